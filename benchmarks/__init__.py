@@ -0,0 +1 @@
+"""性能基准测试脚本，请在仓库根目录下以 `python -m benchmarks.<脚本名>` 的方式运行."""
@@ -0,0 +1,346 @@
+"""在本地模拟的Gelbooru上测试 `GetAPI`、`launch_executor` 和 `Downloader` 的下载吞吐量.
+
+对每组 `max_workers` 和 `unit` 在新的子进程中完整地查询并下载所有图片，
+报告图片数/秒、MB/s、单张图片请求延迟的p50/p99和峰值内存(RSS)，可以保存为基准并与之对比.
+
+用法:
+    ```shell
+    python -m benchmarks.bench_download --images 500 --image_kb 256 --latency 20 \
+        --max_workers 5 10 20 --unit 50 100 --save_baseline baseline.json
+    # 修改代码后与基准对比，吞吐量下降超过 --tolerance 时返回1
+    python -m benchmarks.bench_download --baseline baseline.json
+    ```
+
+默认的模拟服务器运行在另一个进程中，通过本地TCP连接访问；
+`--backend transport` 则使用不经过网络的 `httpx.MockTransport`，只测试客户端本身的开销.
+
+`--existing` 会预先在下载目录中放入一部分图片，使md5检查与下载同时进行，
+可以配合 `--event_loop`、`--file_io_workers` 和 `--hash_workers` 比较不同的事件循环和线程池配置:
+    ```shell
+    python -m benchmarks.bench_download --existing 0.5 --save_baseline default.json
+    python -m benchmarks.bench_download --existing 0.5 --baseline default.json \
+        --event_loop uvloop --file_io_workers 4 --hash_workers 2
+    ```
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.mock_gelbooru import MockGelbooru, SyntheticImages, serve_in_process
+from download_images_coroutine import BASE_URL_PARAMS, GetAPI, launch_executor
+from utils.executors import EVENT_LOOPS, hash_executor, run, use_file_io_executor
+from utils.tag_processor import TagProcessor
+from utils.throughput import TransferStats
+from utils.trace import TraceSink
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class _LatencyRecorder(TraceSink):
+    """只在内存中记录每张图片从发出请求到接收完成的耗时"""
+
+    def __init__(self):
+        super().__init__(os.devnull)
+        self.latencies: List[float] = []
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        phases = record["phases"]
+        if "ttfb" in phases and "transfer" in phases:
+            self.latencies.append(phases["transfer"][1] - phases["ttfb"][0])
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux为KB，macOS为字节
+    return peak / 1048576 if sys.platform == "darwin" else peak / 1024
+
+
+async def _download_all(
+    api_url: str,
+    count: int,
+    max_workers: int,
+    unit: int,
+    download_dir: str,
+    transport: Optional[httpx.AsyncBaseTransport],
+    file_io_workers: Optional[int],
+    hash_workers: Optional[int],
+) -> Dict[str, Any]:
+    use_file_io_executor(file_io_workers)
+    recorder = _LatencyRecorder()
+    stats = TransferStats()
+    tag_processor = TagProcessor()
+    success = duplicate = error = 0
+    md5_executor = hash_executor(hash_workers)
+    async with httpx.AsyncClient(transport=transport) as async_client:
+        get_api = GetAPI(async_client, api_url, BASE_URL_PARAMS)
+        start = time.perf_counter()
+        # 与 `scrape_images` 相同，逐页查询并下载，但不在页之间休息
+        for pid in range(-(-count // unit)):
+            posts = await get_api.get_api("", limit=unit, pid=pid)
+            if posts is None:
+                continue
+            for post in posts:
+                post.tags = tag_processor(post.tags)
+            res = await launch_executor(
+                posts,
+                download_dir,
+                max_workers,
+                timeout=60,
+                async_client=async_client,
+                show_progress=False,
+                transfer_stats=stats,
+                trace_sink=recorder,
+                hash_executor=md5_executor,
+            )
+            success += res.success
+            duplicate += res.duplicate
+            error += res.error
+        elapsed = time.perf_counter() - start
+    if md5_executor is not None:
+        md5_executor.shutdown()
+    mb = stats.total_bytes / 1048576
+    return {
+        "max_workers": max_workers,
+        "unit": unit,
+        "success": success,
+        "duplicate": duplicate,
+        "error": error,
+        "seconds": elapsed,
+        # 重复的图片也计入，它们的md5检查是被测试的一部分
+        "images_per_s": (success + duplicate) / elapsed,
+        "mb_per_s": mb / elapsed,
+        "p50_ms": _percentile(recorder.latencies, 0.5) * 1000,
+        "p99_ms": _percentile(recorder.latencies, 0.99) * 1000,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _write_existing(images: SyntheticImages, download_dir: str, ratio: float) -> None:
+    """预先写入每隔 `1 / ratio` 张中的一张图片，下载时它们的md5检查通过，计为重复"""
+    if ratio <= 0:
+        return
+    step = max(1, round(1 / ratio))
+    for index in range(0, len(images), step):
+        with open(os.path.join(download_dir, f"{images.md5s[index]}.jpg"), "wb") as f:
+            f.write(images.content(index))
+
+
+def _run_case(options: Dict[str, Any], max_workers: int, unit: int) -> Dict[str, Any]:
+    """在子进程中运行一组参数，以便单独统计峰值内存"""
+    download_dir = tempfile.mkdtemp(prefix="bench_download_")
+    transport = None
+    api_url = options["api_url"]
+    images = SyntheticImages(
+        options["images"],
+        options["image_size"],
+        options["size_jitter"],
+        seed=options["seed"],
+    )
+    if api_url is None:
+        app = MockGelbooru(
+            images,
+            latency=options["latency"],
+            api_latency=options["api_latency"],
+        )
+        transport = app.transport()
+        api_url = app.api_url
+    try:
+        _write_existing(images, download_dir, options["existing"])
+        return run(
+            _download_all(
+                api_url,
+                options["images"],
+                max_workers,
+                unit,
+                download_dir,
+                transport,
+                options["file_io_workers"],
+                options["hash_workers"],
+            ),
+            options["event_loop"],
+        )
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def _run_grid(
+    options: Dict[str, Any], args: argparse.Namespace
+) -> List[Dict[str, Any]]:
+    results = []
+    for unit in args.unit:
+        for max_workers in args.max_workers:
+            with multiprocessing.Pool(1) as pool:
+                result = pool.apply(_run_case, (options, max_workers, unit))
+            results.append(result)
+            _print_result(result)
+    return results
+
+
+def _print_result(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    rss = result["peak_rss_mb"]
+    line = (
+        f"{result['max_workers']:>11} {result['unit']:>5} "
+        f"{result['images_per_s']:>10.1f} {result['mb_per_s']:>8.2f} "
+        f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+        f"{'n/a' if rss is None else f'{rss:.1f}':>8} {result['error']:>6}"
+    )
+    if baseline is not None:
+        line += f"  {result['images_per_s'] / baseline['images_per_s']:.2f}x"
+    print(line, flush=True)
+
+
+def _compare(
+    results: List[Dict[str, Any]],
+    config: Dict[str, Any],
+    baseline: Dict[str, Any],
+    tolerance: float,
+) -> bool:
+    """与基准对比，返回是否有吞吐量下降超过 `tolerance` 的参数组合"""
+    if baseline["config"] != config:
+        print("警告: 基准的测试参数与本次不同，对比结果可能没有意义")
+    baseline_results = {
+        (result["max_workers"], result["unit"]): result
+        for result in baseline["results"]
+    }
+    print("\n与基准对比:")
+    regressed = False
+    for result in results:
+        base = baseline_results.get((result["max_workers"], result["unit"]))
+        if base is None:
+            continue
+        _print_result(result, base)
+        if result["images_per_s"] < base["images_per_s"] * (1 - tolerance):
+            regressed = True
+            print(f"{'':>11} ^ 吞吐量下降超过 {tolerance:.0%}")
+    return regressed
+
+
+def main() -> None:  # noqa: D103
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=500, help="每组参数下载的图片数")
+    parser.add_argument("--image_kb", type=float, default=256, help="图片平均大小(KB)")
+    parser.add_argument(
+        "--size_jitter", type=float, default=0.0, help="图片大小浮动比例"
+    )
+    parser.add_argument("--latency", type=float, default=20, help="图片响应延迟(ms)")
+    parser.add_argument("--api_latency", type=float, default=50, help="API响应延迟(ms)")
+    parser.add_argument("--max_workers", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--unit", type=int, nargs="+", default=[100])
+    parser.add_argument(
+        "--backend",
+        choices=("server", "transport"),
+        default="server",
+        help="server: 另一个进程中的本地HTTP服务器; transport: httpx.MockTransport",
+    )
+    parser.add_argument(
+        "--existing",
+        type=float,
+        default=0.0,
+        help="预先放入下载目录的图片比例，这些图片只进行md5检查",
+    )
+    parser.add_argument(
+        "--event_loop", choices=EVENT_LOOPS, default="asyncio", help="使用的事件循环"
+    )
+    parser.add_argument(
+        "--file_io_workers", type=int, default=None, help="文件读写线程数，默认不替换"
+    )
+    parser.add_argument(
+        "--hash_workers", type=int, default=None, help="md5线程数，默认与文件读写共用"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--save_baseline", type=str, default=None, help="保存结果的路径"
+    )
+    parser.add_argument("--baseline", type=str, default=None, help="对比的基准文件")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="允许的吞吐量下降比例"
+    )
+    args = parser.parse_args()
+
+    config = {
+        "images": args.images,
+        "image_size": int(args.image_kb * 1024),
+        "size_jitter": args.size_jitter,
+        "latency": args.latency / 1000,
+        "api_latency": args.api_latency / 1000,
+        "seed": args.seed,
+        "backend": args.backend,
+        "existing": args.existing,
+    }
+    # 事件循环和线程池是被比较的对象，不影响基准是否可比
+    executor_options = {
+        "event_loop": args.event_loop,
+        "file_io_workers": args.file_io_workers,
+        "hash_workers": args.hash_workers,
+    }
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        # 没有指定的参数组合沿用基准的
+        if "--max_workers" not in sys.argv:
+            args.max_workers = sorted({r["max_workers"] for r in baseline["results"]})
+        if "--unit" not in sys.argv:
+            args.unit = sorted({r["unit"] for r in baseline["results"]})
+
+    print(
+        f"{args.images} 张图片，平均 {args.image_kb}KB，"
+        f"延迟 {args.latency}ms，API延迟 {args.api_latency}ms，{args.backend}，"
+        f"已有 {args.existing:.0%}，{executor_options}"
+    )
+    print(
+        f"{'max_workers':>11} {'unit':>5} {'images/s':>10} {'MB/s':>8} "
+        f"{'p50(ms)':>8} {'p99(ms)':>8} {'RSS(MB)':>8} {'errors':>6}"
+    )
+    options = {**config, **executor_options, "api_url": None}
+    if args.backend == "server":
+        server_options = {
+            "count": args.images,
+            "size": config["image_size"],
+            "size_jitter": args.size_jitter,
+            "seed": args.seed,
+            "latency": config["latency"],
+            "api_latency": config["api_latency"],
+        }
+        with serve_in_process(**server_options) as base_url:
+            options["api_url"] = f"{base_url}/index.php"
+            results = _run_grid(options, args)
+    else:
+        results = _run_grid(options, args)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(
+                {"config": config, "executors": executor_options, "results": results},
+                f,
+                indent=2,
+            )
+        print(f"基准已保存到: {args.save_baseline}")
+
+    if baseline is not None and _compare(results, config, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
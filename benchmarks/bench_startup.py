@@ -0,0 +1,86 @@
+"""用 `python -X importtime` 测量各子命令开始工作之前的导入耗时.
+
+每个子命令在新的解释器中只导入它实际会导入的模块，不会访问网络.
+"旧入口" 为 `gelbooru.py` 之前的 `download_images_coroutine.py`，它在解析参数之前就导入了所有模块，
+包括通过 `utils.check_images` 导入的Pillow.
+
+用法:
+    ```shell
+    python -m benchmarks.bench_startup --repeat 5
+    ```
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+_SYNC = (
+    "import gelbooru;"
+    "gelbooru.COMMANDS['sync'](gelbooru._build_parser().parse_args(['sync'])).close()"
+)
+
+# 子命令 -> 执行到开始运行事件循环之前的语句
+CASES = {
+    "旧入口": "import argparse, download_images_coroutine, utils.check_images",
+    "gelbooru.py -h": "import gelbooru; gelbooru._build_parser()",
+    "download / sync": _SYNC,
+    "download --verify_images": f"{_SYNC}; import utils.check_images",
+    "check": "import gelbooru, utils.check_images",
+}
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(statement: str) -> Tuple[float, float, Dict[str, float]]:
+    """在新的解释器中执行 `statement`
+
+    Returns:
+        tuple(导入耗时(ms), 包括解释器启动的总耗时(ms), 顶层模块 -> 累计导入耗时(ms))
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = (time.perf_counter() - start) * 1000
+    top_level = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        # 缩进为1个空格的是顶层导入
+        if match is not None and len(match.group(3)) == 1:
+            top_level[match.group(4)] = int(match.group(2)) / 1000
+    return sum(top_level.values()), wall, top_level
+
+
+def main() -> None:  # noqa: D103
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最快的一次")
+    parser.add_argument("--top", type=int, default=5, help="显示最慢的几个顶层模块")
+    args = parser.parse_args()
+
+    print(f"{'':<28} {'导入(ms)':>10} {'总耗时(ms)':>12}")
+    baseline = None
+    for name, statement in CASES.items():
+        runs = [measure(statement) for _ in range(args.repeat)]
+        imports, _, top_level = min(runs, key=lambda run: run[0])
+        baseline = baseline or imports
+        slowest: List[Tuple[str, float]] = sorted(
+            top_level.items(), key=lambda item: item[1], reverse=True
+        )[: args.top]
+        print(
+            f"{name:<28} {imports:>10.1f} {min(run[1] for run in runs):>12.1f}"
+            f"  {imports / baseline:.0%}"
+        )
+        print(f"{'':<28} " + ", ".join(f"{module} {ms:.0f}" for module, ms in slowest))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""对比 `TagProcessor` 和旧版 `_process_tags` 处理tags的速度.
+
+用法:
+    ```shell
+    python -m benchmarks.bench_tag_processor --posts 100000
+    ```
+"""
+
+import argparse
+import random
+import timeit
+from typing import List
+
+from utils.tag_processor import TagProcessor
+
+
+def legacy_process_tags(
+    tags: str,
+    add_comma: bool,
+    remove_underscore: bool,
+    use_escape: bool,
+) -> str:
+    """`TagProcessor` 之前的 `_process_tags` 实现，作为对比基准"""
+    tag_list = tags.split(" ")
+    # 忽略emoji，将_替换为空格
+    if remove_underscore:
+        for i, tag in enumerate(tag_list):
+            if len(tag) > 3:  # ignore emoji tags like >_< and ^_^
+                tag_list[i] = tag.replace("_", " ")
+    # 转义正则表达式特殊字符
+    if use_escape:
+        for i, tag in enumerate(tag_list):
+            if len(tag) > 3:  # ignore emoji tags like >_< and ^_^
+                tag_list[i] = tag.replace("(", "\\(").replace(")", "\\)")
+    # 添加', '分割或者' '分割
+    final_tags = ", ".join(tag_list) if add_comma else " ".join(tag_list)
+    return final_tags
+
+
+def make_posts(posts: int, vocab: int, tags_per_post: int, seed: int) -> List[str]:
+    """生成符合齐夫分布的模拟tags字符串"""
+    rng = random.Random(seed)
+    vocabulary = [
+        f"tag_{i}_(series_{i % 97})" if i % 5 == 0 else f"some_tag_{i}"
+        for i in range(vocab)
+    ] + [">_<", "^_^", "1girl", "solo"]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return [
+        " ".join(rng.choices(vocabulary, weights=weights, k=tags_per_post))
+        for _ in range(posts)
+    ]
+
+
+def main() -> None:  # noqa: D103
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=100_000, help="模拟的post数")
+    parser.add_argument("--vocab", type=int, default=5000, help="tag词表大小")
+    parser.add_argument("--tags_per_post", type=int, default=40, help="每个post的tag数")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快的一次")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    posts = make_posts(args.posts, args.vocab, args.tags_per_post, args.seed)
+
+    processor = TagProcessor(deduplicate=False)
+    # 默认配置下的输出必须和旧版完全一致
+    for post in posts[:1000]:
+        assert processor(post) == legacy_process_tags(post, True, True, True)
+
+    def run_legacy() -> None:
+        for post in posts:
+            legacy_process_tags(post, True, True, True)
+
+    def run_processor() -> None:
+        processor = TagProcessor()
+        for post in posts:
+            processor(post)
+
+    def run_processor_rules() -> None:
+        processor = TagProcessor(
+            blacklist=["solo"],
+            aliases={"some_tag_1": "some_tag_2"},
+            priority_tags=["1girl", "tag_0_(series_0)"],
+        )
+        for post in posts:
+            processor(post)
+
+    print(f"{args.posts} 个post，每个 {args.tags_per_post} 个tag，词表 {args.vocab}")
+    baseline = None
+    for name, func in (
+        ("_process_tags (旧版)", run_legacy),
+        ("TagProcessor", run_processor),
+        ("TagProcessor + 规则", run_processor_rules),
+    ):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(
+            f"{name:<24} {best:.3f}s  {args.posts / best:,.0f} posts/s  {baseline / best:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
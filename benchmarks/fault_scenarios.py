@@ -0,0 +1,285 @@
+"""在注入了网络故障的本地模拟Gelbooru上检查 `Downloader` 和 `launch_executor` 的行为，完全离线.
+
+每个场景下载两次:
+    1. 第一次下载时注入故障，检查 `_DownloadInfoTuple` 的计数、吞吐量下限和磁盘上每张图片的状态
+    2. 故障只发生在每张图片的第一次请求上，所以在同一目录中再次下载应该修复所有图片，
+       已经正确的图片计为重复
+
+用法:
+    ```shell
+    python -m benchmarks.fault_scenarios
+    python -m benchmarks.fault_scenarios --scenario reset truncate --backend transport
+    ```
+
+任意场景失败时返回1.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+from benchmarks.mock_gelbooru import Faults, MockGelbooru, MockServer, SyntheticImages
+from download_images_coroutine import (
+    BASE_URL_PARAMS,
+    GetAPI,
+    _DownloadInfoTuple,
+    launch_executor,
+)
+
+
+class Scenario(NamedTuple):
+    """一个故障场景"""
+
+    name: str
+    """场景名"""
+    faults: Faults
+    """注入的故障"""
+    min_images_per_s: float
+    """第一次下载的吞吐量下限，单位为图片数/秒"""
+
+
+SCENARIOS = (
+    Scenario("baseline", Faults(), 40),
+    Scenario("jitter", Faults(jitter=0.1), 25),
+    Scenario("trickle", Faults(trickle=0.2, trickle_delay=0.02), 15),
+    # 每块之间的等待超过超时限制，连接被挂起
+    Scenario("stall", Faults(trickle=0.05, trickle_delay=3), 5),
+    Scenario("reset", Faults(reset=0.1), 30),
+    Scenario("truncate", Faults(truncate=0.1), 30),
+    Scenario("status_burst", Faults(burst_every=40, burst_length=8), 30),
+    Scenario("wrong_md5", Faults(wrong_md5=0.1), 30),
+    Scenario(
+        "mixed",
+        Faults(
+            jitter=0.05,
+            trickle=0.1,
+            trickle_delay=0.02,
+            reset=0.05,
+            truncate=0.05,
+            wrong_md5=0.05,
+            burst_every=50,
+            burst_length=5,
+        ),
+        15,
+    ),
+)
+
+_TIMEOUT = 2  # 单张图片的下载超时限制(s)
+
+
+def _disk_state(images: SyntheticImages, download_dir: str) -> Dict[int, str]:
+    """每张图片在磁盘上的状态: ok, corrupt(大小正确但md5错误), partial 或 missing"""
+    states = {}
+    for index, md5 in enumerate(images.md5s):
+        path = os.path.join(download_dir, f"{md5}.jpg")
+        if not os.path.exists(path):
+            states[index] = "missing"
+            continue
+        with open(path, "rb") as f:
+            content = f.read()
+        if hashlib.md5(content).hexdigest() == md5:
+            states[index] = "ok"
+        elif len(content) == images.sizes[index]:
+            states[index] = "corrupt"
+        else:
+            states[index] = "partial"
+    return states
+
+
+def _missing_captions(images: SyntheticImages, download_dir: str) -> int:
+    """没有tags文本的图片数，无论图片是否下载成功都应该写入tags"""
+    return sum(
+        not os.path.exists(os.path.join(download_dir, f"{md5}.txt"))
+        for md5 in images.md5s
+    )
+
+
+async def _download(
+    api_url: str,
+    count: int,
+    download_dir: str,
+    max_workers: int,
+    unit: int,
+    transport: Optional[httpx.AsyncBaseTransport],
+) -> Tuple[_DownloadInfoTuple, float]:
+    """逐页下载所有图片，返回下载计数和耗时"""
+    total = _DownloadInfoTuple(0, 0, 0, 0)
+    async with httpx.AsyncClient(transport=transport) as async_client:
+        get_api = GetAPI(async_client, api_url, BASE_URL_PARAMS)
+        start = time.perf_counter()
+        for pid in range(-(-count // unit)):
+            posts = await get_api.get_api("", limit=unit, pid=pid)
+            assert posts is not None, f"第 {pid} 页查询失败"
+            res = await launch_executor(
+                posts,
+                download_dir,
+                max_workers,
+                timeout=_TIMEOUT,
+                async_client=async_client,
+                show_progress=False,
+            )
+            total = _DownloadInfoTuple(*(a + b for a, b in zip(total, res)))
+        elapsed = time.perf_counter() - start
+    return total, elapsed
+
+
+def _expected_state(kind: Optional[str], faults: Faults) -> Tuple[str, ...]:
+    """注入 `kind` 故障的图片在第一次下载后可能的磁盘状态"""
+    if kind is None or (kind == "trickle" and faults.trickle_delay < _TIMEOUT):
+        return ("ok",)
+    if kind == "wrong_md5":
+        return ("corrupt",)
+    if kind.startswith("http_"):
+        return ("missing",)
+    # 被重置的连接可能连已经发送的部分也收不到
+    return ("partial", "missing")
+
+
+async def run_scenario(  # noqa: C901
+    scenario: Scenario,
+    images: SyntheticImages,
+    backend: str,
+    max_workers: int,
+    unit: int,
+    floor_scale: float,
+) -> List[str]:
+    """运行一个场景，返回所有未通过的检查"""
+    app = MockGelbooru(images, latency=0.01, faults=scenario.faults)
+    failures = []
+
+    with tempfile.TemporaryDirectory(prefix="fault_scenario_") as download_dir:
+        server = None
+        transport = None
+        if backend == "server":
+            server = MockServer(app)
+            await server.start()
+        else:
+            transport = app.transport()
+        try:
+            count = len(images)
+            # 第一次下载
+            res, elapsed = await _download(
+                app.api_url, count, download_dir, max_workers, unit, transport
+            )
+            # md5错误的图片不会被发现，仍然计为成功
+            errors = sum(
+                _expected_state(kind, scenario.faults) not in (("ok",), ("corrupt",))
+                for kind in app.injected.values()
+            )
+            expected = _DownloadInfoTuple(count, count - errors, 0, errors)
+            if res != expected:
+                failures.append(
+                    f"第一次下载的计数为 {tuple(res)}，应为 {tuple(expected)}"
+                )
+            images_per_s = count / elapsed
+            floor = scenario.min_images_per_s * floor_scale
+            if images_per_s < floor:
+                failures.append(f"吞吐量 {images_per_s:.1f} 张/秒 低于下限 {floor:.1f}")
+
+            states = _disk_state(images, download_dir)
+            for index, state in states.items():
+                allowed = _expected_state(app.injected.get(index), scenario.faults)
+                if state not in allowed:
+                    failures.append(
+                        f"图片 {index} ({app.injected.get(index)}) 的状态为 {state}，"
+                        f"应为 {'/'.join(allowed)}"
+                    )
+            missing_captions = _missing_captions(images, download_dir)
+            if missing_captions:
+                failures.append(f"{missing_captions} 张图片没有写入tags")
+
+            # 再次下载，修复所有图片
+            broken = sum(state != "ok" for state in states.values())
+            res, _ = await _download(
+                app.api_url, count, download_dir, max_workers, unit, transport
+            )
+            expected = _DownloadInfoTuple(count, broken, count - broken, 0)
+            if res != expected:
+                failures.append(
+                    f"再次下载的计数为 {tuple(res)}，应为 {tuple(expected)}"
+                )
+            not_ok = [
+                index
+                for index, state in _disk_state(images, download_dir).items()
+                if state != "ok"
+            ]
+            if not_ok:
+                failures.append(f"再次下载后仍有 {len(not_ok)} 张图片不正确")
+
+            injected: Dict[str, int] = {}
+            for kind in app.injected.values():
+                injected[kind] = injected.get(kind, 0) + 1
+            print(
+                f"{scenario.name:<14} {images_per_s:>8.1f} 张/秒  "
+                f"注入: {injected or '-'}  损坏: {broken}"
+            )
+        finally:
+            if server is not None:
+                await server.close()
+    return failures
+
+
+async def _main(args: argparse.Namespace) -> int:
+    images = SyntheticImages(args.images, int(args.image_kb * 1024), seed=args.seed)
+    scenarios = [
+        scenario
+        for scenario in SCENARIOS
+        if not args.scenario or scenario.name in args.scenario
+    ]
+    failed = 0
+    for scenario in scenarios:
+        failures = await run_scenario(
+            scenario._replace(faults=scenario.faults._replace(seed=args.seed)),
+            images,
+            args.backend,
+            args.max_workers,
+            args.unit,
+            args.floor_scale,
+        )
+        for failure in failures:
+            print(f"    FAIL: {failure}")
+        failed += bool(failures)
+    print(f"{len(scenarios) - failed} / {len(scenarios)} 个场景通过")
+    return 1 if failed else 0
+
+
+def main() -> None:  # noqa: D103
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario",
+        nargs="*",
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="要运行的场景，默认全部",
+    )
+    parser.add_argument("--images", type=int, default=200, help="每个场景的图片数")
+    parser.add_argument("--image_kb", type=float, default=64, help="图片大小(KB)")
+    parser.add_argument("--max_workers", type=int, default=10)
+    parser.add_argument("--unit", type=int, default=100)
+    parser.add_argument(
+        "--backend",
+        choices=("server", "transport"),
+        default="server",
+        help="server: 本地HTTP服务器; transport: httpx.MockTransport",
+    )
+    parser.add_argument(
+        "--floor_scale", type=float, default=1.0, help="吞吐量下限的缩放比例"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="显示下载错误的日志")
+    args = parser.parse_args()
+
+    # 注入的故障会产生大量预期之内的错误日志
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    sys.exit(asyncio.run(_main(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""在几个本地模拟的图片服务器上检查 `HostSelector` 的服务器选择和故障转移，完全离线.
+
+主服务器同时提供API和图片，API返回的图片链接指向主服务器；其余服务器是提供相同图片的镜像.
+每个场景分别在不使用和使用 `HostSelector` 时下载所有图片，检查使用时:
+    1. 所有图片都下载成功且内容正确
+    2. 主服务器变慢或故障后，其余的图片请求大部分被转到镜像
+    3. 吞吐量不低于下限
+
+用法:
+    ```shell
+    python -m benchmarks.host_failover
+    python -m benchmarks.host_failover --scenario primary_down --verbose
+    ```
+
+任意场景失败时返回1.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+import httpx
+
+from benchmarks.mock_gelbooru import Faults, MockGelbooru, MockServer, SyntheticImages
+from download_images_coroutine import (
+    BASE_URL_PARAMS,
+    GetAPI,
+    _DownloadInfoTuple,
+    launch_executor,
+)
+from utils.hosts import HostSelector
+
+
+class Scenario(NamedTuple):
+    """一个服务器故障场景"""
+
+    name: str
+    """场景名"""
+    mirror_latencies: Tuple[float, ...] = (0.01, 0.01)
+    """各镜像的图片响应延迟，单位为秒"""
+    dead_mirrors: int = 0
+    """下载开始前关闭的镜像数，对它们的请求会被拒绝连接"""
+    slow_latency: Optional[float] = None
+    """主服务器在 `degrade_after_page` 页之后的图片响应延迟，`None` 则不变慢"""
+    down: bool = False
+    """主服务器在 `degrade_after_page` 页之后是否对每张图片都返回503"""
+    degrade_after_page: int = 0
+    """主服务器从第几页之后开始变慢或故障"""
+    max_primary_share: float = 1.0
+    """变慢或故障之后，主服务器承担的图片请求比例的上限"""
+    min_images_per_s: float = 20
+    """使用 `HostSelector` 时的吞吐量下限，单位为图片数/秒"""
+
+
+SCENARIOS = (
+    # 所有服务器都正常时几乎只使用主服务器
+    Scenario("healthy", min_images_per_s=40),
+    Scenario("primary_slow", slow_latency=0.5, max_primary_share=0.3),
+    Scenario(
+        "primary_slow_midway",
+        slow_latency=0.5,
+        degrade_after_page=1,
+        max_primary_share=0.3,
+    ),
+    Scenario("primary_down", down=True, degrade_after_page=1, max_primary_share=0.1),
+    Scenario(
+        "dead_mirror",
+        mirror_latencies=(0.01, 0.01),
+        dead_mirrors=1,
+        down=True,
+        degrade_after_page=1,
+        max_primary_share=0.1,
+    ),
+    Scenario(
+        "uneven_mirrors",
+        mirror_latencies=(0.3, 0.01),
+        slow_latency=0.5,
+        max_primary_share=0.3,
+    ),
+)
+
+_PRIMARY_LATENCY = 0.01  # 主服务器正常时的图片响应延迟(s)
+_TIMEOUT = 5  # 单张图片的下载超时限制(s)
+
+
+class _Servers:
+    """一个主服务器和若干镜像"""
+
+    def __init__(self, images: SyntheticImages, scenario: Scenario):
+        self.primary = MockServer(MockGelbooru(images, latency=_PRIMARY_LATENCY))
+        self.mirrors = [
+            MockServer(MockGelbooru(images, latency=latency))
+            for latency in scenario.mirror_latencies
+        ]
+        self.scenario = scenario
+
+    async def __aenter__(self) -> "_Servers":
+        for server in (self.primary, *self.mirrors):
+            await server.start()
+        for server in self.mirrors[: self.scenario.dead_mirrors]:
+            await server.close()
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        for server in (self.primary, *self.mirrors):
+            await server.close()
+
+    def degrade(self) -> None:
+        """让主服务器变慢或故障"""
+        app = self.primary.app
+        if self.scenario.slow_latency is not None:
+            app.latency = self.scenario.slow_latency
+        if self.scenario.down:
+            # 每张图片的第一次请求都返回503，而镜像是独立的 `MockGelbooru`，不受影响
+            app.faults = Faults(burst_every=1, burst_length=1, burst_statuses=(503,))
+
+
+def _broken_images(images: SyntheticImages, download_dir: str) -> int:
+    """不存在或内容不正确的图片数"""
+    broken = 0
+    for md5 in images.md5s:
+        path = os.path.join(download_dir, f"{md5}.jpg")
+        if not os.path.exists(path):
+            broken += 1
+            continue
+        with open(path, "rb") as f:
+            broken += hashlib.md5(f.read()).hexdigest() != md5
+    return broken
+
+
+async def _download(
+    images: SyntheticImages,
+    scenario: Scenario,
+    download_dir: str,
+    max_workers: int,
+    unit: int,
+    use_selector: bool,
+) -> Tuple[_DownloadInfoTuple, float, float, Optional[HostSelector]]:
+    """逐页下载所有图片
+
+    Returns:
+        tuple(下载计数, 耗时, 变慢或故障之后主服务器承担的图片请求比例, 使用的选择器)
+    """
+    total = _DownloadInfoTuple(0, 0, 0, 0)
+    async with _Servers(images, scenario) as servers, httpx.AsyncClient() as client:
+        host_selector = (
+            HostSelector(
+                [servers.primary.base_url] + [m.base_url for m in servers.mirrors]
+            )
+            if use_selector
+            else None
+        )
+        get_api = GetAPI(client, servers.primary.api_url, BASE_URL_PARAMS)
+        primary_images = degraded_images = 0
+        start = time.perf_counter()
+        for pid in range(-(-len(images) // unit)):
+            if pid == scenario.degrade_after_page:
+                servers.degrade()
+            posts = await get_api.get_api("", limit=unit, pid=pid)
+            assert posts is not None, f"第 {pid} 页查询失败"
+            primary_requests = servers.primary.app.requests
+            res = await launch_executor(
+                posts,
+                download_dir,
+                max_workers,
+                timeout=_TIMEOUT,
+                async_client=client,
+                show_progress=False,
+                host_selector=host_selector,
+            )
+            total = _DownloadInfoTuple(*(a + b for a, b in zip(total, res)))
+            if pid >= scenario.degrade_after_page:
+                primary_images += servers.primary.app.requests - primary_requests
+                degraded_images += len(posts)
+        elapsed = time.perf_counter() - start
+    return total, elapsed, primary_images / max(1, degraded_images), host_selector
+
+
+async def run_scenario(
+    scenario: Scenario,
+    images: SyntheticImages,
+    max_workers: int,
+    unit: int,
+    floor_scale: float,
+) -> List[str]:
+    """运行一个场景，返回所有未通过的检查"""
+    failures = []
+    count = len(images)
+    with tempfile.TemporaryDirectory(prefix="host_failover_") as download_dir:
+        without, without_elapsed, _, _ = await _download(
+            images, scenario, download_dir, max_workers, unit, use_selector=False
+        )
+    with tempfile.TemporaryDirectory(prefix="host_failover_") as download_dir:
+        res, elapsed, primary_share, host_selector = await _download(
+            images, scenario, download_dir, max_workers, unit, use_selector=True
+        )
+        broken = _broken_images(images, download_dir)
+
+    expected = _DownloadInfoTuple(count, count, 0, 0)
+    if res != expected:
+        failures.append(f"下载计数为 {tuple(res)}，应为 {tuple(expected)}")
+    if broken:
+        failures.append(f"{broken} 张图片不存在或内容不正确")
+    if primary_share > scenario.max_primary_share:
+        failures.append(
+            f"主服务器承担了 {primary_share:.0%} 的图片请求，"
+            f"应不超过 {scenario.max_primary_share:.0%}"
+        )
+    images_per_s = count / elapsed
+    floor = scenario.min_images_per_s * floor_scale
+    if images_per_s < floor:
+        failures.append(f"吞吐量 {images_per_s:.1f} 张/秒 低于下限 {floor:.1f}")
+
+    print(
+        f"{scenario.name:<22} 不使用: {count / without_elapsed:>6.1f} 张/秒 "
+        f"失败 {without.error:>3}  使用: {images_per_s:>6.1f} 张/秒 失败 {res.error:>3}  "
+        f"主服务器比例: {primary_share:.0%}"
+    )
+    if host_selector is not None and logging.getLogger().isEnabledFor(logging.INFO):
+        print(host_selector.format())
+    return failures
+
+
+async def _main(args: argparse.Namespace) -> int:
+    images = SyntheticImages(args.images, int(args.image_kb * 1024), seed=args.seed)
+    scenarios = [
+        scenario
+        for scenario in SCENARIOS
+        if not args.scenario or scenario.name in args.scenario
+    ]
+    failed = 0
+    for scenario in scenarios:
+        failures = await run_scenario(
+            scenario, images, args.max_workers, args.unit, args.floor_scale
+        )
+        for failure in failures:
+            print(f"    FAIL: {failure}")
+        failed += bool(failures)
+    print(f"{len(scenarios) - failed} / {len(scenarios)} 个场景通过")
+    return 1 if failed else 0
+
+
+def main() -> None:  # noqa: D103
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario",
+        nargs="*",
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="要运行的场景，默认全部",
+    )
+    parser.add_argument("--images", type=int, default=200, help="每个场景的图片数")
+    parser.add_argument("--image_kb", type=float, default=64, help="图片大小(KB)")
+    parser.add_argument("--max_workers", type=int, default=10)
+    parser.add_argument("--unit", type=int, default=50)
+    parser.add_argument(
+        "--floor_scale", type=float, default=1.0, help="吞吐量下限的缩放比例"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verbose", action="store_true", help="显示下载错误的日志和各服务器的统计"
+    )
+    args = parser.parse_args()
+
+    # 故障会产生大量预期之内的错误日志
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    sys.exit(asyncio.run(_main(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""在本地模拟的Gelbooru上检查多台机器协同下载(`coordinate_job` 和 `run_job_worker`)，完全离线.
+
+每个场景在同一个SQLite任务队列上运行一个协调进程(本进程)和若干个 `run_job_worker` 子进程，检查:
+    1. 协调进程在期限内返回，不会因为崩溃的工作进程留下的租约而一直等待
+    2. 每一页都恰好完成一次: 状态为DONE，只被租用过一次(崩溃的工作进程租用过的页面除外)
+    3. 已完成页面的下载计数之和与图片数相同，没有图片被下载两次，磁盘上的图片内容正确
+
+崩溃的工作进程在其他工作进程启动前租用第一页，然后不释放租约直接退出.
+
+用法:
+    ```shell
+    python -m benchmarks.job_queue_scenarios
+    python -m benchmarks.job_queue_scenarios --scenario crashed_worker --verbose
+    ```
+
+任意场景失败时返回1.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from benchmarks.mock_gelbooru import MockGelbooru, MockServer, SyntheticImages
+from download_images_coroutine import coordinate_job, run_job_worker
+from utils.job_queue import UnitState, WorkQueue
+
+
+class Scenario(NamedTuple):
+    """一个协同下载场景"""
+
+    name: str
+    """场景名"""
+    workers: int
+    """工作进程数"""
+    crashed_leases: int = 0
+    """崩溃的工作进程对第一页的租用次数，每次都等租约过期后再租用，0则没有崩溃的工作进程"""
+    pages: Optional[int] = None
+    """任务的页数，`None` 则下载所有图片"""
+    failed_pages: Tuple[int, ...] = ()
+    """应该失败的页面"""
+
+
+SCENARIOS = (
+    Scenario("workers", workers=3),
+    # 崩溃的工作进程的租约过期后，第一页由其他工作进程重新下载
+    Scenario("crashed_worker", workers=3, crashed_leases=1),
+    # 最后一个工作进程崩溃时没有其他工作进程，只能由协调进程发现租约过期并把页面标记为失败
+    Scenario(
+        "abandoned_lease", workers=0, crashed_leases=3, pages=1, failed_pages=(0,)
+    ),
+)
+
+_WORKER_LEASE_SECONDS = (
+    3.0  # 正常工作进程的租约时长(s)，等待其他工作进程时每1/3租约时长查看一次
+)
+_CRASHED_LEASE_SECONDS = 0.5  # 崩溃的工作进程的租约时长(s)
+_WATCH_INTERVAL = 0.2  # 协调进程查看进度的间隔(s)
+_DEADLINE = 60  # 协调进程等待所有页面完成的期限(s)
+
+
+def _quiet(verbose: bool) -> None:
+    """不显示子进程的进度条和输出"""
+    if not verbose:
+        devnull = open(os.devnull, "w")  # noqa: SIM115
+        sys.stdout = sys.stderr = devnull
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+
+def _run_worker(job_queue: str, download_dir: str, api_url: str, verbose: bool) -> None:
+    _quiet(verbose)
+    asyncio.run(
+        run_job_worker(
+            job_queue,
+            download_dir,
+            lease_seconds=_WORKER_LEASE_SECONDS,
+            base_url=api_url,
+        )
+    )
+
+
+def _crash_worker(job_queue: str, leases: int) -> None:
+    """租用 `leases` 次第一页，然后不释放租约直接退出"""
+    with WorkQueue(job_queue, lease_seconds=_CRASHED_LEASE_SECONDS) as queue:
+        for n in range(leases):
+            if n > 0:
+                time.sleep(_CRASHED_LEASE_SECONDS * 1.5)
+            queue.lease("crashed-worker")
+    os._exit(1)
+
+
+def _units(job_queue: str) -> List[Tuple[int, int, int, int, int]]:
+    """所有单元的 (页码, 状态, 租用次数, 总下载任务, 成功下载数)"""
+    with contextlib.closing(sqlite3.connect(job_queue)) as conn:
+        return conn.execute(
+            "SELECT page, state, attempts, all_count, success_count FROM units ORDER BY page"
+        ).fetchall()
+
+
+def _ok_images(images: SyntheticImages, download_dir: str) -> int:
+    """内容正确的图片数"""
+    ok = 0
+    for md5 in images.md5s:
+        path = os.path.join(download_dir, f"{md5}.jpg")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                ok += hashlib.md5(f.read()).hexdigest() == md5
+    return ok
+
+
+async def _join(process: multiprocessing.Process) -> None:
+    await asyncio.to_thread(process.join)
+
+
+async def _run_job(
+    scenario: Scenario,
+    job_queue: str,
+    download_dir: str,
+    api_url: str,
+    count: int,
+    unit: int,
+    verbose: bool,
+) -> Tuple[bool, float]:
+    """创建任务，启动崩溃的工作进程和正常的工作进程，并等待协调进程返回
+
+    Returns:
+        tuple(协调进程是否在期限内返回, 启动工作进程之后的耗时)
+    """
+    context = multiprocessing.get_context("spawn")
+    # 先创建任务，再启动工作进程
+    await coordinate_job("", count, job_queue, unit, watch_interval=0, base_url=api_url)
+    if scenario.crashed_leases:
+        crashed = context.Process(
+            target=_crash_worker, args=(job_queue, scenario.crashed_leases)
+        )
+        crashed.start()
+        await _join(crashed)
+
+    start = time.perf_counter()
+    workers = [
+        context.Process(
+            target=_run_worker, args=(job_queue, download_dir, api_url, verbose)
+        )
+        for _ in range(scenario.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    finished = True
+    try:
+        await asyncio.wait_for(
+            coordinate_job(
+                "",
+                count,
+                job_queue,
+                unit,
+                watch_interval=_WATCH_INTERVAL,
+                base_url=api_url,
+            ),
+            _DEADLINE,
+        )
+    except asyncio.TimeoutError:
+        finished = False
+        for worker in workers:
+            worker.terminate()
+    await asyncio.gather(*(_join(worker) for worker in workers))
+    return finished, time.perf_counter() - start
+
+
+def _check_units(
+    scenario: Scenario,
+    units: List[Tuple[int, int, int, int, int]],
+    count: int,
+    unit: int,
+) -> List[str]:
+    """检查每一页的状态、租用次数和下载计数，返回所有未通过的检查"""
+    failures = []
+    page_count = -(-count // unit)
+    if len(units) != page_count:
+        failures.append(f"任务队列中有 {len(units)} 页，应为 {page_count} 页")
+    for page, state, attempts, all_count, success_count in units:
+        expected_state = (
+            UnitState.FAILED if page in scenario.failed_pages else UnitState.DONE
+        )
+        # 崩溃的工作进程租用的第一页完成时，还要加上重新下载的那一次
+        expected_attempts = (
+            scenario.crashed_leases + (expected_state == UnitState.DONE)
+            if page == 0 and scenario.crashed_leases
+            else 1
+        )
+        if state != expected_state:
+            failures.append(
+                f"第 {page} 页的状态为 {UnitState(state).name}，应为 {expected_state.name}"
+            )
+        if attempts != expected_attempts:
+            failures.append(
+                f"第 {page} 页被租用了 {attempts} 次，应为 {expected_attempts} 次"
+            )
+        if state == UnitState.DONE and success_count != all_count:
+            failures.append(
+                f"第 {page} 页成功下载 {success_count} / {all_count} 张，"
+                "可能被下载了不止一次"
+            )
+    return failures
+
+
+async def run_scenario(
+    scenario: Scenario, images: SyntheticImages, unit: int, verbose: bool
+) -> List[str]:
+    """运行一个场景，返回所有未通过的检查"""
+    count = len(images) if scenario.pages is None else scenario.pages * unit
+    expected_images = count - sum(
+        min(unit, count - page * unit) for page in scenario.failed_pages
+    )
+    with tempfile.TemporaryDirectory(prefix="job_queue_") as work_dir:
+        job_queue = os.path.join(work_dir, "job.sqlite")
+        download_dir = os.path.join(work_dir, "images")
+        output = sys.stdout if verbose else io.StringIO()
+        async with MockServer(MockGelbooru(images, latency=0.01)) as server:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                finished, elapsed = await _run_job(
+                    scenario,
+                    job_queue,
+                    download_dir,
+                    server.api_url,
+                    count,
+                    unit,
+                    verbose,
+                )
+
+        failures = [] if finished else [f"协调进程在 {_DEADLINE} 秒内没有返回"]
+        units = _units(job_queue)
+        failures += _check_units(scenario, units, count, unit)
+        downloaded = sum(row[3] for row in units if row[1] == UnitState.DONE)
+        if downloaded != expected_images:
+            failures.append(
+                f"已完成页面的下载任务共 {downloaded} 张，应为 {expected_images} 张"
+            )
+        ok = _ok_images(images, download_dir)
+        if ok != expected_images:
+            failures.append(f"内容正确的图片有 {ok} 张，应为 {expected_images} 张")
+
+    done = sum(row[1] == UnitState.DONE for row in units)
+    print(
+        f"{scenario.name:<18} 工作进程: {scenario.workers}  "
+        f"完成: {done} / {len(units)} 页  图片: {ok}  耗时: {elapsed:.1f}s"
+    )
+    return failures
+
+
+async def _main(args: argparse.Namespace) -> int:
+    images = SyntheticImages(args.images, int(args.image_kb * 1024), seed=args.seed)
+    scenarios = [
+        scenario
+        for scenario in SCENARIOS
+        if not args.scenario or scenario.name in args.scenario
+    ]
+    failed = 0
+    for scenario in scenarios:
+        failures = await run_scenario(scenario, images, args.unit, args.verbose)
+        for failure in failures:
+            print(f"    FAIL: {failure}")
+        failed += bool(failures)
+    print(f"{len(scenarios) - failed} / {len(scenarios)} 个场景通过")
+    return 1 if failed else 0
+
+
+def main() -> None:  # noqa: D103
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario",
+        nargs="*",
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="要运行的场景，默认全部",
+    )
+    parser.add_argument("--images", type=int, default=300, help="每个场景的图片数")
+    parser.add_argument("--image_kb", type=float, default=32, help="图片大小(KB)")
+    parser.add_argument("--unit", type=int, default=20, help="每页图片数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verbose", action="store_true", help="显示协调进程和工作进程的输出"
+    )
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    sys.exit(asyncio.run(_main(args)))
+
+
+if __name__ == "__main__":
+    main()
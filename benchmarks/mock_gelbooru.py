@@ -0,0 +1,564 @@
+"""本地的Gelbooru模拟服务器，用于在不访问gelbooru.com的情况下测试和基准测试下载.
+
+API返回与真实Gelbooru相同格式的 `@attributes` 和 `post` JSON，
+图片为指定大小的合成数据，md5与API中的一致.
+还可以通过 `Faults` 注入延迟抖动、慢速传输、连接重置、内容截断、429/5xx和md5错误等网络故障.
+
+可以作为独立的HTTP服务器运行:
+    ```shell
+    python -m benchmarks.mock_gelbooru --images 1000 --image_kb 512 --latency 20 --port 8000
+    # 10%的图片在传输中途重置连接，每50个图片请求中有5个返回429或503
+    python -m benchmarks.mock_gelbooru --reset 0.1 --burst_every 50 --burst_length 5
+    ```
+
+也可以在代码中使用:
+    ```python
+    app = MockGelbooru(SyntheticImages(100, 256 * 1024))
+    # 真实的本地HTTP服务器
+    async with MockServer(app) as server:
+        get_api = GetAPI(client, server.api_url, BASE_URL_PARAMS)
+    # 或者不经过网络的 `httpx` 传输层
+    client = httpx.AsyncClient(transport=app.transport())
+    ```
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import random
+import socket
+import struct
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+from benchmarks.bench_tag_processor import make_posts
+
+__all__ = (
+    "FAULT_KINDS",
+    "MOCK_HOST",
+    "Faults",
+    "MockGelbooru",
+    "MockResponse",
+    "MockServer",
+    "SyntheticImages",
+    "serve_in_process",
+)
+
+
+MOCK_HOST = "127.0.0.1"
+TRANSPORT_BASE_URL = "http://gelbooru.mock"  # `transport()` 使用的虚拟地址
+_CHUNK_SIZE = 64 * 1024
+_TRICKLE_CHUNK_SIZE = 4 * 1024  # 慢速传输时每次发送的字节数
+FAULT_KINDS = ("trickle", "reset", "truncate", "wrong_md5")
+"""按图片分配的故障，见 `Faults`"""
+
+
+class SyntheticImages:
+    """大小确定、内容各不相同的合成图片
+
+    所有图片共享一段随机数据，每张图片只在开头写入自己的序号，所以生成再多的图片也只占用一份内存.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        size: int,
+        size_jitter: float = 0.0,
+        tags_per_post: int = 30,
+        seed: int = 0,
+    ):
+        """合成图片
+
+        Args:
+            count: 图片数
+            size: 图片的平均大小，单位为字节
+            size_jitter: 图片大小在 `size` 上下随机浮动的比例，0则所有图片大小相同. Defaults to 0.0.
+            tags_per_post: 每张图片的tag数. Defaults to 30.
+            seed: 随机种子. Defaults to 0.
+        """
+        rng = random.Random(seed)
+        self.sizes = [
+            max(16, int(size * (1 + rng.uniform(-size_jitter, size_jitter))))
+            for _ in range(count)
+        ]
+        self._payload = rng.randbytes(max(self.sizes, default=16))
+        self.tags = make_posts(count, 5000, tags_per_post, seed)
+        self.md5s = [
+            hashlib.md5(self.content(index)).hexdigest() for index in range(count)
+        ]
+        self._index = {md5: index for index, md5 in enumerate(self.md5s)}
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.sizes)
+
+    def content(self, index: int) -> bytes:
+        """第 `index` 张图片的内容"""
+        header = index.to_bytes(16, "big")
+        return header + self._payload[: self.sizes[index] - len(header)]
+
+    def find(self, md5: str) -> Optional[int]:
+        """md5对应的图片序号，不存在时为 `None`"""
+        return self._index.get(md5)
+
+
+class Faults(NamedTuple):
+    """`MockGelbooru` 注入的网络故障
+
+    `FAULT_KINDS` 中的故障按比例分配给互不重叠的图片，错误状态码则按图片请求的顺序成批出现.
+    除了延迟抖动，故障只发生在每张图片的第一次请求上，所以重新下载应该能修复所有图片.
+    """
+
+    jitter: float = 0.0
+    """每个图片请求额外的 `0~jitter` 秒随机延迟"""
+    trickle: float = 0.0
+    """慢速传输的图片比例"""
+    trickle_delay: float = 0.05
+    """慢速传输时每发送4KB之前的等待时间，单位为秒"""
+    reset: float = 0.0
+    """传输到一半时重置连接的图片比例"""
+    truncate: float = 0.0
+    """只发送一半内容就正常关闭连接的图片比例，`Content-Length` 仍为完整的大小"""
+    wrong_md5: float = 0.0
+    """内容与API中的md5不一致的图片比例，大小不变"""
+    burst_every: int = 0
+    """每多少个图片请求出现一批错误状态码，0则不出现"""
+    burst_length: int = 0
+    """每批错误状态码的请求数"""
+    burst_statuses: Tuple[int, ...] = (429, 503)
+    """各批轮流使用的状态码"""
+    seed: int = 0
+    """随机种子"""
+
+
+class MockResponse(NamedTuple):
+    """`MockGelbooru` 对一个请求的响应"""
+
+    status: int
+    """HTTP状态码"""
+    content_type: str
+    """Content-Type"""
+    body: bytes
+    """响应内容，`Content-Length` 总是它的完整长度"""
+    chunk_delay: float = 0.0
+    """每发送一小块内容之前的等待时间，单位为秒，0则全速发送"""
+    cut_at: Optional[int] = None
+    """只发送这么多字节就断开连接，`None` 则完整发送"""
+    reset: bool = False
+    """断开连接的方式，True为重置连接(RST)，False为正常关闭"""
+
+    def chunks(self) -> Iterator[memoryview]:
+        """要发送的内容块，断开连接之前的部分"""
+        body = memoryview(self.body)
+        end = len(body) if self.cut_at is None else self.cut_at
+        size = _TRICKLE_CHUNK_SIZE if self.chunk_delay else _CHUNK_SIZE
+        for start in range(0, end, size):
+            yield body[start : min(start + size, end)]
+
+
+class MockGelbooru:
+    """模拟的Gelbooru API和图片服务器，与传输方式无关"""
+
+    def __init__(
+        self,
+        images: SyntheticImages,
+        latency: float = 0.0,
+        api_latency: float = 0.0,
+        base_url: str = TRANSPORT_BASE_URL,
+        faults: Optional[Faults] = None,
+    ):
+        """模拟的Gelbooru
+
+        Args:
+            images: 提供的图片
+            latency: 图片请求的响应延迟，单位为秒. Defaults to 0.0.
+            api_latency: API请求的响应延迟，单位为秒. Defaults to 0.0.
+            base_url: 图片链接使用的地址，`MockServer` 启动后会将其设置为服务器的地址.
+                Defaults to TRANSPORT_BASE_URL.
+            faults: 注入的网络故障，`None` 则不注入. Defaults to None.
+        """
+        self.images = images
+        self.latency = latency
+        self.api_latency = api_latency
+        self.base_url = base_url
+        self.faults = faults
+        self.requests = 0
+        """收到的请求数"""
+        self.injected: Dict[int, str] = {}
+        """图片序号 -> 实际注入的故障，`FAULT_KINDS` 之一或 `http_<状态码>`"""
+        self._requested: Set[int] = set()
+        self._planned: Dict[int, str] = {}
+        self._rng = random.Random(faults.seed if faults is not None else 0)
+        if faults is not None:
+            order = list(range(len(images)))
+            self._rng.shuffle(order)
+            start = 0
+            for kind in FAULT_KINDS:
+                end = start + round(getattr(faults, kind) * len(images))
+                self._planned.update((index, kind) for index in order[start:end])
+                start = end
+
+    @property
+    def api_url(self) -> str:
+        """用于 `GetAPI` 的 `base_url`"""
+        return f"{self.base_url}/index.php"
+
+    def post(self, index: int) -> Dict[str, Any]:
+        """第 `index` 张图片的post，字段与Gelbooru API相同"""
+        md5 = self.images.md5s[index]
+        directory = f"{md5[:2]}/{md5[2:4]}"
+        return {
+            "id": index + 1,
+            "created_at": "Sat May 20 00:00:00 -0500 2023",
+            "score": index % 100,
+            "width": 1024 + index % 7 * 128,
+            "height": 1024 + index % 5 * 128,
+            "md5": md5,
+            "directory": directory,
+            "image": f"{md5}.jpg",
+            "rating": "general",
+            "source": "",
+            "change": 1684558800,
+            "owner": "danbooru",
+            "creator_id": 6498,
+            "parent_id": 0,
+            "sample": 0,
+            "preview_height": 250,
+            "preview_width": 250,
+            "tags": self.images.tags[index],
+            "title": "",
+            "has_notes": "false",
+            "has_comments": "false",
+            "file_url": f"{self.base_url}/images/{directory}/{md5}.jpg",
+            "preview_url": f"{self.base_url}/thumbnails/{directory}/thumbnail_{md5}.jpg",
+            "sample_url": "",
+            "sample_height": 0,
+            "sample_width": 0,
+            "status": "active",
+            "post_locked": 0,
+            "has_children": "false",
+        }
+
+    def api_json(self, limit: int, pid: int) -> Dict[str, Any]:
+        """第 `pid` 页的API结果，没有post时与Gelbooru一样不包含 `post`"""
+        limit = max(1, min(limit, 100))
+        offset = pid * limit
+        data: Dict[str, Any] = {
+            "@attributes": {"limit": limit, "offset": offset, "count": len(self.images)}
+        }
+        indexes = range(offset, min(offset + limit, len(self.images)))
+        if indexes:
+            data["post"] = [self.post(index) for index in indexes]
+        return data
+
+    async def respond(self, method: str, target: str) -> MockResponse:
+        """处理一个请求
+
+        Args:
+            method: HTTP方法
+            target: 请求的路径和查询字符串
+        """
+        self.requests += 1
+        url = urlsplit(target)
+        if method != "GET":
+            return MockResponse(405, "text/plain", b"")
+        if url.path == "/index.php":
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            await asyncio.sleep(self.api_latency)
+            data = self.api_json(int(query.get("limit", 100)), int(query.get("pid", 0)))
+            return MockResponse(200, "application/json", json.dumps(data).encode())
+        if url.path.startswith("/images/"):
+            index = self.images.find(url.path.rsplit("/", 1)[-1].split(".", 1)[0])
+            if index is not None:
+                return await self._image_response(index)
+        return MockResponse(404, "text/plain", b"")
+
+    async def _image_response(self, index: int) -> MockResponse:
+        faults = self.faults
+        latency = self.latency
+        if faults is not None and faults.jitter:
+            latency += self._rng.uniform(0, faults.jitter)
+        await asyncio.sleep(latency)
+
+        content = self.images.content(index)
+        if faults is None or index in self._requested:
+            return MockResponse(200, "image/jpeg", content)
+        self._requested.add(index)
+
+        # 错误状态码按第一次请求的顺序成批出现
+        nth = len(self._requested) - 1
+        if faults.burst_every and nth % faults.burst_every < faults.burst_length:
+            statuses = faults.burst_statuses
+            status = statuses[nth // faults.burst_every % len(statuses)]
+            self.injected[index] = f"http_{status}"
+            return MockResponse(status, "text/plain", b"")
+
+        kind = self._planned.get(index)
+        if kind is None:
+            return MockResponse(200, "image/jpeg", content)
+        self.injected[index] = kind
+        if kind == "trickle":
+            return MockResponse(
+                200, "image/jpeg", content, chunk_delay=faults.trickle_delay
+            )
+        if kind == "wrong_md5":
+            content = content[:-1] + bytes([content[-1] ^ 0xFF])
+            return MockResponse(200, "image/jpeg", content)
+        return MockResponse(
+            200, "image/jpeg", content, cut_at=len(content) // 2, reset=kind == "reset"
+        )
+
+    @staticmethod
+    async def _stream(
+        response: MockResponse, read_timeout: Optional[float]
+    ) -> AsyncIterator[bytes]:
+        for chunk in response.chunks():
+            if response.chunk_delay:
+                # 没有真实的网络连接，需要自己模拟读取超时
+                if read_timeout is not None and response.chunk_delay > read_timeout:
+                    await asyncio.sleep(read_timeout)
+                    raise httpx.ReadTimeout("timed out")
+                await asyncio.sleep(response.chunk_delay)
+            yield bytes(chunk)
+        if response.cut_at is not None:
+            if response.reset:
+                raise httpx.ReadError("[Errno 104] Connection reset by peer")
+            raise httpx.RemoteProtocolError(
+                "peer closed connection without sending complete message body"
+            )
+
+    async def _handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.respond(request.method, request.url.raw_path.decode())
+        return httpx.Response(
+            response.status,
+            headers={
+                "Content-Type": response.content_type,
+                "Content-Length": str(len(response.body)),
+            },
+            content=self._stream(
+                response, request.extensions.get("timeout", {}).get("read")
+            ),
+        )
+
+    def transport(self) -> httpx.MockTransport:
+        """不经过网络的 `httpx.AsyncClient` 传输层，图片链接应为 `TRANSPORT_BASE_URL`"""
+        return httpx.MockTransport(self._handle_request)
+
+
+class MockServer:
+    """在本地端口上提供 `MockGelbooru` 的最小HTTP/1.1服务器，支持keep-alive
+
+    用法:
+        ```python
+        async with MockServer(app) as server:
+            print(server.api_url)
+        ```
+    """
+
+    def __init__(self, app: MockGelbooru, port: int = 0, host: str = MOCK_HOST):
+        """模拟服务器
+
+        Args:
+            app: 处理请求的 `MockGelbooru`
+            port: 监听端口，0则由系统分配. Defaults to 0.
+            host: 监听地址. Defaults to MOCK_HOST.
+        """
+        self.app = app
+        self.port = port
+        self.host = host
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:  # noqa: D102
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self) -> str:
+        """用于 `GetAPI` 的 `base_url`"""
+        return self.app.api_url
+
+    async def start(self) -> None:
+        """开始监听，`port` 为0时会被更新为实际的端口"""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.app.base_url = self.base_url
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                while line := (await reader.readline()).strip():
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "connection":
+                        keep_alive = value.strip().lower() != "close"
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                response = await self.app.respond(method, target)
+                if not await self._send(writer, response, keep_alive) or not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send(
+        self, writer: asyncio.StreamWriter, response: MockResponse, keep_alive: bool
+    ) -> bool:
+        """发送响应，返回连接是否还能继续使用"""
+        writer.write(
+            f"HTTP/1.1 {response.status} Mock\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+        )
+        for chunk in response.chunks():
+            if response.chunk_delay:
+                await asyncio.sleep(response.chunk_delay)
+            writer.write(chunk)
+            await writer.drain()
+        await writer.drain()
+        if response.cut_at is None:
+            return True
+        if response.reset:
+            # SO_LINGER为0时关闭连接会发送RST而不是FIN
+            sock = writer.get_extra_info("socket")
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+            writer.transport.abort()
+        return False
+
+    async def close(self) -> None:
+        """停止监听"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> "MockServer":  # noqa: D105
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:  # noqa: D105
+        await self.close()
+
+
+async def _serve_forever(
+    options: Dict[str, Any], conn: Optional[Any] = None, port: int = 0
+) -> None:
+    server_options = {
+        key: options.pop(key)
+        for key in ("latency", "api_latency", "faults")
+        if key in options
+    }
+    app = MockGelbooru(SyntheticImages(**options), **server_options)
+    async with MockServer(app, port) as server:
+        if conn is None:
+            print(f"模拟Gelbooru API: {server.api_url}")
+        else:
+            conn.send(server.base_url)
+        await asyncio.Event().wait()
+
+
+def _run_server(options: Dict[str, Any], conn: Any) -> None:
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(_serve_forever(options, conn))
+
+
+@contextlib.contextmanager
+def serve_in_process(**options: Union[int, float, Faults]) -> Iterator[str]:
+    """在子进程中运行 `MockServer`，避免服务器与被测的客户端争抢同一个事件循环
+
+    Args:
+        options: `SyntheticImages` 的参数，以及 `MockGelbooru` 的 `latency`、`api_latency` 和 `faults`
+
+    Yields:
+        服务器地址，API地址为 `<地址>/index.php`
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_run_server, args=(dict(options), child_conn), daemon=True
+    )
+    process.start()
+    try:
+        # 生成图片和计算md5需要一些时间
+        if not parent_conn.poll(600):
+            raise TimeoutError("模拟服务器启动超时")
+        yield parent_conn.recv()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--images", type=int, default=1000, help="图片数")
+    parser.add_argument("--image_kb", type=float, default=256, help="图片平均大小(KB)")
+    parser.add_argument(
+        "--size_jitter", type=float, default=0.0, help="图片大小浮动比例"
+    )
+    parser.add_argument("--latency", type=float, default=0, help="图片响应延迟(ms)")
+    parser.add_argument("--api_latency", type=float, default=0, help="API响应延迟(ms)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--jitter", type=float, default=0, help="额外的随机延迟上限(ms)"
+    )
+    for kind in FAULT_KINDS:
+        parser.add_argument(
+            f"--{kind}", type=float, default=0, help="出现此故障的图片比例"
+        )
+    parser.add_argument(
+        "--trickle_delay", type=float, default=50, help="慢速传输每4KB的间隔(ms)"
+    )
+    parser.add_argument(
+        "--burst_every", type=int, default=0, help="每多少个图片请求出现一批429/503"
+    )
+    parser.add_argument(
+        "--burst_length", type=int, default=0, help="每批429/503的请求数"
+    )
+    args = parser.parse_args()
+
+    options: Dict[str, Any] = {
+        "count": args.images,
+        "size": int(args.image_kb * 1024),
+        "size_jitter": args.size_jitter,
+        "seed": args.seed,
+        "latency": args.latency / 1000,
+        "api_latency": args.api_latency / 1000,
+        "faults": Faults(
+            jitter=args.jitter / 1000,
+            trickle=args.trickle,
+            trickle_delay=args.trickle_delay / 1000,
+            reset=args.reset,
+            truncate=args.truncate,
+            wrong_md5=args.wrong_md5,
+            burst_every=args.burst_every,
+            burst_length=args.burst_length,
+            seed=args.seed,
+        ),
+    }
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(_serve_forever(options, port=args.port))
+
+
+if __name__ == "__main__":
+    main()
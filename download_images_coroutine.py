@@ -3,17 +3,37 @@
 @author: WSH
 """
 
-import argparse
 import asyncio
+import concurrent.futures
+import contextlib
+import functools
 import hashlib
 import logging
 import math
+import multiprocessing
 import os
+import sys
 import time
 from asyncio import Task
-from collections import deque
 from enum import IntEnum
-from typing import Any, Dict, List, Literal, NamedTuple, Optional, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 from urllib.parse import urlencode
 
 import aiofiles
@@ -23,7 +43,34 @@ from pydantic import BaseModel, ConfigDict, Field
 from tqdm import tqdm
 from typing_extensions import Annotated
 
-from utils.check_images import check_images
+from utils._tools import scan_img_files
+from utils.buckets import BUCKET_INDEX_FILE_NAME, BucketConfig, BucketIndex
+from utils.captions import (
+    CaptionSink,
+    TxtCaptionSink,
+    make_caption_sink,
+)
+from utils.executors import (
+    current_event_loop,
+    hash_executor,
+    run,
+    use_file_io_executor,
+)
+from utils.hosts import HostSelector
+from utils.job_queue import JobInfo, UnitState, WorkQueue, default_worker_id
+from utils.journal import DownloadJournal, JournalJob
+from utils.metrics import DownloadMetrics, MetricsServer
+from utils.pipeline import ExecutorStage
+from utils.postprocess import ConvertedIndex, ConvertOptions, convert_image
+from utils.tag_processor import TagProcessor
+from utils.throughput import ThroughputMeter, TransferStats
+from utils.trace import DownloadTrace, TraceSink, trace_phase
+
+if TYPE_CHECKING:
+    # 需要numpy，只在启用近似重复过滤或tag统计时导入
+    from utils.near_duplicates import NearDuplicateFilter
+    from utils.profiling import Profiler
+    from utils.tag_stats import TagMatrixBuilder
 
 __all__ = (
     "BASE_URL",
@@ -32,8 +79,14 @@ __all__ = (
     "DownloadResultState",
     "Downloader",
     "GetAPI",
+    "StreamedImage",
+    "coordinate_job",
     "launch_executor",
+    "profile_download",
+    "refresh_tags",
+    "run_job_worker",
     "scrape_images",
+    "stream_images",
 )
 
 
@@ -51,7 +104,12 @@ SHOW_URL_PARAMS = {
     "q": "index",
 }
 
+_T = TypeVar("_T")
+
 WAITING_TIME_BEFORE_DOWNLOADING = 3  # 下载前等待时间(s)
+PROGRESS_REFRESH_INTERVAL = 0.5  # 进度条中速度等信息的刷新间隔(s)
+STREAM_API_ATTEMPTS = 3  # stream_images 查询一页API的最大尝试次数
+STREAM_API_RETRY_DELAY = 1  # stream_images 重新查询API前的等待时间(s)，每次翻倍
 
 
 ##############################
@@ -87,6 +145,8 @@ class DownloadResult(NamedTuple):
     """下载的图片的tag字符串"""
     md5: Optional[str] = None
     """下载的文件的md5值"""
+    verified: Optional[bool] = None
+    """下载后的图片是否通过了解码校验，`None` 表示没有校验"""
 
     def __eq__(self, other: object):
         """为了向前兼容，方便用 DownloadResult() == 1 等判断下载结果"""
@@ -104,7 +164,8 @@ start_time={self.start_time}, \
 end_time={self.end_time}, \
 size={self.size}, \
 tags={self.tags}, \
-md5={self.md5})"
+md5={self.md5}, \
+verified={self.verified})"
 
     def __repr__(self):  # noqa: D105
         return self.__str__()
@@ -113,11 +174,13 @@ md5={self.md5})"
 ### 下载类 Downloader ###
 
 
-async def _get_response_to_file(
+async def _get_response_to_file(  # noqa: C901
     file_path: str,
     file_url: str,
     async_client: httpx.AsyncClient,
     timeout: Optional[Union[int, float]] = None,
+    transfer_stats: Optional[TransferStats] = None,
+    trace: Optional[DownloadTrace] = None,
 ) -> Literal[0, 1]:
     """异步、流式地连接中地连接 `file_url` ，将回应内容写入到 `file_path`.
 
@@ -126,56 +189,109 @@ async def _get_response_to_file(
         file_url: 文件url链接
         async_client: 用于连接的 `httpx.AsyncClient`
         timeout: get请求超时限制，`None` 则不限时. Defaults to None.
+        transfer_stats: 用于统计传输状态，每接收一个数据块更新一次. Defaults to None.
+        trace: 用于记录首字节时间、传输和写入耗时的追踪记录. Defaults to None.
 
     Returns:
         成功下载返回1， 出现异常返回0
     """
+    stream_bytes = 0
+    if transfer_stats is not None:
+        transfer_stats.stream_started()
     try:
+        if trace is not None:
+            trace.begin("ttfb")
         # 进行连接
         async with async_client.stream("GET", file_url, timeout=timeout) as r:
+            if trace is not None:
+                trace.end("ttfb")
+                trace.status = r.status_code
             # 检查是否是200成功访问,不是就引发异常
             r.raise_for_status()
 
-            async with aiofiles.open(file_path, "wb") as f:
-                async for chunk in r.aiter_bytes():
-                    if chunk:
-                        await f.write(chunk)
+            with trace_phase(trace, "transfer"):
+                async with aiofiles.open(file_path, "wb") as f:
+                    async for chunk in r.aiter_bytes():
+                        if chunk:
+                            if transfer_stats is not None:
+                                stream_bytes += len(chunk)
+                                transfer_stats.received(len(chunk))
+                            if trace is None:
+                                await f.write(chunk)
+                            else:
+                                trace.bytes += len(chunk)
+                                write_start = time.perf_counter()
+                                await f.write(chunk)
+                                trace.disk_write += time.perf_counter() - write_start
         return 1
 
     except Exception as e:
         logging.error(f"下载 {file_url} 时发生错误, error: {e}")
+        if trace is not None:
+            trace.error = str(e)
         return 0
 
+    finally:
+        if transfer_stats is not None:
+            transfer_stats.stream_finished(stream_bytes)
 
-async def _tags2txt(tags: str, txt_path: str) -> Literal[0, 1]:
-    """异步地将 `tags` 的内容写入 `txt_path`
 
-    Args:
-        tags: 字符串内容
-        txt_path: 写入路径
+async def _get_response_content(
+    file_url: str,
+    async_client: httpx.AsyncClient,
+    timeout: Optional[Union[int, float]] = None,
+    transfer_stats: Optional[TransferStats] = None,
+    trace: Optional[DownloadTrace] = None,
+) -> Optional[bytes]:
+    """与 `_get_response_to_file` 相同，但把回应内容读入内存而不写入文件
 
     Returns:
-        成功返回1， 异常返回0
+        成功下载返回回应内容， 出现异常返回None
     """
+    stream_bytes = 0
+    if transfer_stats is not None:
+        transfer_stats.stream_started()
     try:
-        async with aiofiles.open(txt_path, "w") as f:
-            await f.write(tags)
-        return 1
+        if trace is not None:
+            trace.begin("ttfb")
+        async with async_client.stream("GET", file_url, timeout=timeout) as r:
+            if trace is not None:
+                trace.end("ttfb")
+                trace.status = r.status_code
+            r.raise_for_status()
+
+            chunks: List[bytes] = []
+            with trace_phase(trace, "transfer"):
+                async for chunk in r.aiter_bytes():
+                    chunks.append(chunk)
+                    stream_bytes += len(chunk)
+                    if transfer_stats is not None:
+                        transfer_stats.received(len(chunk))
+            if trace is not None:
+                trace.bytes += stream_bytes
+        return b"".join(chunks)
 
     except Exception as e:
-        logging.error(f"将tags写入 {txt_path} 时发生错误, error: {e}")
-        return 0
+        logging.error(f"下载 {file_url} 时发生错误, error: {e}")
+        if trace is not None:
+            trace.error = str(e)
+        return None
+
+    finally:
+        if transfer_stats is not None:
+            transfer_stats.stream_finished(stream_bytes)
 
 
 def _check_download_state(
     task_result_list: List[Union[BaseException, Literal[0, 1]]],
+    is_duplicate: bool,
 ) -> DownloadResultState:
     # 如果结果不都为1，即返回了0或者异常。 就返回0
     if [result for result in task_result_list if result != 1]:
         return DownloadResultState.ERROR
 
-    # 如果只有一个任务，说明存在重复文件而没下载图片。返回2
-    if len(task_result_list) == 1:
+    # 如果存在重复文件而没下载图片。返回2
+    if is_duplicate:
         return DownloadResultState.DUPLICATE
 
     # 上述两种情况都没发生，说明正常下载了图片和tags。 返回1
@@ -190,6 +306,19 @@ class Downloader:
         timeout: Optional[Union[int, float]],
         semaphore: Optional[asyncio.Semaphore],
         async_client: httpx.AsyncClient,
+        caption_sink: Optional[CaptionSink] = None,
+        verify_stage: Optional[ExecutorStage] = None,
+        verify_retries: int = 0,
+        verify_fast: bool = False,
+        convert_stage: Optional[ExecutorStage] = None,
+        convert_options: Optional[ConvertOptions] = None,
+        converted_index: Optional[ConvertedIndex] = None,
+        near_duplicate_filter: Optional["NearDuplicateFilter"] = None,
+        transfer_stats: Optional[TransferStats] = None,
+        trace_sink: Optional[TraceSink] = None,
+        metrics: Optional[DownloadMetrics] = None,
+        hash_executor: Optional[concurrent.futures.Executor] = None,
+        host_selector: Optional[HostSelector] = None,
     ):
         """下载器
 
@@ -197,33 +326,79 @@ class Downloader:
             timeout: 超时限制，单位为秒
             semaphore: 用于控制并发数的信号量
             async_client: 用于发送下载请求的 `httpx.AsyncClient`
+            caption_sink: 用于写入tags的caption写入器，`None` 则为每张图片写一个同名 `.txt` 文件.
+                Defaults to None.
+            verify_stage: 用于校验新下载图片的流水线阶段(通常是进程池)，`None` 则不校验.
+                校验在释放 `semaphore` 之后进行，不会阻塞其他下载. Defaults to None.
+            verify_retries: 校验失败时重新下载的最大次数. Defaults to 0.
+            verify_fast: 是否只检查图片的容器结构，结构可疑时才完整解码. Defaults to False.
+            convert_stage: 用于缩放和转换新下载图片的流水线阶段(通常是进程池). Defaults to None.
+            convert_options: 缩放和转换的参数，与 `convert_stage` 同时提供时才会进行转换.
+                Defaults to None.
+            converted_index: 转换记录，用于识别已经原地缩放过的图片，`None` 则这些图片会被重新下载.
+                Defaults to None.
+            near_duplicate_filter: 用于过滤近似重复图片的感知哈希过滤器，`None` 则不过滤.
+                Defaults to None.
+            transfer_stats: 用于统计传输速度、传输中的字节数和连接数，`None` 则不统计.
+                Defaults to None.
+            trace_sink: 用于输出每张图片各阶段耗时的追踪记录写入器，`None` 则不记录.
+                Defaults to None.
+            metrics: 用于更新完成数、等待信号量的下载数、重新下载次数和md5检查耗时等指标，
+                `None` 则不更新. Defaults to None.
+            hash_executor: 计算已有文件md5的执行器，`None` 则使用事件循环的默认执行器.
+                Defaults to None.
+            host_selector: 在等价的图片服务器之间选择的选择器，失败时会换用其他镜像，
+                `None` 则总是使用原链接. Defaults to None.
         """
         self.timeout = timeout
         self.semaphore = semaphore
         self.async_client = async_client
+        self.caption_sink = (
+            caption_sink if caption_sink is not None else TxtCaptionSink()
+        )
+        self.verify_stage = verify_stage
+        self.verify_retries = verify_retries
+        self.verify_fast = verify_fast
+        self.convert_stage = convert_stage
+        self.convert_options = convert_options if convert_stage is not None else None
+        self.converted_index = converted_index
+        self.near_duplicate_filter = near_duplicate_filter
+        self.transfer_stats = transfer_stats
+        self.trace_sink = trace_sink
+        self.metrics = metrics
+        self.hash_executor = hash_executor
+        self.host_selector = host_selector
+
+    @staticmethod
+    def _file_md5(file_path: str) -> str:
+        md5_hash = hashlib.md5()
+        with open(file_path, "rb") as f:
+            while chunk := f.read(128 * 1024):  # 128kb
+                md5_hash.update(chunk)
+        return md5_hash.hexdigest()
 
     @staticmethod
-    async def cul_md5(file_path: str):
+    async def cul_md5(
+        file_path: str, executor: Optional[concurrent.futures.Executor] = None
+    ):
         """计算文件的 MD5 哈希值
 
         file_path为需要计算的文件路径
 
+        读取和计算都在 `executor` 的同一个线程中完成，每个文件只需要交接一次，
+        `executor` 为 `None` 则使用事件循环的默认执行器
+
         只有成功计算了哈希值才返回，否则就返回None
         """
         try:
-            async with aiofiles.open(file_path, "rb") as f:
-                md5_hash = hashlib.md5()
-                while True:
-                    chunk = await f.read(128 * 1024)  # 128kb
-                    if not chunk:
-                        break
-                    await asyncio.to_thread(md5_hash.update, chunk)
-            return md5_hash.hexdigest()
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, Downloader._file_md5, file_path
+            )
         except Exception as e:
             logging.error(f"检验 {file_path} md5时发生错误 error: {e}")
             return None
 
-    async def download(  # noqa: C901, PLR0912
+    async def download(
         self,
         download_dir: str,
         file_url: str,
@@ -233,7 +408,21 @@ class Downloader:
     ) -> DownloadResult:
         """下载文件和将tags写入文本.
 
-        Note: 无论是否有重复有文件，tags都会被重写一次
+        Note: 无论是否有重复有文件，tags都会交给 `caption_sink` 写入一次，
+            内容未改变的tags不会被重写
+
+        如果设置了 `verify_stage`，新下载的图片会被解码校验，
+        校验失败时最多重新下载 `verify_retries` 次，仍然失败则结果为 `DownloadResultState.ERROR`.
+
+        如果设置了 `convert_stage` 和 `convert_options`，成功下载(并通过校验)的图片会被缩放和转换，
+        结果中的 `path` 为转换后的路径. 转换失败时保留原图，只记录错误.
+        转换为其他格式时，已经存在的转换结果视为重复文件，由于转换后md5已经改变，此时不再进行md5校验；
+        原地缩放时，`converted_index` 记录的转换结果未被改变也视为重复文件，否则仍然进行md5校验.
+
+        如果设置了 `near_duplicate_filter`，与已有图片近似重复的新图片会在转换之前被删除，
+        其caption也会被移除，结果为 `DownloadResultState.DUPLICATE`.
+
+        如果设置了 `trace_sink`，每次调用都会输出一条记录各阶段耗时的追踪记录.
 
         Args:
             download_dir: 下载地址，这个必须是已经存在的路径.
@@ -243,15 +432,294 @@ class Downloader:
             md5: 文件的md5字符串，`None`则不进行重复哈希校验 . Defaults to None.
 
         Raises:
-            Exception: _description_
+            Exception: 创建下载任务时发生错误
 
         Returns:
             返回一个DownloadResult对象，记录下载结果
         """
+        trace = DownloadTrace(file_url, md5) if self.trace_sink is not None else None
+        download_result = None
+        try:
+            download_result = await self._download(
+                download_dir,
+                file_url,
+                file_name=file_name,
+                tags=tags,
+                md5=md5,
+                trace=trace,
+            )
+
+            if (
+                self.verify_stage is not None
+                and download_result.state is DownloadResultState.SUCCESS
+            ):
+                with trace_phase(trace, "verify"):
+                    download_result = await self._verify(
+                        download_result,
+                        download_dir,
+                        file_url,
+                        file_name=file_name,
+                        trace=trace,
+                    )
+
+            if (
+                self.near_duplicate_filter is not None
+                and download_result.state is DownloadResultState.SUCCESS
+            ):
+                with trace_phase(trace, "near_duplicate"):
+                    download_result = await self._filter_near_duplicate(download_result)
+
+            if (
+                self.convert_options is not None
+                and download_result.state is DownloadResultState.SUCCESS
+            ):
+                with trace_phase(trace, "convert"):
+                    download_result = await self._convert(download_result)
+
+            return download_result
+
+        finally:
+            if trace is not None or self.metrics is not None:
+                # 引发异常或被取消时也输出记录，状态视为失败
+                state = (
+                    download_result.state
+                    if download_result is not None
+                    else DownloadResultState.ERROR
+                )
+                if trace is not None:
+                    assert self.trace_sink is not None
+                    self.trace_sink.emit(trace.record(state.name))
+                if self.metrics is not None:
+                    self.metrics.completed(state.name)
+
+    async def fetch(
+        self,
+        file_url: str,
+        file_name: Optional[str] = None,
+        tags: Optional[str] = None,
+        md5: Optional[str] = None,
+    ) -> Tuple[DownloadResult, Optional[bytes]]:
+        """把文件下载到内存中，不写入磁盘，也不写入tags.
+
+        不进行重复检查、校验、近似重复过滤和转换，
+        但与 `download` 一样受 `semaphore` 限制，并更新 `transfer_stats`、`trace_sink` 和 `metrics`.
+
+        Args:
+            file_url: 文件链接url.
+            file_name: 文件名字，`None` 则使用下载连接的 `basename`. Defaults to None.
+            tags: tags字符串，只被记录在结果中. Defaults to None.
+            md5: 文件的md5字符串，只被记录在结果中. Defaults to None.
+
+        Returns:
+            tuple(DownloadResult, 文件内容)，下载失败时文件内容为None.
+            结果中的 `path` 为文件名，因为文件没有被写入磁盘.
+        """
+        if file_name is None:
+            file_name = os.path.basename(file_url)
+        trace = DownloadTrace(file_url, md5) if self.trace_sink is not None else None
+        state = DownloadResultState.ERROR
+        try:
+            if self.semaphore is not None:
+                if self.metrics is not None:
+                    self.metrics.semaphore_waiting += 1
+                try:
+                    with trace_phase(trace, "semaphore_wait"):
+                        await self.semaphore.acquire()
+                finally:
+                    if self.metrics is not None:
+                        self.metrics.semaphore_waiting -= 1
+            try:
+                start_time = time.time()
+                content = await self._request(
+                    file_url,
+                    lambda url, trace: _get_response_content(
+                        url,
+                        self.async_client,
+                        timeout=self.timeout,
+                        transfer_stats=self.transfer_stats,
+                        trace=trace,
+                    ),
+                    lambda content: content is not None,
+                    trace=trace,
+                )
+                end_time = time.time()
+            finally:
+                if self.semaphore is not None:
+                    self.semaphore.release()
+
+            if content is not None:
+                state = DownloadResultState.SUCCESS
+            download_result = DownloadResult(
+                state=state,
+                path=file_name,
+                start_time=start_time,
+                end_time=end_time,
+                size=len(content) if content is not None else 0,
+                tags=tags,
+                md5=md5,
+            )
+            return download_result, content
+
+        finally:
+            if trace is not None:
+                assert self.trace_sink is not None
+                self.trace_sink.emit(trace.record(state.name))
+            if self.metrics is not None:
+                self.metrics.completed(state.name)
+
+    async def _request(
+        self,
+        file_url: str,
+        send: Callable[[str, Optional[DownloadTrace]], Awaitable[_T]],
+        succeeded: Callable[[_T], bool],
+        trace: Optional[DownloadTrace] = None,
+    ) -> _T:
+        """用 `send(url, trace)` 请求 `file_url`，设置了 `host_selector` 时由其选择服务器
+
+        失败时依次换用 `host_selector.candidates` 中的下一个镜像，返回最后一次请求的结果.
+        换用镜像的次数记录在 `trace.failovers` 中.
+        """
+        host_selector = self.host_selector
+        if host_selector is None:
+            return await send(file_url, trace)
+
+        for attempt, url in enumerate(host_selector.candidates(file_url)):
+            if attempt > 0 and trace is not None:
+                trace.failovers += 1
+            # 需要首字节时间，没有追踪记录时也创建一个
+            attempt_trace = trace if trace is not None else DownloadTrace(url)
+            result = await send(url, attempt_trace)
+            ok = succeeded(result)
+            ttfb = attempt_trace.phases.get("ttfb")
+            host_selector.record(
+                url, ok, ttfb[1] - ttfb[0] if ok and ttfb is not None else None
+            )
+            if ok:
+                # 之前失败的镜像留下的错误不属于这次成功的下载
+                attempt_trace.error = None
+                break
+        return result
+
+    async def _verify(
+        self,
+        download_result: DownloadResult,
+        download_dir: str,
+        file_url: str,
+        file_name: Optional[str] = None,
+        trace: Optional[DownloadTrace] = None,
+    ) -> DownloadResult:
+        """校验新下载的图片，失败时重新下载，参数见 `download`"""
+        # 需要Pillow，只在启用校验时导入
+        from utils.check_images import verify_image  # noqa: PLC0415
+
+        verify_stage = self.verify_stage
+        assert verify_stage is not None
+
+        for retry in range(self.verify_retries + 1):
+            error = await verify_stage.run(
+                verify_image, download_result.path, self.verify_fast
+            )
+            if error is None:
+                return download_result._replace(verified=True)
+
+            logging.error(f"{download_result.path} 校验失败, error: {error}")
+            if retry == self.verify_retries:
+                break
+
+            # 只重新下载图片，tags已经写入过了
+            if trace is not None:
+                trace.retries += 1
+            if self.metrics is not None:
+                self.metrics.retries += 1
+            retry_result = await self._download(
+                download_dir, file_url, file_name=file_name, trace=trace
+            )
+            download_result = retry_result._replace(
+                start_time=download_result.start_time,
+                tags=download_result.tags,
+                md5=download_result.md5,
+            )
+            if download_result.state is not DownloadResultState.SUCCESS:
+                return download_result
+
+        return download_result._replace(state=DownloadResultState.ERROR, verified=False)
+
+    async def _filter_near_duplicate(
+        self, download_result: DownloadResult
+    ) -> DownloadResult:
+        """删除与已有图片近似重复的新图片"""
+        near_duplicate_filter = self.near_duplicate_filter
+        assert near_duplicate_filter is not None
+
+        path = download_result.path
+        # 索引中记录的是转换后的文件名
+        result_path = (
+            self.convert_options.output_path(path)
+            if self.convert_options is not None
+            else path
+        )
+        match = await near_duplicate_filter.find(path, os.path.basename(result_path))
+        if match is None:
+            return download_result
+
+        name, distance = match
+        logging.info(f"{path} 与 {name} 近似重复(距离 {distance})，将被删除")
+        try:
+            await aiofiles.os.remove(path)
+            if download_result.tags is not None:
+                await self.caption_sink.remove(result_path)
+        except Exception as e:
+            logging.error(f"删除近似重复的 {path} 时发生错误, error: {e}")
+        return download_result._replace(state=DownloadResultState.DUPLICATE)
+
+    async def _convert(self, download_result: DownloadResult) -> DownloadResult:
+        """缩放和转换新下载的图片"""
+        convert_stage = self.convert_stage
+        assert convert_stage is not None
+
+        assert self.convert_options is not None
+        path, error = await convert_stage.run(
+            convert_image, download_result.path, self.convert_options
+        )
+        if error is None:
+            if (
+                self.converted_index is not None
+                and download_result.md5 is not None
+                and path == download_result.path
+            ):
+                try:
+                    await self.converted_index.add(download_result.md5, path)
+                except Exception as e:
+                    logging.error(f"记录 {path} 的转换结果时发生错误, error: {e}")
+        else:
+            logging.error(f"转换 {download_result.path} 时发生错误, error: {error}")
+            # 下载时tags已经按转换后的文件名写入，转换失败时改为对应保留下来的原图
+            result_path = self.convert_options.output_path(path)
+            if result_path != path and download_result.tags is not None:
+                await self.caption_sink.remove(result_path)
+                await self.caption_sink.write(path, download_result.tags)
+        return download_result._replace(path=path)
+
+    async def _download(  # noqa: C901, PLR0912, PLR0915
+        self,
+        download_dir: str,
+        file_url: str,
+        file_name: Optional[str] = None,
+        tags: Optional[str] = None,
+        md5: Optional[str] = None,
+        trace: Optional[DownloadTrace] = None,
+    ) -> DownloadResult:
+        """下载文件和将tags写入文本，不进行校验，参数见 `download`"""
         # 如果没提供文件名，就用url中的basename
         if file_name is None:
             file_name = os.path.basename(file_url)
         file_path = os.path.join(download_dir, file_name)
+        # 启用转换时，tags对应的是转换后的图片
+        result_path = (
+            self.convert_options.output_path(file_path)
+            if self.convert_options is not None
+            else file_path
+        )
 
         # 获取初始化参数
         timeout = self.timeout
@@ -261,36 +729,74 @@ class Downloader:
         # 如果提供了如果提供了md5，则尝试进行重复校验
         # 如果检查到已经存在的本地文件md5和提供一致，就不下载图片了
         is_duplicate = False
-        if md5 is not None:
+        # 转换为其他格式后文件md5已经改变，只要转换结果存在就视为重复；
+        # 只缩放时转换结果就是原文件，先查转换记录，否则比较md5，以免把中断时留下的不完整文件当作重复
+        check_exists = result_path != file_path
+        check_duplicate = check_exists or md5 is not None
+        if trace is not None and check_duplicate:
+            trace.begin("md5_check")
+        if check_exists:
+            try:
+                is_duplicate = await aiofiles.os.path.exists(result_path)
+            except Exception as e:
+                logging.error(f"检查 {result_path} 是否存在时发生错误。 error : {e}")
+        elif md5 is not None:
             try:
                 if (
-                    await aiofiles.os.path.exists(file_path)
-                    and await Downloader.cul_md5(file_path) == md5
+                    self.convert_options is not None
+                    and self.converted_index is not None
+                    and await self.converted_index.is_converted(md5, file_path)
                 ):
                     is_duplicate = True
+                elif await aiofiles.os.path.exists(file_path):
+                    hash_start = time.perf_counter()
+                    is_duplicate = (
+                        await Downloader.cul_md5(file_path, self.hash_executor) == md5
+                    )
+                    if self.metrics is not None:
+                        self.metrics.md5_check.observe(time.perf_counter() - hash_start)
             except Exception as e:
                 logging.error(f"校验md5时发生错误。 error : {e}")
+        if trace is not None and check_duplicate:
+            trace.end("md5_check")
+
         # 如果传入了semaphore，则根据其限制下载并发数
         if semaphore is not None:
-            await semaphore.acquire()
+            if self.metrics is not None:
+                self.metrics.semaphore_waiting += 1
+            try:
+                with trace_phase(trace, "semaphore_wait"):
+                    await semaphore.acquire()
+            finally:
+                if self.metrics is not None:
+                    self.metrics.semaphore_waiting -= 1
 
         try:
             task_list: List[Task[Literal[0, 1]]] = []
             # 如果不存在重复文件，准备创建下载任务
             if not is_duplicate:
                 file_task = asyncio.create_task(
-                    _get_response_to_file(
-                        file_path, file_url, async_client=async_client, timeout=timeout
+                    self._request(
+                        file_url,
+                        lambda url, trace: _get_response_to_file(
+                            file_path,
+                            url,
+                            async_client=async_client,
+                            timeout=timeout,
+                            transfer_stats=self.transfer_stats,
+                            trace=trace,
+                        ),
+                        lambda result: result == 1,
+                        trace=trace,
                     )
                 )
                 task_list.append(file_task)
 
             # 不管图片是否重复，只要提供了tasg输入参数，创建写入tag文件任务
             if tags is not None:
-                txt_path = os.path.join(
-                    download_dir, os.path.splitext(file_name)[0] + ".txt"
+                tags_task = asyncio.create_task(
+                    self.caption_sink.write(result_path, tags)
                 )
-                tags_task = asyncio.create_task(_tags2txt(tags, txt_path))
                 task_list.append(tags_task)
 
             # 同步等待任务完成
@@ -298,7 +804,7 @@ class Downloader:
             task_result_list = await asyncio.gather(*task_list, return_exceptions=True)
             wait_end = time.time()
 
-            state = _check_download_state(task_result_list)
+            state = _check_download_state(task_result_list, is_duplicate)
 
             # 如果存在重复文件，说明根本没下载，下载量自然为0
             if state is DownloadResultState.DUPLICATE:
@@ -313,7 +819,7 @@ class Downloader:
 
             download_result = DownloadResult(
                 state=state,
-                path=file_path,
+                path=result_path if is_duplicate else file_path,
                 start_time=wait_start,
                 end_time=wait_end,
                 size=size,
@@ -348,13 +854,16 @@ class _Post(BaseModel):
     file_url: str
     tags: str
     image: str
+    width: Optional[int] = None
+    height: Optional[int] = None
 
 
 class _GelbooruApiJson(BaseModel):
     """Gelbooru API返回的json格式"""
 
     attributes: Annotated[_Attributes, Field(alias="@attributes")]
-    post: List[_Post]
+    post: List[_Post] = []
+    """没有查询到图片时，Gelbooru返回的json中不包含 `post`"""
 
 
 def _get_api_post_data(response: httpx.Response) -> Optional[List[_Post]]:
@@ -380,6 +889,7 @@ class GetAPI:
         async_client: httpx.AsyncClient,
         base_url: str,
         base_url_params: Dict[str, Any],
+        metrics: Optional[DownloadMetrics] = None,
     ):
         """初始化GetAPI参数
 
@@ -387,18 +897,20 @@ class GetAPI:
             async_client: 用于连接的 `httpx.AsyncClient`
             base_url: 访问的域名
             base_url_params: 访问的API url参数
+            metrics: 用于记录API请求耗时和失败数的指标，`None` 则不记录. Defaults to None.
         """
         self.base_url = base_url
         self.base_url_params = base_url_params
         self.async_client = async_client
+        self.metrics = metrics
 
-    async def get_api(
+    async def query(
         self,
         tags: str,
         limit: int = 100,
         pid: int = 0,
-    ) -> Optional[List[_Post]]:
-        """根据tags获取gelbooru的API信息
+    ) -> List[_Post]:
+        """根据tags获取gelbooru的API信息，与 `get_api` 不同，查询失败时会引发异常
 
         Args:
             tags: 需要查询的tags
@@ -406,8 +918,10 @@ class GetAPI:
             pid: 查询的页数索引. Defaults to 0.
 
         Returns:
-            - 如果成功获取图片信息，就返回Api中所包含的post图片信息
-            - 如果不成功就返回None
+            Api中所包含的post图片信息，没有更多图片时为空列表
+
+        Raises:
+            Exception: 请求超时、响应状态码不是2xx或者响应不是有效的API json时
         """
         api_param: Dict[str, Any] = {
             "limit": limit,
@@ -419,94 +933,47 @@ class GetAPI:
         base_url = self.base_url
         base_url_params = self.base_url_params
         async_client = self.async_client
+        metrics = self.metrics
 
+        request_start = time.perf_counter()
         try:
             response = await async_client.get(
                 base_url, params=base_url_params | api_param
             )
-            return _get_api_post_data(response)
-        except Exception as e:
-            logging.error(f"{e}")
-            return None
-
-
-##############################
-# 计算下载速度，会被launch_executor使用
-class _DownloadSpeed:
-    """根据n个记录点和初始点，计算瞬时和平均下载速度"""
+            return _get_api_post_data(response) or []
+        except Exception:
+            if metrics is not None:
+                metrics.api_errors += 1
+            raise
+        finally:
+            if metrics is not None:
+                metrics.api_latency.observe(time.perf_counter() - request_start)
 
-    def __init__(
+    async def get_api(
         self,
-        n: int,
-        data_size_init: int = 0,
-        time_init: float = 0,
-    ):
-        """根据n个记录点和初始点，计算瞬时和平均下载速度
+        tags: str,
+        limit: int = 100,
+        pid: int = 0,
+    ) -> Optional[List[_Post]]:
+        """根据tags获取gelbooru的API信息
 
         Args:
-            n: 用于计算平均数的数据个数
-            data_size_init: 开始之前已有的下载量. Defaults to 0.
-            time_init: 开始时间戳. Defaults to 0.
-        """
-        self._n = n
-        self._data_size_init = data_size_init
-        self._time_init = time_init
-
-        # 注意，这里需要计算n个数据，并且需要一个初始点，所以需要n+1个数据
-        _data_n = self._n + 1
-        self._data = deque(
-            ((self._data_size_init, self._time_init) for i in range(_data_n)),
-            _data_n,
-        )
-        self._instant_speed = 0  # 初始瞬时速度为0
-        self._average_speed = 0  # 初始平均速度为0
-
-    def set_init(
-        self,
-        data_size_init: Optional[int] = None,
-        time_init: Optional[float] = None,
-    ) -> None:
-        """将数据状态重置为初始
-
-        如有需要，可以改变以下参数：
-        data_size_init为需要修改的开始之前下载量
-        time_init为需要修改的开始时间戳
-        """
-        # 调用__init__重新初始化
-        # 如果没有传入参数，就使用原来的参数
-        self.__init__(
-            n=self._n,
-            data_size_init=self._data_size_init
-            if data_size_init is None
-            else data_size_init,
-            time_init=self._time_init if time_init is None else time_init,
-        )
-
-    def update(self, data_size: int, time: float) -> None:
-        """更新数据
+            tags: 需要查询的tags
+            limit: 一次获取图片的最大限制. Defaults to 100.
+            pid: 查询的页数索引. Defaults to 0.
 
-        data_size为某个时间点对应的总下载数据的大小，speed将保持和这里输入一样的单位
-        time为data_size对应的时间点
+        Returns:
+            - 如果成功获取图片信息，就返回Api中所包含的post图片信息
+            - 如果不成功就返回None
         """
-        # 在头部插入新元素, 因为deque有长度限制，所以会自动顶出最后一个元素
-        self._data.appendleft((data_size, time))
-
-    def speed(self) -> Tuple[float, float]:
-        """根据n个记录点和初始点，计算瞬时和平均下载速度，返回每秒大小，单位为输入update的单位.
+        try:
+            return await self.query(tags, limit=limit, pid=pid) or None
+        except Exception as e:
+            logging.error(f"{e}")
+            return None
 
-        返回一个元组，第一个元素为瞬时速度，第二个元素为平均速度
-        """
-        data_size_list, time_list = zip(*self._data)
-        data_size_list = list(data_size_list)
-        time_list = list(time_list)
 
-        self._instant_speed = (max(data_size_list) - min(data_size_list)) / (
-            max(time_list) - min(time_list)
-        )
-        self._average_speed = (max(data_size_list) - self._data_size_init) / (
-            max(time_list) - self._time_init
-        )
-        return self._instant_speed, self._average_speed
+##############################
 
 
 def _byte_to_mb(byte: Union[int, float]) -> float:
@@ -516,12 +983,28 @@ def _byte_to_mb(byte: Union[int, float]) -> float:
 
 
 # 协程池调度器
-async def launch_executor(
+async def launch_executor(  # noqa: C901, PLR0915
     post_data: List[_Post],
     download_dir: str,
     max_workers: int,
     timeout: Optional[Union[int, float]],
     async_client: httpx.AsyncClient,
+    caption_sink: Optional[CaptionSink] = None,
+    verify_stage: Optional[ExecutorStage] = None,
+    verify_retries: int = 0,
+    verify_fast: bool = False,
+    convert_stage: Optional[ExecutorStage] = None,
+    convert_options: Optional[ConvertOptions] = None,
+    converted_index: Optional[ConvertedIndex] = None,
+    bucket_index: Optional[BucketIndex] = None,
+    near_duplicate_filter: Optional["NearDuplicateFilter"] = None,
+    on_result: Optional[Callable[[DownloadResult], None]] = None,
+    show_progress: bool = True,
+    transfer_stats: Optional[TransferStats] = None,
+    trace_sink: Optional[TraceSink] = None,
+    metrics: Optional[DownloadMetrics] = None,
+    hash_executor: Optional[concurrent.futures.Executor] = None,
+    host_selector: Optional[HostSelector] = None,
 ) -> "_DownloadInfoTuple":
     """并发下载，将 `post_data` 的每一份分给一个协程.
 
@@ -533,6 +1016,30 @@ async def launch_executor(
             注意这个实现是靠子函数 `download_file` 中的httpx库实现
             如果其中一个线程下载超时无响应，就会引发一个错误被捕获，并返回1
         async_client: 用于下载的`httpx.AsyncClient.
+        caption_sink: 用于写入tags的caption写入器，`None` 则为每张图片写一个同名 `.txt` 文件.
+            Defaults to None.
+        verify_stage: 用于在下载过程中校验新下载图片的流水线阶段，`None` 则不校验. Defaults to None.
+        verify_retries: 校验失败时重新下载的最大次数. Defaults to 0.
+        verify_fast: 是否只检查图片的容器结构，结构可疑时才完整解码. Defaults to False.
+        convert_stage: 用于在下载过程中缩放和转换新下载图片的流水线阶段，`None` 则不转换.
+            Defaults to None.
+        convert_options: 缩放和转换的参数. Defaults to None.
+        converted_index: 转换记录，用于识别已经原地缩放过的图片. Defaults to None.
+        bucket_index: 用于记录图片尺寸的分桶索引，尺寸来自API返回的宽高，`None` 则不记录.
+            Defaults to None.
+        near_duplicate_filter: 用于在下载过程中过滤近似重复图片的过滤器，`None` 则不过滤.
+            Defaults to None.
+        on_result: 每张图片下载完成时调用，传入其 `DownloadResult`. Defaults to None.
+        show_progress: 是否显示进度条和下载结果，由其他进程汇总显示时为False. Defaults to True.
+        transfer_stats: 用于统计传输速度的 `TransferStats`，多次调用时传入同一个可以统计整个下载过程，
+            `None` 则为本次调用新建一个. Defaults to None.
+        trace_sink: 用于输出每张图片各阶段耗时的追踪记录写入器，`None` 则不记录. Defaults to None.
+        metrics: 用于更新下载指标，字节数和传输中的下载数来自 `metrics.transfer_stats`，
+            所以应与 `transfer_stats` 是同一个. Defaults to None.
+        hash_executor: 计算已有文件md5的执行器，`None` 则使用事件循环的默认执行器.
+            Defaults to None.
+        host_selector: 在等价的图片服务器之间选择的选择器，`None` 则总是使用原链接.
+            Defaults to None.
 
     Raises:
         e: 任意一个下载任务发生错误时引发，为 `Exception`
@@ -540,24 +1047,56 @@ async def launch_executor(
     Returns:
         成功会返回一个元组，按顺序为：总下载任务、 成功下载数、 存在的重复数、 下载失败数
     """
+    stats = transfer_stats if transfer_stats is not None else TransferStats()
+
     # 实例化下载器
     downloader = Downloader(
         timeout=timeout,
         semaphore=asyncio.Semaphore(max_workers),
         async_client=async_client,
+        caption_sink=caption_sink,
+        verify_stage=verify_stage,
+        verify_retries=verify_retries,
+        verify_fast=verify_fast,
+        convert_stage=convert_stage,
+        convert_options=convert_options,
+        converted_index=converted_index,
+        near_duplicate_filter=near_duplicate_filter,
+        transfer_stats=stats,
+        trace_sink=trace_sink,
+        metrics=metrics,
+        hash_executor=hash_executor,
+        host_selector=host_selector,
     )
 
-    # 创建下载task
-    tasks_list: List[Task[DownloadResult]] = []
-    for post in post_data:
-        coroutine = downloader.download(
+    async def download_post(post: _Post) -> DownloadResult:
+        result = await downloader.download(
             download_dir,
             post.file_url,
             file_name=post.image,
             tags=post.tags,
             md5=post.md5,
         )
-        tasks_list.append(asyncio.create_task(coroutine))
+        # 不需要打开图片，直接用API返回的宽高分桶
+        if (
+            bucket_index is not None
+            and result.state is not DownloadResultState.ERROR
+            and await aiofiles.os.path.exists(result.path)
+            and post.width
+            and post.height
+        ):
+            size = (post.width, post.height)
+            if convert_options is not None:
+                size = convert_options.target_size(*size)
+            bucket_index.add(os.path.basename(result.path), *size)
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    # 创建下载task
+    tasks_list: List[Task[DownloadResult]] = [
+        asyncio.create_task(download_post(post)) for post in post_data
+    ]
 
     # 用于统计下载计数
     all_download_number = len(post_data)
@@ -565,19 +1104,21 @@ async def launch_executor(
     duplicate_download_number = 0
     error_download_number = 0
 
-    # 用于统计下载速度，其采用平均算法，因为有max_workers个并发，所以需要对max_workers个数据取平均
-    download_speed = _DownloadSpeed(max_workers)
+    download_pbar = tqdm(total=all_download_number, disable=not show_progress)
 
-    try:
-        # 注意，这个time_init是第一个任务开始时候的时间戳，所以这个set_init应该传入开始瞬间的time.time()
-        download_speed.set_init(time_init=time.time())
+    async def refresh_progress() -> None:
+        # 速度等信息由定时任务更新，完成任务时只增加计数，所以完成再多的任务也几乎没有开销；
+        # 没有任务完成时，也能看到大文件的传输进度
+        while True:
+            download_pbar.set_description_str(stats.describe(), refresh=False)
+            download_pbar.refresh()
+            await asyncio.sleep(PROGRESS_REFRESH_INTERVAL)
+
+    refresh_task = asyncio.create_task(refresh_progress()) if show_progress else None
 
+    try:
         # 等待结果
-        download_pbar = tqdm(
-            asyncio.as_completed(tasks_list), total=all_download_number
-        )
-        total_download_size = 0
-        for task in download_pbar:
+        for task in asyncio.as_completed(tasks_list):
             try:
                 res = (
                     await task
@@ -594,27 +1135,15 @@ async def launch_executor(
                 else:
                     error_download_number += 1
                     logging.error(f"任务 {task} 返回状态异常, result: {res}")
-
-                # 更新下载速度
-                total_download_size += res.size  # 总下载量
-                download_speed.update(
-                    total_download_size, res.end_time
-                )  # 每个时间点对应的累计下载量
-                instant_speed, average_speed = (
-                    download_speed.speed()
-                )  # 计算瞬时和平均下载速度
-
-                # 转为MB单位
-                instant_speed_mb = _byte_to_mb(instant_speed)
-                average_speed_mb = _byte_to_mb(average_speed)
-                total_download_size_mb = _byte_to_mb(total_download_size)
-
-                download_pbar.set_description(
-                    f"当前: {instant_speed_mb:.2f}MB/s，平均: {average_speed_mb:.2f}MB/s，总量: {total_download_size_mb:.2f}MB"
-                )
             except Exception as e:
                 error_download_number += 1
                 logging.error(f"任务 {task} 返回状态异常, error: {e}")
+            download_pbar.update()
+
+        if refresh_task is not None:
+            refresh_task.cancel()
+        download_pbar.set_description_str(stats.describe())
+        download_pbar.close()
 
         # 统计下载信息
         download_info = _DownloadInfoTuple(
@@ -624,11 +1153,12 @@ async def launch_executor(
             error_download_number,
         )
 
-        tqdm.write("下载完成")
-        tqdm.write(f"下载任务： {download_info.all} 个")
-        tqdm.write(f"成功完成： {download_info.success} 个")
-        tqdm.write(f"存在重复： {download_info.duplicate} 个")
-        tqdm.write(f"下载失败： {download_info.error} 个")
+        if show_progress:
+            tqdm.write("下载完成")
+            tqdm.write(f"下载任务： {download_info.all} 个")
+            tqdm.write(f"成功完成： {download_info.success} 个")
+            tqdm.write(f"存在重复： {download_info.duplicate} 个")
+            tqdm.write(f"下载失败： {download_info.error} 个")
 
         return download_info
 
@@ -639,6 +1169,11 @@ async def launch_executor(
             task.cancel()
         raise
 
+    finally:
+        if refresh_task is not None:
+            refresh_task.cancel()
+        download_pbar.close()
+
 
 ##############################
 
@@ -678,148 +1213,1166 @@ class _DownloadInfoCounter:
         print(f"下载失败： {self.error} 个")
 
 
+@functools.cache
+def _default_tag_processor(
+    add_comma: bool,
+    remove_underscore: bool,
+    use_escape: bool,
+) -> TagProcessor:
+    return TagProcessor(
+        add_comma=add_comma,
+        remove_underscore=remove_underscore,
+        use_escape=use_escape,
+        deduplicate=False,
+    )
+
+
 def _process_tags(
     tags: str,
     add_comma: bool,
     remove_underscore: bool,
     use_escape: bool,
 ) -> str:
-    """处理tags字符串，返回处理后的字符串"""
-    tag_list = tags.split(" ")
-    # 忽略emoji，将_替换为空格
-    if remove_underscore:
-        for i, tag in enumerate(tag_list):
-            if len(tag) > 3:  # ignore emoji tags like >_< and ^_^
-                tag_list[i] = tag.replace("_", " ")
-    # 转义正则表达式特殊字符
-    if use_escape:
-        for i, tag in enumerate(tag_list):
-            if len(tag) > 3:  # ignore emoji tags like >_< and ^_^
-                tag_list[i] = tag.replace("(", "\\(").replace(")", "\\)")
-    # 添加', '分割或者' '分割
-    final_tags = ", ".join(tag_list) if add_comma else " ".join(tag_list)
-    return final_tags
+    """处理tags字符串，返回处理后的字符串
+
+    Note: 为了向前兼容而保留，新代码请直接使用 `TagProcessor`
+    """
+    return _default_tag_processor(add_comma, remove_underscore, use_escape)(tags)
 
 
-# 顶层封装
-async def scrape_images(
+async def _query_download_count(
+    async_client: httpx.AsyncClient,
     tags: str,
     max_images_number: int,
-    download_dir: str,
-    max_workers: int = 10,
-    unit: int = 100,
-    timeout: Optional[Union[int, float]] = 10,
-    add_comma: bool = True,
-    remove_underscore: bool = True,
-    use_escape: bool = True,
-    check_images_mode: Union[None, int] = None,
-) -> None:
-    r"""从gelbooru抓取图片，图片数量为max_images_number以unit为单位向上取.
+    unit: int,
+    base_url: str = BASE_URL,
+) -> Tuple[int, int, int]:
+    """查询 `tags` 的图片总数，并计算每页图片数和需要访问的页数.
 
     Args:
-        tags: 用于在gelbooru中搜索图片的tag，浏览以下链接获取更多信息.
-            - [tags](https://gelbooru.com/index.php?page=wiki&s=&s=view&id=25921)
-            - [cheatsheet](https://gelbooru.com/index.php?page=wiki&s=&s=view&id=26263)
-        max_images_number: 要抓取的图片数量.
-        download_dir: 下载目录.
-        max_workers: 下载并发数. Defaults to 10.
-        unit: 下载量单位，最小为1，最大为100. Defaults to 100.
-        timeout: 单个图片下载超时限制，单位为秒. Defaults to 10.
-        add_comma: 是否在`与图片一起被抓取的tag字符串`中添加逗号分割. Defaults to True.
-        remove_underscore: 是否将`与图片一起被抓取的tag字符串`中的下划线换成空格. Defaults to True.
-        use_escape: 是否对`与图片一起被抓取的tag字符串`中的成空格进行转义. Defaults to True.
-            即 `()` -> `\(` 和 `)` -> `\)`.
-        check_images_mode: 是否在下载结束后检查图片是否正确. Defaults to None.
-            - None: 不检查
-            - 0: 检查，但只输出信息不做任何操作
-            - 1: 尝试修复图片
-            - 2: 尝试删除图片
+        async_client: 用于连接的 `httpx.AsyncClient`
+        tags: 需要查询的tags
+        max_images_number: 要抓取的图片数量
+        unit: 下载量单位，最小为1，最大为100
+        base_url: API地址. Defaults to BASE_URL.
+
+    Raises:
+        AssertionError: 无法获取正确的json格式
 
     Returns:
-        None
+        tuple(图片总数, 每页图片数, 需要访问的页数)
     """
-    # 尝试用ipython展示markdown连接
-    show_url = BASE_URL + "?" + urlencode(SHOW_URL_PARAMS | {"tags": tags})
-    print(f"打开此连接检查图片是否正确: {show_url}")
+    # 尝试连接并读取json格式
+    test_response = await async_client.get(
+        base_url, params=BASE_URL_PARAMS | {"tags": tags}
+    )
+    test_response.raise_for_status()
 
-    # 建立连接客户端
-    async with httpx.AsyncClient() as async_client:
-        # 尝试连接并读取json格式
-        test_response = await async_client.get(
-            BASE_URL, params=BASE_URL_PARAMS | {"tags": tags}
-        )
-        test_response.raise_for_status()
+    try:
+        test_api_data = _GelbooruApiJson.model_validate_json(test_response.text)
+    except Exception as e:
+        raise AssertionError("无法获取正确的json格式") from e
 
-        try:
-            test_api_data = _GelbooruApiJson.model_validate_json(test_response.text)
-        except Exception as e:
-            raise AssertionError("无法获取正确的json格式") from e
+    count = test_api_data.attributes.count
 
-        count = test_api_data.attributes.count
-        if count == 0:
-            print("未发现任何图像，检查下输入的tags")
-            return
+    limit = max(1, min(100, unit))  # 每页获取图片数，最小为1，最大100
+    max_pid = math.floor(count / limit)  # 根据图片总数，计算最大可访问页数
+    need_pid = math.floor(
+        (max_images_number - 1) / limit
+    )  # 根据输入的max_images_numbe，决定要访问的页数
+    # 最终决定下载的轮数，不超过最大可访问页数，如果读不到图片就不下载
+    download_count = min(max_pid, need_pid) + 1  # `+1` 是因为页数从0开始
 
-        limit = max(1, min(100, unit))  # 每页获取图片数，最小为1，最大100
-        max_pid = math.floor(count / limit)  # 根据图片总数，计算最大可访问页数
-        need_pid = math.floor(
-            (max_images_number - 1) / limit
-        )  # 根据输入的max_images_numbe，决定要访问的页数
-        # 最终决定下载的轮数，不超过最大可访问页数，如果读不到图片就不下载
-        download_count = min(max_pid, need_pid) + 1  # `+1` 是因为页数从0开始
+    return count, limit, download_count
 
-        print(f"找到 {count} 张图片")
-        print(f"指定下载 {max_images_number} 张, 将执行 { download_count } 轮下载")
-        print(f"下载将在 {WAITING_TIME_BEFORE_DOWNLOADING} 秒后开始")
 
-        # 下载前读秒
-        for t in range(WAITING_TIME_BEFORE_DOWNLOADING):
-            print(WAITING_TIME_BEFORE_DOWNLOADING - t)
-            await asyncio.sleep(1)
+def _enter_process_stage(
+    stack: contextlib.AsyncExitStack, max_workers: Optional[int]
+) -> ExecutorStage:
+    """创建一个由 `stack` 管理的进程池流水线阶段，排队的任务最多为进程数的两倍"""
+    executor = stack.enter_context(
+        concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    )
+    return ExecutorStage(executor, max_pending=2 * (max_workers or os.cpu_count() or 1))
 
-        # 下载计数器
-        download_info_counter = _DownloadInfoCounter()
 
-        # 实例化GetAPI类用于查询API， 提供先前的async_client， 将在此函数执行完后才关闭
-        get_api = GetAPI(
-            base_url=BASE_URL,
-            base_url_params=BASE_URL_PARAMS,
-            async_client=async_client,
-        )
+class _DownloadStages(NamedTuple):
+    """`launch_executor` 在下载过程中使用的进程池阶段和追踪记录写入器"""
 
-        # 创建下载文件夹
-        await aiofiles.os.makedirs(download_dir, exist_ok=True)
+    verify_stage: Optional[ExecutorStage]
+    convert_stage: Optional[ExecutorStage]
+    converted_index: Optional[ConvertedIndex]
+    near_duplicate_filter: Optional["NearDuplicateFilter"]
+    trace_sink: Optional[TraceSink]
+    hash_executor: Optional[concurrent.futures.Executor]
 
-        for i in range(download_count):
-            # print下载轮次
-            divide_str = "#" * 20  # 显示每轮之间的分割字符
-            tqdm.write(f"{divide_str}\n第 {i+1} / {download_count} 轮下载进行中:")
 
-            # 查询API
-            api_post_data = await get_api.get_api(tags, limit=limit, pid=i)
+async def _enter_download_stages(
+    stack: contextlib.AsyncExitStack,
+    download_dir: str,
+    verify_images: bool,
+    verify_workers: Optional[int],
+    convert_options: Optional[ConvertOptions],
+    convert_workers: Optional[int],
+    near_duplicate_threshold: Optional[int],
+    near_duplicate_workers: Optional[int] = None,
+    update_index: bool = True,
+    trace_file: Optional[str] = None,
+    hash_workers: Optional[int] = None,
+) -> _DownloadStages:
+    """创建由 `stack` 管理的校验、转换和近似重复过滤阶段，转换记录，追踪记录写入器和md5线程池
 
-            if api_post_data is not None:
-                for post in api_post_data:
-                    post.tags = _process_tags(
-                        post.tags,
-                        add_comma=add_comma,
-                        remove_underscore=remove_underscore,
-                        use_escape=use_escape,
-                    )
+    Args:
+        stack: 管理进程池和索引保存的 `AsyncExitStack`
+        download_dir: 下载目录
+        verify_images: 见 `scrape_images`
+        verify_workers: 见 `scrape_images`
+        convert_options: 见 `scrape_images`
+        convert_workers: 见 `scrape_images`
+        near_duplicate_threshold: 见 `scrape_images`
+        near_duplicate_workers: 计算感知哈希的进程数，`None` 则为CPU核心数. Defaults to None.
+        update_index: 是否在开始前增量更新感知哈希索引，并在 `stack` 退出时保存.
+            为False时只读取已有的索引，下载过程中的更新只保留在内存中. Defaults to True.
+        trace_file: 见 `scrape_images`. Defaults to None.
+        hash_workers: 见 `scrape_images`. Defaults to None.
+    """
+    # 校验或转换跟不上时会反过来减慢下载
+    verify_stage = (
+        _enter_process_stage(stack, verify_workers) if verify_images else None
+    )
+    convert_stage = None
+    converted_index = None
+    if convert_options is not None:
+        convert_stage = _enter_process_stage(stack, convert_workers)
+        converted_index = await stack.enter_async_context(ConvertedIndex(download_dir))
+
+    near_duplicate_filter = None
+    if near_duplicate_threshold is not None:
+        from utils.near_duplicates import (  # noqa: PLC0415
+            NearDuplicateFilter,
+            PerceptualHashIndex,
+        )
 
-                res = await launch_executor(
-                    api_post_data,
-                    download_dir,
-                    max_workers=max_workers,
-                    timeout=timeout,
-                    async_client=async_client,
-                )
-                download_info_counter.update(res)
-            else:
-                tqdm.write("第 {i+1} 轮下载失败")
-            await asyncio.sleep(0.5)  # 休息一下，减轻压力
+        phash_index = PerceptualHashIndex.load(download_dir)
+        if update_index:
+            await asyncio.to_thread(phash_index.update)
+            # 无论下载是否中断，都保存索引
+            stack.push_async_callback(asyncio.to_thread, phash_index.save)
+        near_duplicate_filter = NearDuplicateFilter(
+            phash_index,
+            _enter_process_stage(stack, near_duplicate_workers),
+            threshold=near_duplicate_threshold,
+        )
 
-        download_info_counter.print()
+    trace_sink = None
+    if trace_file is not None:
+        trace_sink = TraceSink(trace_file)
+        trace_sink.start()
+        stack.push_async_callback(trace_sink.close)
+
+    md5_executor = hash_executor(hash_workers)
+    if md5_executor is not None:
+        stack.enter_context(md5_executor)
+
+    return _DownloadStages(
+        verify_stage,
+        convert_stage,
+        converted_index,
+        near_duplicate_filter,
+        trace_sink,
+        md5_executor,
+    )
+
+
+async def _enter_metrics(
+    stack: contextlib.AsyncExitStack,
+    metrics_port: Optional[int],
+    transfer_stats: TransferStats,
+) -> Optional[DownloadMetrics]:
+    """在 `metrics_port` 上启动由 `stack` 管理的指标服务器，`metrics_port` 为 `None` 时不启动
+
+    Args:
+        stack: 管理服务器关闭的 `AsyncExitStack`
+        metrics_port: 见 `scrape_images`
+        transfer_stats: 下载使用的 `TransferStats`，提供字节数和传输中的下载数
+    """
+    if metrics_port is None:
+        return None
+    metrics = DownloadMetrics(transfer_stats)
+    server = MetricsServer(metrics, metrics_port)
+    await server.start()
+    stack.push_async_callback(server.close)
+    return metrics
+
+
+async def _flush_page_outputs(
+    caption_sink: Optional[CaptionSink], bucket_index: Optional[BucketIndex]
+) -> None:
+    """在任务日志记录一页完成之前，写入这一页已缓存的caption和分桶"""
+    if caption_sink is not None:
+        await caption_sink.flush()
+    if bucket_index is not None:
+        await bucket_index.flush()
+
+
+async def _download_pages(  # noqa: C901
+    get_api: "GetAPI",
+    tags: str,
+    pages: Sequence[int],
+    limit: int,
+    tag_processor: TagProcessor,
+    on_posts: Optional[Callable[[List[_Post]], None]] = None,
+    on_result: Optional[Callable[[DownloadResult], None]] = None,
+    journal: Optional[DownloadJournal] = None,
+    show_progress: bool = True,
+    **launch_kwargs: Any,
+) -> _DownloadInfoCounter:
+    """依次查询并下载 `pages` 中的每一页
+
+    Args:
+        get_api: 用于查询API的 `GetAPI`
+        tags: 需要查询的tags
+        pages: 需要下载的页码(pid)
+        limit: 每页图片数
+        tag_processor: 用于处理tags字符串的 `TagProcessor`
+        on_posts: 每页的tags处理完成后、开始下载前调用，传入这一页的所有post. Defaults to None.
+        on_result: 见 `launch_executor`. Defaults to None.
+        journal: 用于记录每张图片的最终状态和已完成页面的任务日志.
+            日志中已经完成的图片会被直接跳过，不会再计算md5. Defaults to None.
+        show_progress: 是否显示每一轮的进度. Defaults to True.
+        launch_kwargs: 传给 `launch_executor` 的其他参数
+
+    Returns:
+        所有页的下载计数，跳过的图片计为重复
+    """
+    download_info_counter = _DownloadInfoCounter()
+    for n, pid in enumerate(pages):
+        if show_progress:
+            # print下载轮次
+            divide_str = "#" * 20  # 显示每轮之间的分割字符
+            tqdm.write(f"{divide_str}\n第 {n + 1} / {len(pages)} 轮下载进行中:")
+
+        # 查询API
+        api_post_data = await get_api.get_api(tags, limit=limit, pid=pid)
+
+        if api_post_data is None:
+            tqdm.write(f"第 {pid + 1} 页下载失败")
+            await asyncio.sleep(0.5)
+            continue
+
+        for post in api_post_data:
+            post.tags = tag_processor(post.tags)
+        if on_posts is not None:
+            on_posts(api_post_data)
+
+        page_on_result = on_result
+        skipped_number = 0
+        if journal is not None:
+            pending_posts = [
+                post for post in api_post_data if not journal.is_finished(post.md5)
+            ]
+            skipped_number = len(api_post_data) - len(pending_posts)
+            api_post_data = pending_posts
+
+            def page_on_result(result: DownloadResult, pid: int = pid) -> None:
+                assert journal is not None
+                if result.md5 is not None:
+                    journal.record_post(pid, result.md5, result.state.name)
+                if on_result is not None:
+                    on_result(result)
+
+        res = _DownloadInfoTuple(skipped_number, 0, skipped_number, 0)
+        if api_post_data:
+            launch_res = await launch_executor(
+                api_post_data,
+                on_result=page_on_result,
+                show_progress=show_progress,
+                **launch_kwargs,
+            )
+            res = _DownloadInfoTuple(*(a + b for a, b in zip(res, launch_res)))
+        elif show_progress:
+            tqdm.write(f"本页 {skipped_number} 张图片都已经下载完成")
+        download_info_counter.update(res)
+
+        if journal is not None:
+            # 先写入这一页的caption和分桶，再把这一页记为完成；
+            # 否则被强制结束后继续下载时，这些被日志跳过的图片不会再写入caption
+            await _flush_page_outputs(
+                launch_kwargs.get("caption_sink"), launch_kwargs.get("bucket_index")
+            )
+            await journal.complete_page(pid, res)
+        await asyncio.sleep(0.5)  # 休息一下，减轻压力
+
+    return download_info_counter
+
+
+##############################
+# 多进程下载
+
+
+class _ShardReporter:
+    """在下载进程中收集事件，定期成批地发送给主进程，避免每张图片都进行一次进程间通信"""
+
+    def __init__(self, events: Any, stop: Any = None, interval: float = 0.2):
+        """下载进程的事件发送器
+
+        Args:
+            events: 发送事件的队列，为 `multiprocessing.Manager().Queue()` 的代理
+            stop: 主进程要求停止的事件，为 `multiprocessing.Manager().Event()` 的代理.
+                Defaults to None.
+            interval: 发送间隔，单位为秒. Defaults to 0.2.
+        """
+        self.events = events
+        self.stop = stop
+        self.interval = interval
+        self._buffer: List[Tuple[Any, ...]] = []
+        self._closed = asyncio.Event()
+
+    def put(self, *event: Any) -> None:
+        """记录一个事件，第一个元素为事件类型"""
+        self._buffer.append(event)
+
+    async def flush(self) -> None:
+        """发送所有已记录的事件"""
+        if self._buffer:
+            batch, self._buffer = self._buffer, []
+            await asyncio.to_thread(self.events.put, batch)
+
+    def close(self) -> None:
+        """让 `run` 发送剩余的事件后返回"""
+        self._closed.set()
+
+    async def run(self, main_task: "Optional[Task[Any]]" = None) -> None:
+        """每隔 `interval` 秒发送一次，直到 `close` 被调用；主进程要求停止时取消 `main_task`
+
+        不能直接取消 `run`: 正在线程中发送的一批事件不会随之停止，
+        可能在进程结束、主进程停止接收事件之后才到达而被丢弃.
+        """
+        while not self._closed.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._closed.wait(), self.interval)
+            await self.flush()
+            if (
+                not self._closed.is_set()
+                and main_task is not None
+                and self.stop is not None
+                and await asyncio.to_thread(self.stop.is_set)
+            ):
+                main_task.cancel()
+                return
+
+
+class _ShardCaptionSink(CaptionSink):
+    """把caption转发给主进程，由主进程的 `CaptionSink` 统一写入同一个文件"""
+
+    def __init__(self, reporter: _ShardReporter):
+        self.reporter = reporter
+
+    async def write(self, image_path: str, tags: str) -> Literal[0, 1]:
+        self.reporter.put("caption", image_path, tags)
+        return 1
+
+    async def remove(self, image_path: str) -> None:
+        self.reporter.put("remove", image_path)
+
+
+class _ShardBucketIndex(BucketIndex):
+    """把图片尺寸转发给主进程的分桶索引，自身不会被打开或写入"""
+
+    def __init__(self, reporter: _ShardReporter):
+        super().__init__(os.devnull)
+        self.reporter = reporter
+
+    def add(self, file_name: str, width: int, height: int) -> None:
+        self.reporter.put("bucket", file_name, width, height)
+
+
+class _ShardJournal(DownloadJournal):
+    """把任务日志的记录转发给主进程写入，已完成的图片由主进程在开始前传入"""
+
+    def __init__(self, reporter: _ShardReporter, finished_posts: FrozenSet[str]):
+        super().__init__(os.devnull)
+        self.reporter = reporter
+        self._finished_posts = finished_posts
+
+    def is_finished(self, md5: str) -> bool:
+        return md5 in self._finished_posts
+
+    def finished_posts(self) -> FrozenSet[str]:
+        return self._finished_posts
+
+    def record_post(self, page: int, md5: str, state: str) -> None:
+        self.reporter.put("journal_post", page, md5, state)
+
+    async def complete_page(self, page: int, counts: Sequence[int]) -> None:
+        self.reporter.put("journal_page", page, list(counts))
+
+
+class _ShardTask(NamedTuple):
+    """一个下载进程的参数，会被pickle传递给子进程，其余参数见 `scrape_images`"""
+
+    tags: str
+    pages: List[int]
+    limit: int
+    download_dir: str
+    tag_processor: TagProcessor
+    events: Any
+    """`multiprocessing.Manager().Queue()` 的代理，用于向主进程发送事件"""
+    stop: Any
+    """`multiprocessing.Manager().Event()` 的代理，被设置时子进程立即停止"""
+    forward_captions: bool
+    """是否把caption转发给主进程写入，为False时在子进程中直接写入 `.txt` 文件"""
+    forward_buckets: bool
+    """是否把图片尺寸转发给主进程分桶"""
+    forward_tags: bool
+    """是否把处理后的tags转发给主进程统计"""
+    finished_posts: FrozenSet[str]
+    """任务日志中已经完成的图片的md5"""
+    max_workers: int
+    timeout: Optional[Union[int, float]]
+    verify_images: bool
+    verify_retries: int
+    verify_workers: Optional[int]
+    fast_verify: bool
+    convert_options: Optional[ConvertOptions]
+    convert_workers: Optional[int]
+    near_duplicate_threshold: Optional[int]
+    near_duplicate_workers: Optional[int]
+    trace_file: Optional[str]
+    """本进程的追踪记录文件"""
+    metrics_port: Optional[int]
+    """本进程的指标服务器端口"""
+    event_loop: str
+    """本进程使用的事件循环，与主进程相同"""
+    file_io_workers: Optional[int]
+    hash_workers: Optional[int]
+    image_mirrors: Optional[List[str]]
+    """每个进程各自统计和选择服务器"""
+
+
+async def _scrape_shard_async(task: _ShardTask) -> _DownloadInfoTuple:
+    reporter = _ShardReporter(task.events, task.stop)
+
+    def on_posts(posts: List[_Post]) -> None:
+        reporter.put("tags", [(post.image, post.tags) for post in posts])
+
+    def on_result(result: DownloadResult) -> None:
+        reporter.put("result", result.state, result.size)
+
+    # 每个进程有自己的事件循环、线程池和连接客户端
+    use_file_io_executor(task.file_io_workers)
+    async_client = httpx.AsyncClient()
+    async with async_client, contextlib.AsyncExitStack() as stack:
+        stages = await _enter_download_stages(
+            stack,
+            task.download_dir,
+            verify_images=task.verify_images,
+            verify_workers=task.verify_workers,
+            convert_options=task.convert_options,
+            convert_workers=task.convert_workers,
+            near_duplicate_threshold=task.near_duplicate_threshold,
+            near_duplicate_workers=task.near_duplicate_workers,
+            update_index=False,
+            trace_file=task.trace_file,
+            hash_workers=task.hash_workers,
+        )
+        transfer_stats = TransferStats()
+        metrics = await _enter_metrics(stack, task.metrics_port, transfer_stats)
+        get_api = GetAPI(
+            base_url=BASE_URL,
+            base_url_params=BASE_URL_PARAMS,
+            async_client=async_client,
+            metrics=metrics,
+        )
+
+        flush_task = asyncio.create_task(reporter.run(asyncio.current_task()))
+        try:
+            counter = await _download_pages(
+                get_api,
+                task.tags,
+                task.pages,
+                task.limit,
+                task.tag_processor,
+                on_posts=on_posts if task.forward_tags else None,
+                journal=_ShardJournal(reporter, task.finished_posts),
+                show_progress=False,
+                download_dir=task.download_dir,
+                max_workers=task.max_workers,
+                timeout=task.timeout,
+                async_client=async_client,
+                caption_sink=_ShardCaptionSink(reporter)
+                if task.forward_captions
+                else TxtCaptionSink(),
+                verify_retries=task.verify_retries,
+                verify_fast=task.fast_verify,
+                convert_options=task.convert_options,
+                bucket_index=_ShardBucketIndex(reporter)
+                if task.forward_buckets
+                else None,
+                on_result=on_result,
+                transfer_stats=transfer_stats,
+                metrics=metrics,
+                host_selector=HostSelector(task.image_mirrors)
+                if task.image_mirrors
+                else None,
+                **stages._asdict(),
+            )
+        finally:
+            reporter.close()
+            await flush_task
+
+    return _DownloadInfoTuple(
+        counter.all, counter.success, counter.duplicate, counter.error
+    )
+
+
+def _scrape_shard(task: _ShardTask) -> _DownloadInfoTuple:
+    """在子进程中下载 `task.pages`，可以被进程池调用"""
+    return run(_scrape_shard_async(task), task.event_loop)
+
+
+def _shard_file(path: Optional[str], index: int) -> Optional[str]:
+    """第 `index` 个下载进程使用的文件路径，例如 `trace.jsonl` -> `trace.0.jsonl`"""
+    if path is None:
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+def _shard_port(port: Optional[int], index: int) -> Optional[int]:
+    """第 `index` 个下载进程使用的端口，`0` 仍由系统分配"""
+    if not port:
+        return port
+    return port + index
+
+
+async def _scrape_sharded(  # noqa: C901, PLR0912, PLR0915
+    processes: int,
+    pages: List[int],
+    total: int,
+    caption_sink: CaptionSink,
+    bucket_index: Optional[BucketIndex],
+    tag_matrix_builder: Optional["TagMatrixBuilder"],
+    journal: DownloadJournal,
+    trace_file: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    **task_kwargs: Any,
+) -> _DownloadInfoCounter:
+    """把 `pages` 轮流分给 `processes` 个下载进程，并在本进程中汇总它们的结果和进度
+
+    caption、分桶、tag统计和任务日志都转发给本进程写入，所以各进程不会同时写入同一个文件.
+
+    Args:
+        processes: 下载进程数
+        pages: 需要下载的页码(pid)
+        total: 预计的图片总数，用于显示进度
+        caption_sink: 本进程的caption写入器
+        bucket_index: 本进程的分桶索引
+        tag_matrix_builder: 本进程的tag统计
+        journal: 本进程的任务日志
+        trace_file: 追踪记录文件，每个进程写入各自的 `<name>.<进程序号><ext>`. Defaults to None.
+        metrics_port: 指标服务器端口，每个进程使用 `metrics_port + 进程序号`. Defaults to None.
+        task_kwargs: `_ShardTask` 的其他参数
+
+    Returns:
+        所有进程的下载计数之和
+    """
+    near_duplicate_threshold = task_kwargs["near_duplicate_threshold"]
+    phash_index = None
+    if near_duplicate_threshold is not None:
+        from utils.near_duplicates import PerceptualHashIndex  # noqa: PLC0415
+
+        # 先为已有图片建立索引供各进程读取；同一次下载中不同进程之间的近似重复不会被过滤
+        phash_index = PerceptualHashIndex.load(task_kwargs["download_dir"])
+        await asyncio.to_thread(phash_index.update)
+        await asyncio.to_thread(phash_index.save)
+
+    loop = asyncio.get_running_loop()
+    finished_posts = journal.finished_posts()
+    download_info_counter = _DownloadInfoCounter()
+    states = dict.fromkeys(DownloadResultState, 0)
+    # 各进程只上报完成的图片大小，这里用同样的EWMA估计速度
+    meter = ThroughputMeter()
+
+    manager = multiprocessing.Manager()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    with manager, executor, tqdm(total=total) as pbar:
+        events = manager.Queue()
+        stop = manager.Event()
+        shard_futures = asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    executor,
+                    _scrape_shard,
+                    _ShardTask(
+                        pages=pages[i::processes],
+                        events=events,
+                        stop=stop,
+                        forward_captions=not isinstance(caption_sink, TxtCaptionSink),
+                        forward_buckets=bucket_index is not None,
+                        forward_tags=tag_matrix_builder is not None,
+                        finished_posts=finished_posts,
+                        trace_file=_shard_file(trace_file, i),
+                        metrics_port=_shard_port(metrics_port, i),
+                        event_loop=current_event_loop(),
+                        **task_kwargs,
+                    ),
+                )
+                for i in range(processes)
+            )
+        )
+
+        # 所有进程结束后(包括出错)，用None通知停止接收事件
+        def notify_done(future: "asyncio.Future[Any]") -> None:
+            if not future.cancelled():
+                # 被中断时不会再await它，在这里读取异常避免asyncio的警告
+                future.exception()
+            with contextlib.suppress(Exception):
+                events.put(None)
+
+        shard_futures.add_done_callback(notify_done)
+
+        try:
+            while (batch := await asyncio.to_thread(events.get)) is not None:
+                for kind, *args in batch:
+                    if kind == "result":
+                        state, size = args
+                        states[state] += 1
+                        meter.add(size)
+                        pbar.update()
+                    elif kind == "caption":
+                        await caption_sink.write(*args)
+                    elif kind == "remove":
+                        await caption_sink.remove(*args)
+                    elif kind == "bucket" and bucket_index is not None:
+                        bucket_index.add(*args)
+                    elif kind == "tags" and tag_matrix_builder is not None:
+                        for name, tags in args[0]:
+                            tag_matrix_builder.add(name, tags)
+                    elif kind == "journal_post":
+                        journal.record_post(*args)
+                    elif kind == "journal_page":
+                        await _flush_page_outputs(caption_sink, bucket_index)
+                        await journal.complete_page(*args)
+
+                pbar.set_description(
+                    f"{processes}个进程，当前: {_byte_to_mb(meter.rate()):.2f}MB/s，"
+                    f"平均: {_byte_to_mb(meter.average()):.2f}MB/s，总量: {_byte_to_mb(meter.total):.2f}MB",
+                    refresh=False,
+                )
+                pbar.set_postfix_str(
+                    f"成功: {states[DownloadResultState.SUCCESS]}，"
+                    f"重复: {states[DownloadResultState.DUPLICATE]}，"
+                    f"失败: {states[DownloadResultState.ERROR]}"
+                )
+        except BaseException:
+            # 被中断时通知各进程立即停止，已经完成的页面都已写入任务日志
+            stop.set()
+            raise
+
+        for res in await shard_futures:
+            download_info_counter.update(res)
+
+    if phash_index is not None:
+        # 各进程对索引的更新只保留在内存中，这里统一加入新下载的图片
+        await asyncio.to_thread(phash_index.update)
+        await asyncio.to_thread(phash_index.save)
+
+    return download_info_counter
+
+
+##############################
+# 流式API
+
+
+class StreamedImage(NamedTuple):
+    """`stream_images` 产出的一张图片"""
+
+    post: _Post
+    """API返回的图片信息，其中的 `tags` 已经被 `tag_processor` 处理过"""
+    result: DownloadResult
+    """下载结果"""
+    content: Optional[bytes] = None
+    """内存模式下成功下载的图片内容，否则为None"""
+
+
+async def _query_page(get_api: GetAPI, tags: str, limit: int, pid: int) -> List[_Post]:
+    """查询一页API，失败时等待后重试，最多尝试 `STREAM_API_ATTEMPTS` 次
+
+    Raises:
+        Exception: 所有尝试都失败时，引发最后一次的异常
+    """
+    delay = STREAM_API_RETRY_DELAY
+    for attempt in range(1, STREAM_API_ATTEMPTS):
+        try:
+            return await get_api.query(tags, limit=limit, pid=pid)
+        except Exception as e:
+            logging.warning(
+                f"第 {pid} 页API查询失败({attempt}/{STREAM_API_ATTEMPTS})，"
+                f"{delay}秒后重试: {e}"
+            )
+        await asyncio.sleep(delay)
+        delay *= 2
+    return await get_api.query(tags, limit=limit, pid=pid)
+
+
+async def stream_images(  # noqa: C901, PLR0912
+    tags: str,
+    max_images_number: int,
+    download_dir: Optional[str] = None,
+    max_workers: int = 10,
+    unit: int = 100,
+    timeout: Optional[Union[int, float]] = 10,
+    tag_processor: Optional[TagProcessor] = None,
+    async_client: Optional[httpx.AsyncClient] = None,
+    base_url: str = BASE_URL,
+    hash_executor: Optional[concurrent.futures.Executor] = None,
+    host_selector: Optional[HostSelector] = None,
+) -> AsyncIterator[StreamedImage]:
+    """查询并下载图片，按完成顺序逐张产出 `StreamedImage`，用于在其他程序中直接处理下载的图片.
+
+    同时最多有 `max_workers` 张图片在下载或等待被取走，
+    调用者处理得慢时不会开始新的下载，也只在需要更多图片时才查询下一页API，
+    所以内存模式下最多只有 `max_workers` 张图片的内容在内存中.
+    提前退出循环(或对生成器调用 `aclose`)时，正在进行的下载会被取消.
+
+    用法:
+        ```python
+        async for image in stream_images("hifumi_(blue_archive)", 50):
+            if image.result.state is DownloadResultState.ERROR:
+                continue
+            train_on(image.content, image.post.tags)
+        ```
+
+    Args:
+        tags: 见 `scrape_images`.
+        max_images_number: 最多产出的图片数.
+        download_dir: 下载目录，图片和同名 `.txt` tags文件写入其中，已有的图片会进行md5重复校验.
+            `None` 则为内存模式，不写入磁盘，图片内容在 `StreamedImage.content` 中. Defaults to None.
+        max_workers: 下载并发数，也是下载中和等待被取走的图片数之和的上限. Defaults to 10.
+        unit: 每次查询API的图片数，最小为1，最大为100. Defaults to 100.
+        timeout: 单个图片下载超时限制，单位为秒. Defaults to 10.
+        tag_processor: 用于处理tags字符串的 `TagProcessor`，`None` 则使用默认的 `TagProcessor`.
+            Defaults to None.
+        async_client: 用于查询和下载的 `httpx.AsyncClient`，由调用者负责关闭，
+            `None` 则新建一个并在结束时关闭. Defaults to None.
+        base_url: API地址，可以指向本地的模拟服务器用于测试. Defaults to BASE_URL.
+        hash_executor: 见 `Downloader`. Defaults to None.
+        host_selector: 见 `Downloader`，调用者可以在结束后读取其中各服务器的统计. Defaults to None.
+
+    Yields:
+        每张图片的 `StreamedImage`，按下载完成的顺序
+
+    Raises:
+        Exception: 某一页API查询 `STREAM_API_ATTEMPTS` 次都失败时，
+            引发最后一次的异常，而不是把它当作没有更多图片
+    """
+    if tag_processor is None:
+        tag_processor = TagProcessor()
+    max_workers = max(1, max_workers)
+    if download_dir is not None:
+        await aiofiles.os.makedirs(download_dir, exist_ok=True)
+
+    owns_client = async_client is None
+    client = httpx.AsyncClient() if async_client is None else async_client
+    get_api = GetAPI(client, base_url, BASE_URL_PARAMS)
+    # 并发数由任务数限制，不需要信号量
+    downloader = Downloader(
+        timeout=timeout,
+        semaphore=None,
+        async_client=client,
+        hash_executor=hash_executor,
+        host_selector=host_selector,
+    )
+
+    async def download_post(post: _Post) -> StreamedImage:
+        if download_dir is None:
+            result, content = await downloader.fetch(
+                post.file_url, file_name=post.image, tags=post.tags, md5=post.md5
+            )
+            return StreamedImage(post, result, content)
+        result = await downloader.download(
+            download_dir,
+            post.file_url,
+            file_name=post.image,
+            tags=post.tags,
+            md5=post.md5,
+        )
+        return StreamedImage(post, result)
+
+    # 每页的图片数必须固定，否则页码对应的位置会发生偏移
+    limit = max(1, min(unit, max_images_number))
+    queued_posts: List[_Post] = []
+    pid = 0
+    last_page = False
+    remaining = max_images_number
+    pending: Set[Task[StreamedImage]] = set()
+    try:
+        while True:
+            # 只在调用者取走结果之后才开始新的下载
+            while len(pending) < max_workers and remaining > 0:
+                if not queued_posts:
+                    if last_page:
+                        break
+                    posts = await _query_page(get_api, tags, limit, pid)
+                    pid += 1
+                    # 不足一页时，说明没有更多图片了
+                    last_page = len(posts) < limit
+                    if not posts:
+                        break
+                    for post in posts:
+                        post.tags = tag_processor(post.tags)
+                    queued_posts.extend(reversed(posts))
+                pending.add(asyncio.create_task(download_post(queued_posts.pop())))
+                remaining -= 1
+
+            if not pending:
+                return
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if owns_client:
+            await client.aclose()
+
+
+##############################
+
+
+async def _start_journal(
+    journal: DownloadJournal, get_api: GetAPI, job: JournalJob, resume: bool
+) -> JournalJob:
+    """开始或继续 `journal` 中的任务，新任务会记录当前最新的图片id
+
+    Args:
+        journal: 任务日志
+        get_api: 用于查询最新图片id的 `GetAPI`
+        job: 本次要开始的任务
+        resume: 是否继续日志中的任务
+
+    Returns:
+        实际执行的任务
+    """
+    if resume:
+        await asyncio.to_thread(journal.load)
+        if journal.job is not None and journal.job[:2] == job[:2]:
+            return journal.job
+        if journal.job is not None:
+            logging.warning(
+                f"上次下载的任务 {journal.job.tags!r} 与本次不同，将重新开始"
+            )
+
+    job = job._replace(max_id=await _latest_post_id(get_api, job.tags))
+    await journal.start(job)
+    return job
+
+
+async def _latest_post_id(get_api: GetAPI, tags: str) -> Optional[int]:
+    """`tags` 当前最新的图片id，用于固定之后每一页的内容
+
+    默认按id降序排列，第一张图片的id就是最新的id；
+    用 `id:<=最新id` 查询可以避免下载过程中新上传的图片使后面的页面发生偏移.
+
+    Returns:
+        最新的图片id，`tags` 指定了其他排序方式或查询失败时为None
+    """
+    if "sort:" in tags:
+        return None
+    first_posts = await get_api.get_api(tags, limit=1)
+    return first_posts[0].id if first_posts else None
+
+
+# 顶层封装
+async def scrape_images(  # noqa: C901, PLR0912, PLR0915
+    tags: str,
+    max_images_number: int,
+    download_dir: str,
+    max_workers: int = 10,
+    unit: int = 100,
+    timeout: Optional[Union[int, float]] = 10,
+    add_comma: bool = True,
+    remove_underscore: bool = True,
+    use_escape: bool = True,
+    check_images_mode: Union[None, int] = None,
+    caption_format: str = "txt",
+    tag_processor: Optional[TagProcessor] = None,
+    verify_images: bool = False,
+    verify_retries: int = 1,
+    verify_workers: Optional[int] = None,
+    fast_verify: bool = False,
+    convert_options: Optional[ConvertOptions] = None,
+    convert_workers: Optional[int] = None,
+    bucket_config: Optional[BucketConfig] = None,
+    near_duplicate_threshold: Optional[int] = None,
+    tag_stats: bool = False,
+    processes: int = 1,
+    resume: bool = False,
+    trace_file: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    countdown: Optional[int] = None,
+    file_io_workers: Optional[int] = None,
+    hash_workers: Optional[int] = None,
+    image_mirrors: Optional[Sequence[str]] = None,
+) -> None:
+    r"""从gelbooru抓取图片，图片数量为max_images_number以unit为单位向上取.
+
+    Args:
+        tags: 用于在gelbooru中搜索图片的tag，浏览以下链接获取更多信息.
+            - [tags](https://gelbooru.com/index.php?page=wiki&s=&s=view&id=25921)
+            - [cheatsheet](https://gelbooru.com/index.php?page=wiki&s=&s=view&id=26263)
+        max_images_number: 要抓取的图片数量.
+        download_dir: 下载目录.
+        max_workers: 下载并发数. Defaults to 10.
+        unit: 下载量单位，最小为1，最大为100. Defaults to 100.
+        timeout: 单个图片下载超时限制，单位为秒. Defaults to 10.
+        add_comma: 是否在`与图片一起被抓取的tag字符串`中添加逗号分割. Defaults to True.
+        remove_underscore: 是否将`与图片一起被抓取的tag字符串`中的下划线换成空格. Defaults to True.
+        use_escape: 是否对`与图片一起被抓取的tag字符串`中的成空格进行转义. Defaults to True.
+            即 `()` -> `\(` 和 `)` -> `\)`.
+        check_images_mode: 是否在下载结束后检查图片是否正确. Defaults to None.
+            - None: 不检查
+            - 0: 检查，但只输出信息不做任何操作
+            - 1: 尝试修复图片
+            - 2: 尝试删除图片
+            检查使用进程池，并通过下载目录下的检查缓存跳过之前已经通过检查且没有改变的图片.
+        caption_format: tags的保存格式. Defaults to "txt".
+            - "txt": 每张图片一个同名 `.txt` 文件
+            - "jsonl": 所有tags追加写入下载目录下的 `captions.jsonl`
+            - "json": 所有tags写入下载目录下kohya风格的 `meta_cap.json`
+        tag_processor: 用于处理tags字符串的 `TagProcessor`，可以配置黑白名单、别名、排序等规则.
+            如果提供，将忽略 `add_comma`, `remove_underscore`, `use_escape`. Defaults to None.
+        verify_images: 是否在下载过程中用进程池解码校验每张新下载的图片. Defaults to False.
+            与 `check_images_mode` 不同，这只会检查本次新下载的图片，并且与其他图片的下载同时进行.
+        verify_retries: 校验失败时重新下载的最大次数. Defaults to 1.
+        verify_workers: 校验进程数，也是 `check_images_mode` 的检查进程数，`None` 则为CPU核心数.
+            Defaults to None.
+        fast_verify: `verify_images` 和 `check_images_mode` 是否只检查图片的容器结构
+            (如JPEG的EOI、PNG的IEND和CRC、GIF的trailer)，结构可疑时才完整解码. Defaults to False.
+        convert_options: 下载后缩放和转换图片的参数，`None` 则不转换. Defaults to None.
+            转换在进程池中与其他图片的下载同时进行；已经存在的转换结果会被视为重复而跳过下载.
+        convert_workers: 转换进程数，`None` 则为CPU核心数. Defaults to None.
+        bucket_config: 宽高比分桶的参数，`None` 则不分桶. Defaults to None.
+            分桶使用API返回的宽高，不需要打开图片，结果写入下载目录下的 `buckets.json`.
+        near_duplicate_threshold: 在下载过程中过滤近似重复图片的dHash汉明距离阈值，`None` 则不过滤.
+            Defaults to None. 需要安装numpy.
+            下载开始前会为下载目录中的已有图片建立(或增量更新)感知哈希索引 `.phash_index.npz`.
+        tag_stats: 是否直接用API返回的tags统计本次抓取的tag频率和共现，不需要再读取caption文件.
+            Defaults to False. 需要安装numpy.
+            结束时打印统计结果，并将 文档-tag 矩阵保存到下载目录下的 `.tag_stats_scrape.npz`，
+            可以用 `python -m utils.tag_stats --matrix` 再次查看.
+        processes: 下载进程数. Defaults to 1.
+            大于1时各页轮流分给多个进程，每个进程有自己的事件循环、连接客户端和进程池，
+            本进程汇总显示进度并统一写入caption、分桶索引和tag统计.
+            同一次下载中不同进程之间的近似重复图片不会被过滤.
+        resume: 是否继续下载目录中任务日志 `.scrape_journal.jsonl` 记录的上一次下载. Defaults to False.
+            每次下载都会记录已完成的页面和每张图片的最终状态；继续下载时跳过已完成的页面，
+            已经下载完成的图片也不会再计算md5，失败的图片会被重新下载.
+            日志中的任务与本次的 `tags` 和 `unit` 不同时，将重新开始.
+        trace_file: 追踪记录的JSONL文件路径，`None` 则不记录. Defaults to None.
+            每张图片一条记录，包括md5检查、等待信号量、首字节、传输、写入磁盘和后处理各阶段的耗时，
+            以及HTTP状态码、字节数和重新下载次数，用于找出下载慢的原因.
+            记录在后台批量写入；`processes` 大于1时每个进程写入各自的 `<name>.<进程序号><ext>`.
+        metrics_port: 在 `127.0.0.1` 的此端口上以Prometheus文本格式提供下载指标(`/metrics`)，
+            `None` 则不提供. Defaults to None.
+            指标包括按结果统计的完成数、字节数、传输中的下载数、等待信号量的下载数、
+            API请求耗时、重新下载次数和md5检查耗时，见 `utils.metrics`.
+            `processes` 大于1时每个进程在 `metrics_port + 进程序号` 上提供各自的指标.
+        countdown: 查询API之后、开始下载之前的倒计时秒数，用于确认下载信息，
+            `None` 则为 `WAITING_TIME_BEFORE_DOWNLOADING`. Defaults to None.
+            定时任务等无人值守的下载可以设为0.
+        file_io_workers: 文件读写(aiofiles)使用的线程数，`None` 则使用asyncio默认的执行器.
+            Defaults to None.
+            设置后会替换事件循环的默认执行器，所以应在使用默认执行器之前调用 `scrape_images`.
+        hash_workers: 计算已有图片md5使用的线程数，`None` 则与文件读写共用默认执行器.
+            Defaults to None.
+            `processes` 大于1时，`file_io_workers` 和 `hash_workers` 为每个进程的线程数.
+        image_mirrors: 提供相同图片路径的服务器，例如 `["img3.gelbooru.com", "img4.gelbooru.com"]`，
+            `None` 则总是使用API返回的图片链接. Defaults to None.
+            图片链接的服务器在其中时，根据各服务器的首字节时间和错误率选择服务器，
+            下载失败时换用其他镜像重试一次，结束时打印各服务器的统计，见 `utils.hosts.HostSelector`.
+            `processes` 大于1时每个进程各自选择，不打印统计.
+
+    Returns:
+        None
+    """
+    # 在第一次DNS解析或文件读写之前替换默认执行器
+    use_file_io_executor(file_io_workers)
+
+    # 先检查参数，避免在查询API之后才报错
+    caption_sink = make_caption_sink(caption_format, download_dir)
+    if tag_processor is None:
+        tag_processor = TagProcessor(
+            add_comma=add_comma,
+            remove_underscore=remove_underscore,
+            use_escape=use_escape,
+        )
+
+    # 尝试用ipython展示markdown连接
+    show_url = BASE_URL + "?" + urlencode(SHOW_URL_PARAMS | {"tags": tags})
+    print(f"打开此连接检查图片是否正确: {show_url}")
+
+    # 建立连接客户端
+    async with httpx.AsyncClient() as async_client:
+        count, limit, download_count = await _query_download_count(
+            async_client, tags, max_images_number=max_images_number, unit=unit
+        )
+        if count == 0:
+            print("未发现任何图像，检查下输入的tags")
+            return
+
+        # 创建下载文件夹
+        await aiofiles.os.makedirs(download_dir, exist_ok=True)
+
+        # 实例化GetAPI类用于查询API， 提供先前的async_client， 将在此函数执行完后才关闭
+        get_api = GetAPI(
+            base_url=BASE_URL,
+            base_url_params=BASE_URL_PARAMS,
+            async_client=async_client,
+        )
+
+        journal = DownloadJournal(download_dir)
+        job = await _start_journal(
+            journal, get_api, JournalJob(tags, limit, download_count), resume
+        )
+        pages = journal.pending_pages()
+        processes = max(1, min(processes, len(pages)))
+
+        print(f"找到 {count} 张图片")
+        if len(pages) < job.page_count:
+            print(
+                f"继续上次的下载，已完成 {job.page_count - len(pages)} / {job.page_count} 轮"
+            )
+        print(f"指定下载 {max_images_number} 张, 将执行 {len(pages)} 轮下载")
+        if processes > 1:
+            print(f"将使用 {processes} 个进程下载")
+        if countdown is None:
+            countdown = WAITING_TIME_BEFORE_DOWNLOADING
+        if countdown > 0:
+            print(f"下载将在 {countdown} 秒后开始")
+
+        # 下载前读秒
+        for t in range(countdown):
+            print(countdown - t)
+            await asyncio.sleep(1)
+
+        host_selector = HostSelector(image_mirrors) if image_mirrors else None
+
+        tag_matrix_builder = None
+        if tag_stats:
+            from utils.tag_stats import TagMatrixBuilder  # noqa: PLC0415
+
+            tag_matrix_builder = TagMatrixBuilder(
+                separator=tag_processor.separator.strip() or " "
+            )
+
+        def add_post_tags(posts: List[_Post]) -> None:
+            assert tag_matrix_builder is not None
+            for post in posts:
+                tag_matrix_builder.add(post.image, post.tags)
+
+        async with contextlib.AsyncExitStack() as stack:
+            # 无论下载是否中断，都写入已经完成的图片记录
+            stack.push_async_callback(journal.close)
+            await stack.enter_async_context(caption_sink)
+            bucket_index = (
+                await stack.enter_async_context(
+                    BucketIndex(
+                        os.path.join(download_dir, BUCKET_INDEX_FILE_NAME),
+                        bucket_config,
+                    )
+                )
+                if bucket_config is not None
+                else None
+            )
+
+            if processes > 1:
+                # 每个进程都有自己的进程池，默认平分CPU核心
+                shard_workers = max(1, (os.cpu_count() or 1) // processes)
+                download_info_counter = await _scrape_sharded(
+                    processes,
+                    pages,
+                    total=min(count, len(pages) * limit),
+                    caption_sink=caption_sink,
+                    bucket_index=bucket_index,
+                    tag_matrix_builder=tag_matrix_builder,
+                    journal=journal,
+                    tags=job.query_tags(),
+                    limit=limit,
+                    download_dir=download_dir,
+                    tag_processor=tag_processor,
+                    max_workers=max_workers,
+                    timeout=timeout,
+                    verify_images=verify_images,
+                    verify_retries=verify_retries,
+                    verify_workers=verify_workers or shard_workers,
+                    fast_verify=fast_verify,
+                    convert_options=convert_options,
+                    convert_workers=convert_workers or shard_workers,
+                    near_duplicate_threshold=near_duplicate_threshold,
+                    near_duplicate_workers=shard_workers,
+                    trace_file=trace_file,
+                    metrics_port=metrics_port,
+                    file_io_workers=file_io_workers,
+                    hash_workers=hash_workers,
+                    image_mirrors=list(image_mirrors) if image_mirrors else None,
+                )
+            else:
+                stages = await _enter_download_stages(
+                    stack,
+                    download_dir,
+                    verify_images=verify_images,
+                    verify_workers=verify_workers,
+                    convert_options=convert_options,
+                    convert_workers=convert_workers,
+                    near_duplicate_threshold=near_duplicate_threshold,
+                    trace_file=trace_file,
+                    hash_workers=hash_workers,
+                )
+                # 所有页面共用，速度和总量统计整个下载过程
+                transfer_stats = TransferStats()
+                get_api.metrics = await _enter_metrics(
+                    stack, metrics_port, transfer_stats
+                )
+                download_info_counter = await _download_pages(
+                    get_api,
+                    job.query_tags(),
+                    pages,
+                    limit,
+                    tag_processor,
+                    on_posts=add_post_tags if tag_matrix_builder is not None else None,
+                    journal=journal,
+                    download_dir=download_dir,
+                    max_workers=max_workers,
+                    timeout=timeout,
+                    async_client=async_client,
+                    caption_sink=caption_sink,
+                    verify_retries=verify_retries,
+                    verify_fast=fast_verify,
+                    convert_options=convert_options,
+                    bucket_index=bucket_index,
+                    transfer_stats=transfer_stats,
+                    metrics=get_api.metrics,
+                    host_selector=host_selector,
+                    **stages._asdict(),
+                )
+
+        download_info_counter.print()
+        if host_selector is not None and host_selector.stats:
+            print(host_selector.format())
+
+        if tag_matrix_builder is not None:
+            from utils.tag_stats import print_tag_stats  # noqa: PLC0415
+
+            tag_matrix = tag_matrix_builder.build()
+            await asyncio.to_thread(
+                tag_matrix.save, os.path.join(download_dir, ".tag_stats_scrape.npz")
+            )
+            print_tag_stats(tag_matrix)
 
         if check_images_mode not in [0, 1, 2, None]:
             logging.warning(
@@ -828,84 +2381,413 @@ async def scrape_images(
             check_images_mode = None
         # 是否删除下载失败的图片
         if check_images_mode is not None:
+            from utils.check_images import check_images  # noqa: PLC0415
+
             delete_list = await asyncio.to_thread(  # noqa: F841
                 check_images,
                 download_dir,
-                max_workers=None,
+                max_workers=verify_workers,
                 mode=check_images_mode,
                 debug=True,
+                fast=fast_verify,
+                engine="process",
+                use_cache=True,
             )
 
 
-##############################
-# 命令行脚本
-if __name__ == "__main__":
-    """ 用命令行读取参数并启动下载协程 """
+async def refresh_tags(
+    tags: str,
+    max_images_number: int,
+    download_dir: str,
+    unit: int = 100,
+    add_comma: bool = True,
+    remove_underscore: bool = True,
+    use_escape: bool = True,
+    caption_format: str = "txt",
+    tag_processor: Optional[TagProcessor] = None,
+) -> None:
+    r"""只更新已下载图片的tags，不下载也不校验任何图片.
 
-    parser = argparse.ArgumentParser()
+    和 `scrape_images` 一样分页查询API，但只为 `download_dir` 中已经存在的图片写入tags.
+    图片按文件名(不含扩展名，即gelbooru的md5)与API结果匹配，不会计算任何md5；
+    每页的tags作为一批写入，内容未改变的tags不会被重写.
 
-    parser.add_argument(
-        "--tags", type=str, default="girl", help="符合gelbooru规则的tags字符串"
-    )
-    parser.add_argument(
-        "--max_images_number", type=int, default="50", help="下载图片数量"
-    )
-    parser.add_argument(
-        "--download_dir",
-        type=str,
-        default=os.path.join(os.getcwd(), "images"),
-        help="下载路径",
-    )
-    parser.add_argument("--max_workers", type=int, default=15, help="最大协程工作数")
-    parser.add_argument(
-        "--unit", type=int, default=50, help="下载单位，图片数量以此向上取一单位"
-    )
-    parser.add_argument("--timeout", type=int, default=10, help="连接超时限制")
-    parser.add_argument(
-        "--add_comma", action="store_true", help="是否在tags之间添加逗号"
-    )
-    parser.add_argument(
-        "--remove_underscore",
-        action="store_true",
-        help="是否将tags中的下划线替换为空格",
-    )
-    parser.add_argument(
-        "--use_escape", action="store_true", help="是否转义正则表达式特殊字符"
-    )
-    parser.add_argument(
-        "--check_images_mode",
-        type=int,
-        default=None,
-        help="None为不检查，0表示只检查并输出信息而不做任何操作，1表示检查并尝试修复图片，2表示检查并删除无法读取的图片",
+    Args:
+        tags: 用于在gelbooru中搜索图片的tag.
+        max_images_number: 要查询的图片数量.
+        download_dir: 已下载图片所在的目录.
+        unit: 每页查询的图片数量，最小为1，最大为100. Defaults to 100.
+        add_comma: 见 `scrape_images`. Defaults to True.
+        remove_underscore: 见 `scrape_images`. Defaults to True.
+        use_escape: 见 `scrape_images`. Defaults to True.
+        caption_format: 见 `scrape_images`. Defaults to "txt".
+        tag_processor: 见 `scrape_images`. Defaults to None.
+
+    Returns:
+        None
+    """
+    caption_sink = make_caption_sink(caption_format, download_dir)
+    if tag_processor is None:
+        tag_processor = TagProcessor(
+            add_comma=add_comma,
+            remove_underscore=remove_underscore,
+            use_escape=use_escape,
+        )
+
+    if not await aiofiles.os.path.isdir(download_dir):
+        print(f"{download_dir} 不存在，没有可以更新tags的图片")
+        return
+
+    # 只遍历一次目录建立索引，之后的匹配都在内存中完成
+    local_images = await asyncio.to_thread(
+        lambda: {
+            os.path.splitext(entry.name)[0]: entry.path
+            for entry in scan_img_files(download_dir)
+        }
     )
+    print(f"{download_dir} 中有 {len(local_images)} 张图片")
 
-    cmd_param, unknown = parser.parse_known_args()
-
-    if unknown:
-        logging.error(f"以下输入参数非法，将被忽略：\n{unknown}")
-
-    tags = cmd_param.tags
-    max_images_number = cmd_param.max_images_number
-    download_dir = cmd_param.download_dir
-    max_workers = cmd_param.max_workers
-    unit = cmd_param.unit
-    timeout = cmd_param.timeout
-    add_comma = cmd_param.add_comma
-    remove_underscore = cmd_param.remove_underscore
-    use_escape = cmd_param.use_escape
-    check_images_mode = cmd_param.check_images_mode
-
-    Scrape_images_coroutine = scrape_images(
-        tags,
-        max_images_number,
-        download_dir,
-        max_workers=max_workers,
-        unit=unit,
-        timeout=timeout,
-        add_comma=add_comma,
-        remove_underscore=remove_underscore,
-        use_escape=use_escape,
-        check_images_mode=check_images_mode,
+    async with httpx.AsyncClient() as async_client:
+        count, limit, page_count = await _query_download_count(
+            async_client, tags, max_images_number=max_images_number, unit=unit
+        )
+        if count == 0:
+            print("未发现任何图像，检查下输入的tags")
+            return
+
+        get_api = GetAPI(
+            base_url=BASE_URL,
+            base_url_params=BASE_URL_PARAMS,
+            async_client=async_client,
+        )
+
+        matched_number = 0
+        missing_number = 0
+        error_number = 0
+
+        async with caption_sink:
+            for i in tqdm(range(page_count), desc="更新tags中"):
+                api_post_data = await get_api.get_api(tags, limit=limit, pid=i)
+                if api_post_data is None:
+                    tqdm.write(f"第 {i + 1} 页查询失败")
+                    continue
+
+                write_coroutines = []
+                for post in api_post_data:
+                    image_path = local_images.get(os.path.splitext(post.image)[0])
+                    if image_path is None:
+                        missing_number += 1
+                        continue
+                    write_coroutines.append(
+                        caption_sink.write(image_path, tag_processor(post.tags))
+                    )
+
+                results = await asyncio.gather(*write_coroutines)
+                matched_number += len(results)
+                error_number += results.count(0)
+                await asyncio.sleep(0.5)  # 休息一下，减轻压力
+
+    print("*#" * 20)
+    print("tags更新总结")
+    print(f"匹配到本地图片： {matched_number} 个")
+    print(f"本地不存在： {missing_number} 个")
+    print(f"写入失败： {error_number} 个")
+
+
+##############################
+# 多台机器协同下载
+
+
+async def coordinate_job(
+    tags: str,
+    max_images_number: int,
+    job_queue: str,
+    unit: int = 100,
+    reset: bool = False,
+    watch_interval: float = 10.0,
+    base_url: str = BASE_URL,
+) -> None:
+    """创建多台机器协同下载的任务，并等待所有工作进程完成.
+
+    查询 `tags` 的图片总数后，把需要下载的每一页作为一个工作单元写入共享存储上的 `job_queue`.
+    任务会记录创建时最新的图片id，工作进程只查询不晚于它的图片，之后上传的图片不会使页面发生偏移.
+    之后在任意台机器上用 `run_job_worker` 启动工作进程即可，工作进程可以在任务创建后随时加入或退出.
+
+    Args:
+        tags: 用于在gelbooru中搜索图片的tag.
+        max_images_number: 要抓取的图片数量.
+        job_queue: 任务队列(SQLite数据库)路径，应位于所有机器都能访问的共享存储上.
+        unit: 每页图片数，最小为1，最大为100. Defaults to 100.
+        reset: 队列中已有任务时，是否清空后重新创建. Defaults to False.
+            为False时，如果已有相同的任务则继续等待它完成.
+        watch_interval: 查看进度的间隔，单位为秒，不大于0则创建任务后立即返回. Defaults to 10.0.
+        base_url: API地址，可以指向本地的模拟服务器用于测试. Defaults to BASE_URL.
+
+    Returns:
+        None
+    """
+    async with httpx.AsyncClient() as async_client:
+        count, limit, page_count = await _query_download_count(
+            async_client,
+            tags,
+            max_images_number=max_images_number,
+            unit=unit,
+            base_url=base_url,
+        )
+        if count == 0:
+            print("未发现任何图像，检查下输入的tags")
+            return
+        get_api = GetAPI(async_client, base_url, BASE_URL_PARAMS)
+        max_id = await _latest_post_id(get_api, tags)
+
+    with WorkQueue(job_queue) as queue:
+        created = await asyncio.to_thread(
+            queue.create, JobInfo(tags, limit, page_count, max_id), reset
+        )
+        print(f"找到 {count} 张图片，共 {page_count} 页")
+        print(f"{'已创建' if created else '继续'}任务: {job_queue}")
+        if watch_interval <= 0:
+            return
+
+        with tqdm(total=page_count, desc="已完成页数") as pbar:
+            while True:
+                # 持有租约的工作进程崩溃后，只有这里能让它的单元重新等待租用或失败
+                await asyncio.to_thread(queue.reclaim_expired)
+                status = await asyncio.to_thread(queue.status)
+                pbar.n = status[UnitState.DONE] + status[UnitState.FAILED]
+                pbar.set_postfix_str(
+                    f"下载中: {status[UnitState.LEASED]}，失败: {status[UnitState.FAILED]}"
+                )
+                if status[UnitState.PENDING] == status[UnitState.LEASED] == 0:
+                    break
+                await asyncio.sleep(watch_interval)
+
+        download_info_counter = _DownloadInfoCounter()
+        download_info_counter.update(
+            _DownloadInfoTuple(*await asyncio.to_thread(queue.totals))
+        )
+        download_info_counter.print()
+        for page, error in (await asyncio.to_thread(queue.failed_units)).items():
+            print(f"第 {page + 1} 页失败: {error}")
+
+
+async def _keep_lease(queue: WorkQueue, page: int, worker_id: str) -> None:
+    """每隔租约时长的三分之一续租一次，直到被取消"""
+    while True:
+        await asyncio.sleep(queue.lease_seconds / 3)
+        if not await asyncio.to_thread(queue.renew, page, worker_id):
+            logging.warning(
+                f"第 {page + 1} 页的租约已过期，可能会被其他工作进程重复下载"
+            )
+            return
+
+
+async def run_job_worker(  # noqa: C901, PLR0915
+    job_queue: str,
+    download_dir: str,
+    worker_id: Optional[str] = None,
+    max_workers: int = 10,
+    timeout: Optional[Union[int, float]] = 10,
+    tag_processor: Optional[TagProcessor] = None,
+    verify_images: bool = False,
+    verify_retries: int = 1,
+    verify_workers: Optional[int] = None,
+    fast_verify: bool = False,
+    convert_options: Optional[ConvertOptions] = None,
+    convert_workers: Optional[int] = None,
+    lease_seconds: float = 300.0,
+    base_url: str = BASE_URL,
+    trace_file: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    file_io_workers: Optional[int] = None,
+    hash_workers: Optional[int] = None,
+    image_mirrors: Optional[Sequence[str]] = None,
+) -> None:
+    """从 `job_queue` 中租用页面并下载，直到任务的所有页面都已完成或失败.
+
+    多台机器可以同时运行工作进程，下载到同一个共享目录.
+    租用的页面会被定期续租；进程崩溃后租约过期，页面会被重新分配给其他工作进程.
+    因为多台机器同时写入同一个caption文件会互相覆盖，tags总是保存为每张图片一个同名 `.txt` 文件.
+
+    Args:
+        job_queue: `coordinate_job` 创建的任务队列路径.
+        download_dir: 下载目录，通常位于共享存储上.
+        worker_id: 工作进程标识，`None` 则由主机名和进程号生成. Defaults to None.
+        max_workers: 见 `scrape_images`. Defaults to 10.
+        timeout: 见 `scrape_images`. Defaults to 10.
+        tag_processor: 见 `scrape_images`，`None` 则使用默认的 `TagProcessor`. Defaults to None.
+        verify_images: 见 `scrape_images`. Defaults to False.
+        verify_retries: 见 `scrape_images`. Defaults to 1.
+        verify_workers: 见 `scrape_images`. Defaults to None.
+        fast_verify: 见 `scrape_images`. Defaults to False.
+        convert_options: 见 `scrape_images`. Defaults to None.
+        convert_workers: 见 `scrape_images`. Defaults to None.
+        lease_seconds: 租约时长，单位为秒. Defaults to 300.0.
+        base_url: API地址，可以指向本地的模拟服务器用于测试. Defaults to BASE_URL.
+        trace_file: 见 `scrape_images`，多台机器时应各自使用不同的文件. Defaults to None.
+        metrics_port: 见 `scrape_images`. Defaults to None.
+        file_io_workers: 见 `scrape_images`. Defaults to None.
+        hash_workers: 见 `scrape_images`. Defaults to None.
+        image_mirrors: 见 `scrape_images`. Defaults to None.
+
+    Returns:
+        None
+    """
+    use_file_io_executor(file_io_workers)
+    if worker_id is None:
+        worker_id = default_worker_id()
+    if tag_processor is None:
+        tag_processor = TagProcessor()
+
+    with WorkQueue(job_queue, lease_seconds=lease_seconds) as queue:
+        job = await asyncio.to_thread(queue.job)
+        if job is None:
+            print(f"{job_queue} 中没有任务，请先创建任务")
+            return
+        print(f"工作进程 {worker_id} 开始下载: {job.tags}")
+
+        await aiofiles.os.makedirs(download_dir, exist_ok=True)
+        download_info_counter = _DownloadInfoCounter()
+        transfer_stats = TransferStats()
+
+        async_client = httpx.AsyncClient()
+        async with async_client, contextlib.AsyncExitStack() as stack:
+            stages = await _enter_download_stages(
+                stack,
+                download_dir,
+                verify_images=verify_images,
+                verify_workers=verify_workers,
+                convert_options=convert_options,
+                convert_workers=convert_workers,
+                near_duplicate_threshold=None,
+                trace_file=trace_file,
+                hash_workers=hash_workers,
+            )
+            metrics = await _enter_metrics(stack, metrics_port, transfer_stats)
+            get_api = GetAPI(
+                base_url=base_url,
+                base_url_params=BASE_URL_PARAMS,
+                async_client=async_client,
+                metrics=metrics,
+            )
+            caption_sink = TxtCaptionSink()
+            host_selector = HostSelector(image_mirrors) if image_mirrors else None
+
+            while True:
+                page = await asyncio.to_thread(queue.lease, worker_id)
+                if page is None:
+                    if await asyncio.to_thread(queue.is_finished):
+                        break
+                    # 剩下的页面正在被其他工作进程下载，等待它们完成或租约过期
+                    await asyncio.sleep(min(lease_seconds / 3, 30))
+                    continue
+
+                divide_str = "#" * 20  # 显示每轮之间的分割字符
+                tqdm.write(
+                    f"{divide_str}\n第 {page + 1} / {job.page_count} 页下载进行中:"
+                )
+                keep_lease = asyncio.create_task(_keep_lease(queue, page, worker_id))
+                try:
+                    api_post_data = await get_api.get_api(
+                        job.query_tags(), limit=job.limit, pid=page
+                    )
+                    if api_post_data is None:
+                        await asyncio.to_thread(
+                            queue.release, page, worker_id, "API查询失败"
+                        )
+                        continue
+
+                    for post in api_post_data:
+                        post.tags = tag_processor(post.tags)
+                    res = await launch_executor(
+                        api_post_data,
+                        download_dir,
+                        max_workers=max_workers,
+                        timeout=timeout,
+                        async_client=async_client,
+                        caption_sink=caption_sink,
+                        verify_retries=verify_retries,
+                        verify_fast=fast_verify,
+                        convert_options=convert_options,
+                        transfer_stats=transfer_stats,
+                        metrics=metrics,
+                        host_selector=host_selector,
+                        **stages._asdict(),
+                    )
+                    download_info_counter.update(res)
+                    await asyncio.to_thread(queue.complete, page, worker_id, res)
+                except Exception as e:
+                    logging.error(f"下载第 {page + 1} 页时发生错误, error: {e}")
+                    await asyncio.to_thread(
+                        queue.release, page, worker_id, f"{type(e).__name__}: {e}"
+                    )
+                except BaseException:
+                    # 被中断时立即放弃租约，其他工作进程不必等待租约过期
+                    queue.release(page, worker_id, "工作进程被中断")
+                    raise
+                finally:
+                    keep_lease.cancel()
+                await asyncio.sleep(0.5)  # 休息一下，减轻压力
+
+    print(f"工作进程 {worker_id} 已完成")
+    download_info_counter.print()
+    if host_selector is not None and host_selector.stats:
+        print(host_selector.format())
+
+
+##############################
+# 性能分析
+
+
+def profile_download(
+    mode: Literal["cprofile", "sample"],
+    output_dir: str,
+    tracemalloc_frames: int = 0,
+    tracemalloc_interval: Optional[float] = None,
+) -> "Profiler":
+    """创建分析下载过程的 `Profiler`，用法见 `utils.profiling.Profiler`
+
+    除了cProfile或调用栈采样、事件循环延迟和tracemalloc快照外，还会统计以下阶段的CPU时间:
+        - api_parse: 解析API返回的json
+        - tag_processing: 处理tags
+        - progress: 进度条的渲染和速度描述
+        - hashing / writing / reading 等: 线程池中的md5计算和文件读写
+
+    只分析调用它的进程，`processes` 大于1时各下载进程不会被分析.
+
+    Args:
+        mode: "cprofile" 或 "sample"
+        output_dir: 保存结果的目录
+        tracemalloc_frames: tracemalloc记录的栈帧数，0则不启用. Defaults to 0.
+        tracemalloc_interval: 每隔多少秒保存一次tracemalloc快照，`None` 则只在结束时保存.
+            Defaults to None.
+    """
+    # 不分析时不需要导入
+    from utils.profiling import Profiler  # noqa: PLC0415
+
+    return Profiler(
+        mode,
+        output_dir,
+        stages=(
+            (sys.modules[__name__], "_get_api_post_data", "api_parse"),
+            (TagProcessor, "__call__", "tag_processing"),
+            (tqdm, "refresh", "progress"),
+            (TransferStats, "describe", "progress"),
+        ),
+        tracemalloc_frames=tracemalloc_frames,
+        tracemalloc_interval=tracemalloc_interval,
     )
 
-    asyncio.run(Scrape_images_coroutine)
+
+async def _run_profiled(coroutine: Awaitable[None], profiler: "Profiler") -> None:
+    async with profiler:
+        await coroutine
+
+
+##############################
+# 命令行脚本
+if __name__ == "__main__":
+    # 命令行参数在 `gelbooru.py` 中解析，这里保留原来的用法
+    from gelbooru import main
+
+    main(["download", *sys.argv[1:]])
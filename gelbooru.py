@@ -0,0 +1,631 @@
+"""命令行入口，每个子命令只在被使用时才导入它需要的模块.
+
+用法:
+    ```shell
+    python gelbooru.py download --tags "hifumi_(blue_archive)" --max_images_number 200
+    # 适合定时任务: 不等待下载前的倒计时
+    python gelbooru.py sync --tags "hifumi_(blue_archive)" --max_images_number 50
+    # 只更新已下载图片的tags
+    python gelbooru.py tags --tags "hifumi_(blue_archive)" --max_images_number 200
+    # 多台机器协同下载
+    python gelbooru.py coordinate --job_queue jobs.db --tags "hifumi_(blue_archive)"
+    python gelbooru.py worker --job_queue jobs.db
+    # 下载目录的维护工具，参数与对应模块的命令行相同
+    python gelbooru.py check images --mode 1
+    python gelbooru.py dedup images
+    python gelbooru.py stats images
+    ```
+
+不指定子命令时与 `download` 相同，所以 `download_images_coroutine.py` 原有的参数仍然可以使用.
+
+`check`、`dedup`、`stats` 不会导入httpx和pydantic；
+`download` 等只在启用校验、转换或下载后检查时才导入Pillow，只在启用近似重复过滤或tag统计时才导入numpy.
+用 `python -m benchmarks.bench_startup` 测量各子命令的启动耗时.
+"""
+
+import argparse
+import logging
+import os
+import runpy
+import sys
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+if TYPE_CHECKING:
+    from utils.postprocess import ConvertOptions
+    from utils.tag_processor import TagProcessor
+
+# 模块顶层只导入标准库中很快的模块，其余的在子命令中按需导入，
+# 所以 `check` 等工具子命令连asyncio也不会导入
+
+__all__ = (
+    "COMMANDS",
+    "main",
+)
+
+
+TOOL_MODULES = {
+    "check": ("utils.check_images", "检查并修复或删除无法读取的图片"),
+    "dedup": ("utils.near_duplicates", "查找并删除近似重复的图片，需要安装numpy"),
+    "stats": ("utils.tag_stats", "统计数据集的tag频率和共现，需要安装numpy"),
+}
+"""子命令 -> (直接以 `__main__` 运行的模块, 说明)"""
+
+
+def _query_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--tags", type=str, default="girl", help="符合gelbooru规则的tags字符串"
+    )
+    parser.add_argument(
+        "--max_images_number", type=int, default="50", help="下载图片数量"
+    )
+    parser.add_argument(
+        "--unit", type=int, default=50, help="下载单位，图片数量以此向上取一单位"
+    )
+    return parser
+
+
+def _download_dir_parser() -> argparse.ArgumentParser:
+    from utils.captions import CAPTION_FORMATS  # noqa: PLC0415
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--download_dir",
+        type=str,
+        default=os.path.join(os.getcwd(), "images"),
+        help="下载路径",
+    )
+    parser.add_argument(
+        "--caption_format",
+        type=str,
+        default="txt",
+        choices=CAPTION_FORMATS,
+        help="tags的保存格式，txt为每张图片一个同名txt文件，jsonl为追加写入captions.jsonl，json为写入kohya风格的meta_cap.json",
+    )
+    return parser
+
+
+def _tag_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--add_comma", action="store_true", help="是否在tags之间添加逗号"
+    )
+    parser.add_argument(
+        "--remove_underscore",
+        action="store_true",
+        help="是否将tags中的下划线替换为空格",
+    )
+    parser.add_argument(
+        "--use_escape", action="store_true", help="是否转义正则表达式特殊字符"
+    )
+    parser.add_argument(
+        "--tag_blacklist",
+        type=str,
+        default=None,
+        help="需要移除的tags文件路径，每行一个tag",
+    )
+    parser.add_argument(
+        "--tag_whitelist",
+        type=str,
+        default=None,
+        help="只保留的tags文件路径，每行一个tag",
+    )
+    parser.add_argument(
+        "--tag_aliases",
+        type=str,
+        default=None,
+        help="tag别名文件路径，每行为`原tag 新tag`",
+    )
+    parser.add_argument(
+        "--priority_tags",
+        type=str,
+        default=None,
+        help="需要排在最前面的tags(例如角色和画师)文件路径，每行一个tag，按文件中的顺序排列",
+    )
+    parser.add_argument(
+        "--no_deduplicate_tags",
+        action="store_true",
+        help="不移除重复的tags",
+    )
+    return parser
+
+
+def _download_parser() -> argparse.ArgumentParser:
+    from utils.postprocess import CONVERT_FORMATS  # noqa: PLC0415
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--max_workers", type=int, default=15, help="最大协程工作数")
+    parser.add_argument("--timeout", type=int, default=10, help="连接超时限制")
+    parser.add_argument(
+        "--verify_images",
+        action="store_true",
+        help="是否在下载过程中用进程池校验每张新下载的图片，校验失败会重新下载",
+    )
+    parser.add_argument(
+        "--verify_retries", type=int, default=1, help="校验失败时重新下载的最大次数"
+    )
+    parser.add_argument(
+        "--verify_workers", type=int, default=None, help="校验进程数，默认为CPU核心数"
+    )
+    parser.add_argument(
+        "--fast_verify",
+        action="store_true",
+        help="校验和检查图片时只检查容器结构而不解码像素，结构可疑时才完整解码",
+    )
+    parser.add_argument(
+        "--resize_max_side",
+        type=int,
+        default=None,
+        help="下载后将图片缩小到最长边不超过此像素数",
+    )
+    parser.add_argument(
+        "--resize_max_pixels",
+        type=int,
+        default=None,
+        help="下载后将图片缩小到总像素数(宽*高)不超过此值",
+    )
+    parser.add_argument(
+        "--convert_format",
+        type=str,
+        default=None,
+        choices=CONVERT_FORMATS,
+        help="下载后将图片转换为此格式，默认保持原有格式",
+    )
+    parser.add_argument(
+        "--convert_quality", type=int, default=90, help="转换时有损编码的质量，1~100"
+    )
+    parser.add_argument(
+        "--keep_original",
+        action="store_true",
+        help="转换为其他格式后保留原图",
+    )
+    parser.add_argument(
+        "--convert_workers", type=int, default=None, help="转换进程数，默认为CPU核心数"
+    )
+    parser.add_argument(
+        "--trace_file",
+        type=str,
+        default=None,
+        help="将每张图片各下载阶段的耗时、状态码和字节数写入的JSONL文件，用于分析下载瓶颈",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="在127.0.0.1的此端口上以Prometheus格式提供下载指标(/metrics)",
+    )
+    parser.add_argument(
+        "--file_io_workers",
+        type=int,
+        default=None,
+        help="文件读写使用的线程数，默认使用asyncio默认大小的执行器",
+    )
+    parser.add_argument(
+        "--hash_workers",
+        type=int,
+        default=None,
+        help="计算已有图片md5使用的线程数，默认与文件读写共用线程",
+    )
+    parser.add_argument(
+        "--image_mirrors",
+        type=str,
+        nargs="+",
+        default=None,
+        help="提供相同图片的服务器，例如 img3.gelbooru.com img4.gelbooru.com；根据延迟和错误率选择，失败时换用其他镜像",
+    )
+    return parser
+
+
+def _scrape_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--check_images_mode",
+        type=int,
+        default=None,
+        help="None为不检查，0表示只检查并输出信息而不做任何操作，1表示检查并尝试修复图片，2表示检查并删除无法读取的图片",
+    )
+    parser.add_argument(
+        "--bucket_resolution",
+        type=int,
+        default=None,
+        help="根据API返回的宽高预先计算宽高比分桶并写入buckets.json，此值为训练分辨率，默认不分桶",
+    )
+    parser.add_argument(
+        "--bucket_min_size", type=int, default=256, help="分桶的最小边长"
+    )
+    parser.add_argument(
+        "--bucket_max_size", type=int, default=2048, help="分桶的最大边长"
+    )
+    parser.add_argument(
+        "--bucket_step", type=int, default=64, help="分桶的边长必须是此值的倍数"
+    )
+    parser.add_argument(
+        "--near_duplicate_threshold",
+        type=int,
+        default=None,
+        help="在下载过程中删除与已有图片近似重复(dHash汉明距离不超过此值)的图片，默认不过滤，需要安装numpy",
+    )
+    parser.add_argument(
+        "--tag_stats",
+        action="store_true",
+        help="用API返回的tags统计本次抓取的tag频率和共现，需要安装numpy",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="下载进程数，大于1时各页轮流分给多个进程，每个进程有自己的事件循环和连接",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="继续下载目录中任务日志记录的上一次下载，跳过已完成的页面和图片",
+    )
+    return parser
+
+
+def _job_parser(required: bool) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--job_queue",
+        type=str,
+        default=None,
+        required=required,
+        help="多台机器协同下载时，共享存储上的任务队列(SQLite数据库)路径",
+    )
+    parser.add_argument(
+        "--worker_id",
+        type=str,
+        default=None,
+        help="工作进程标识，默认由主机名和进程号生成",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=float,
+        default=300.0,
+        help="工作进程租用页面的租约时长(秒)",
+    )
+    parser.add_argument(
+        "--reset_job", action="store_true", help="清空任务队列中已有的任务后重新创建"
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="API地址，协同下载时可以指向本地的模拟服务器用于测试，默认为gelbooru",
+    )
+    return parser
+
+
+def _runtime_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--event_loop",
+        type=str,
+        default="auto",
+        choices=("asyncio", "uvloop", "auto"),
+        help="使用的事件循环，auto为安装了uvloop时使用uvloop",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        choices=("cprofile", "sample"),
+        help="分析下载过程的性能: cprofile为确定性分析，sample为调用栈采样；同时统计事件循环延迟和分阶段CPU时间",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="性能分析结果的保存目录，默认为下载目录下的 .profile",
+    )
+    parser.add_argument(
+        "--tracemalloc_frames",
+        type=int,
+        default=0,
+        help="启用性能分析时，tracemalloc记录的栈帧数，0为不启用",
+    )
+    parser.add_argument(
+        "--tracemalloc_interval",
+        type=float,
+        default=None,
+        help="每隔多少秒保存一次tracemalloc快照，默认只在结束时保存",
+    )
+    return parser
+
+
+def _tag_processor(cmd_param: argparse.Namespace) -> "TagProcessor":
+    from utils.tag_processor import (  # noqa: PLC0415
+        TagProcessor,
+        load_tag_aliases,
+        load_tag_list,
+    )
+
+    return TagProcessor(
+        add_comma=cmd_param.add_comma,
+        remove_underscore=cmd_param.remove_underscore,
+        use_escape=cmd_param.use_escape,
+        blacklist=load_tag_list(cmd_param.tag_blacklist)
+        if cmd_param.tag_blacklist
+        else None,
+        whitelist=load_tag_list(cmd_param.tag_whitelist)
+        if cmd_param.tag_whitelist
+        else None,
+        aliases=load_tag_aliases(cmd_param.tag_aliases)
+        if cmd_param.tag_aliases
+        else None,
+        priority_tags=load_tag_list(cmd_param.priority_tags)
+        if cmd_param.priority_tags
+        else None,
+        deduplicate=not cmd_param.no_deduplicate_tags,
+    )
+
+
+def _convert_options(cmd_param: argparse.Namespace) -> Optional["ConvertOptions"]:
+    from utils.postprocess import ConvertOptions  # noqa: PLC0415
+
+    if (
+        cmd_param.resize_max_side is None
+        and cmd_param.resize_max_pixels is None
+        and cmd_param.convert_format is None
+    ):
+        return None
+    return ConvertOptions(
+        max_side=cmd_param.resize_max_side,
+        max_pixels=cmd_param.resize_max_pixels,
+        format=cmd_param.convert_format,
+        quality=cmd_param.convert_quality,
+        keep_original=cmd_param.keep_original,
+    )
+
+
+def _download_kwargs(cmd_param: argparse.Namespace) -> Dict[str, Any]:
+    """`scrape_images` 和 `run_job_worker` 共有的下载参数"""
+    return {
+        "max_workers": cmd_param.max_workers,
+        "timeout": cmd_param.timeout,
+        "tag_processor": _tag_processor(cmd_param),
+        "verify_images": cmd_param.verify_images,
+        "verify_retries": cmd_param.verify_retries,
+        "verify_workers": cmd_param.verify_workers,
+        "fast_verify": cmd_param.fast_verify,
+        "convert_options": _convert_options(cmd_param),
+        "convert_workers": cmd_param.convert_workers,
+        "trace_file": cmd_param.trace_file,
+        "metrics_port": cmd_param.metrics_port,
+        "file_io_workers": cmd_param.file_io_workers,
+        "hash_workers": cmd_param.hash_workers,
+        "image_mirrors": cmd_param.image_mirrors,
+    }
+
+
+def _base_url_kwargs(cmd_param: argparse.Namespace) -> Dict[str, Any]:
+    return {} if cmd_param.base_url is None else {"base_url": cmd_param.base_url}
+
+
+def _download(cmd_param: argparse.Namespace) -> Coroutine[Any, Any, None]:
+    # 兼容 `download_images_coroutine.py` 原有的参数
+    if cmd_param.job_role == "coordinator":
+        return _coordinate(cmd_param)
+    if cmd_param.job_role == "worker":
+        return _worker(cmd_param)
+    if cmd_param.tags_only:
+        return _refresh_tags(cmd_param)
+
+    from download_images_coroutine import scrape_images  # noqa: PLC0415
+    from utils.buckets import BucketConfig  # noqa: PLC0415
+
+    bucket_config = (
+        BucketConfig(
+            resolution=(cmd_param.bucket_resolution, cmd_param.bucket_resolution),
+            min_size=cmd_param.bucket_min_size,
+            max_size=cmd_param.bucket_max_size,
+            step=cmd_param.bucket_step,
+        )
+        if cmd_param.bucket_resolution is not None
+        else None
+    )
+    return scrape_images(
+        cmd_param.tags,
+        cmd_param.max_images_number,
+        cmd_param.download_dir,
+        unit=cmd_param.unit,
+        add_comma=cmd_param.add_comma,
+        remove_underscore=cmd_param.remove_underscore,
+        use_escape=cmd_param.use_escape,
+        check_images_mode=cmd_param.check_images_mode,
+        caption_format=cmd_param.caption_format,
+        bucket_config=bucket_config,
+        near_duplicate_threshold=cmd_param.near_duplicate_threshold,
+        tag_stats=cmd_param.tag_stats,
+        processes=cmd_param.processes,
+        resume=cmd_param.resume,
+        countdown=cmd_param.countdown,
+        **_download_kwargs(cmd_param),
+    )
+
+
+def _refresh_tags(cmd_param: argparse.Namespace) -> Coroutine[Any, Any, None]:
+    from download_images_coroutine import refresh_tags  # noqa: PLC0415
+
+    return refresh_tags(
+        cmd_param.tags,
+        cmd_param.max_images_number,
+        cmd_param.download_dir,
+        unit=cmd_param.unit,
+        add_comma=cmd_param.add_comma,
+        remove_underscore=cmd_param.remove_underscore,
+        use_escape=cmd_param.use_escape,
+        caption_format=cmd_param.caption_format,
+        tag_processor=_tag_processor(cmd_param),
+    )
+
+
+def _coordinate(cmd_param: argparse.Namespace) -> Coroutine[Any, Any, None]:
+    from download_images_coroutine import coordinate_job  # noqa: PLC0415
+
+    return coordinate_job(
+        cmd_param.tags,
+        cmd_param.max_images_number,
+        cmd_param.job_queue,
+        unit=cmd_param.unit,
+        reset=cmd_param.reset_job,
+        **_base_url_kwargs(cmd_param),
+    )
+
+
+def _worker(cmd_param: argparse.Namespace) -> Coroutine[Any, Any, None]:
+    from download_images_coroutine import run_job_worker  # noqa: PLC0415
+
+    if cmd_param.caption_format != "txt":
+        logging.warning("协同下载时tags总是保存为txt格式，--caption_format将被忽略")
+    return run_job_worker(
+        cmd_param.job_queue,
+        cmd_param.download_dir,
+        worker_id=cmd_param.worker_id,
+        lease_seconds=cmd_param.lease_seconds,
+        **_download_kwargs(cmd_param),
+        **_base_url_kwargs(cmd_param),
+    )
+
+
+COMMANDS: Dict[str, Callable[[argparse.Namespace], Coroutine[Any, Any, None]]] = {
+    "download": _download,
+    "sync": _download,
+    "tags": _refresh_tags,
+    "coordinate": _coordinate,
+    "worker": _worker,
+}
+"""在事件循环中运行的子命令 -> 创建其协程的函数"""
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    query = _query_parser()
+    download_dir = _download_dir_parser()
+    tag = _tag_parser()
+    download = _download_parser()
+    scrape = _scrape_parser()
+    runtime = _runtime_parser()
+
+    parser = argparse.ArgumentParser(
+        description="Gelbooru-API-Downloader，不指定子命令时为download"
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+    download_parser = subparsers.add_parser(
+        "download",
+        parents=[
+            query,
+            download_dir,
+            tag,
+            download,
+            scrape,
+            _job_parser(False),
+            runtime,
+        ],
+        help="查询API并下载图片和tags",
+    )
+    download_parser.add_argument(
+        "--tags_only",
+        action="store_true",
+        help="只为下载目录中已有的图片更新tags，不下载也不校验图片，与tags子命令相同",
+    )
+    download_parser.add_argument(
+        "--job_role",
+        type=str,
+        default=None,
+        choices=("coordinator", "worker"),
+        help="与coordinate和worker子命令相同，需要同时指定--job_queue",
+    )
+    download_parser.set_defaults(countdown=None)
+
+    sync_parser = subparsers.add_parser(
+        "sync",
+        parents=[query, download_dir, tag, download, scrape, runtime],
+        help="与download相同，但不等待下载前的倒计时，适合定时任务",
+    )
+    sync_parser.set_defaults(countdown=0, tags_only=False, job_role=None)
+
+    subparsers.add_parser(
+        "tags",
+        parents=[query, download_dir, tag, runtime],
+        help="只为下载目录中已有的图片更新tags，不下载也不校验图片",
+    )
+    subparsers.add_parser(
+        "coordinate",
+        parents=[query, _job_parser(True), runtime],
+        help="在任务队列中创建协同下载的任务并等待完成",
+    )
+    subparsers.add_parser(
+        "worker",
+        parents=[download_dir, tag, download, _job_parser(True), runtime],
+        help="从任务队列中租用页面并下载",
+    )
+    for command, (module, help_str) in TOOL_MODULES.items():
+        subparsers.add_parser(
+            command, add_help=False, help=f"{help_str}，参数见 python -m {module} -h"
+        )
+    return parser
+
+
+def _run_tool(command: str, argv: Sequence[str]) -> None:
+    module = TOOL_MODULES[command][0]
+    sys.argv = [module, *argv]
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """解析命令行参数并运行子命令
+
+    Args:
+        argv: 命令行参数，`None` 则为 `sys.argv[1:]`. Defaults to None.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in TOOL_MODULES:
+        _run_tool(argv[0], argv[1:])
+        return
+
+    parser = _build_parser()
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        argv = ["download", *argv]
+    cmd_param, unknown = parser.parse_known_args(argv)
+
+    if unknown:
+        logging.error(f"以下输入参数非法，将被忽略：\n{unknown}")
+    if cmd_param.command == "download" and (cmd_param.job_queue is None) != (
+        cmd_param.job_role is None
+    ):
+        parser.error("--job_queue 和 --job_role 需要同时指定")
+
+    coroutine = COMMANDS[cmd_param.command](cmd_param)
+
+    if cmd_param.profile is not None:
+        from download_images_coroutine import _run_profiled, profile_download  # noqa: PLC0415
+
+        coroutine = _run_profiled(
+            coroutine,
+            profile_download(
+                cmd_param.profile,
+                cmd_param.profile_dir
+                or os.path.join(getattr(cmd_param, "download_dir", "."), ".profile"),
+                tracemalloc_frames=cmd_param.tracemalloc_frames,
+                tracemalloc_interval=cmd_param.tracemalloc_interval,
+            ),
+        )
+
+    from utils.executors import run  # noqa: PLC0415
+
+    run(coroutine, cmd_param.event_loop)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,51 @@ $use_escape = 1    # 是否对括号进行转义 | whether to escape parentheses
 # whether to check images, -1 for not checking, 0 for only showing error messages, 1 for trying to fix images, 2 for deleting error images
 $check_images_mode = -1
 
+# tags的保存格式，txt为每张图片一个同名txt文件，jsonl为追加写入captions.jsonl，json为写入kohya风格的meta_cap.json |
+# format for saving tags, txt for one txt file per image, jsonl for appending to captions.jsonl, json for kohya-style meta_cap.json
+$caption_format = "txt"
+
+$tags_only = 0    # 是否只为已下载的图片更新tags，不下载图片 | whether to only refresh tags of downloaded images without downloading
+
+# 下载后缩放和转换图片，0或空字符串为不启用 | resize and convert images after downloading, 0 or empty string to disable
+$resize_max_side = 0    # 最长边的最大像素数 | maximum pixels of the longest side
+$convert_format = ""    # 转换格式，webp或jpeg | target format, webp or jpeg
+$convert_quality = 90    # 有损编码质量 | quality of lossy encoding
+$keep_original = 0    # 转换格式后是否保留原图 | whether to keep original images after converting
+
+# 根据API返回的宽高预先分桶并写入buckets.json，此值为训练分辨率，0为不分桶 |
+# precompute aspect ratio buckets from API width/height into buckets.json, value is training resolution, 0 to disable
+$bucket_resolution = 0
+
+# 删除与已有图片近似重复的新图片，此值为dHash汉明距离阈值，-1为不过滤，需要安装numpy |
+# delete new images that are near-duplicates of existing ones, value is dHash hamming distance threshold, -1 to disable, requires numpy
+$near_duplicate_threshold = -1
+
+# 下载进程数，大于1时各页轮流分给多个进程 | number of download processes, pages are split round-robin when greater than 1
+$processes = 1
+
+# 继续上次被中断的下载，跳过已完成的页面和图片 | resume the last interrupted download, skipping finished pages and images
+$resume = 0
+
+# 记录每张图片各下载阶段耗时的JSONL文件，为空则不记录 | JSONL file recording per-image download phase timings, empty to disable
+$trace_file = ""
+
+# 在127.0.0.1的此端口上提供Prometheus格式的下载指标，0为不提供 | serve Prometheus download metrics on this 127.0.0.1 port, 0 to disable
+$metrics_port = 0
+
+# 性能分析模式，"cprofile" 或 "sample"，为空则不分析，结果保存在下载目录下的 .profile | profile mode, "cprofile" or "sample", empty to disable, results saved in .profile under the download dir
+$profile_mode = ""
+
+# 性能分析时tracemalloc记录的栈帧数，0为不启用 | tracemalloc frames recorded while profiling, 0 to disable
+$tracemalloc_frames = 0
+
+# 文件读写和计算md5的线程数，0为使用默认执行器 | threads for file I/O and md5 hashing, 0 to use the default executor
+$file_io_workers = 0
+$hash_workers = 0
+
+# 提供相同图片的服务器，根据延迟和错误率选择，失败时换用其他镜像，为空则不启用 | equivalent image hosts chosen by latency and error rate with failover, empty to disable
+$image_mirrors = @()  # e.g. @("img3.gelbooru.com", "img4.gelbooru.com")
+
 
 ##########  你可以在这找到tags规则 some useful info for tags   ##########
 <# 
@@ -36,17 +81,65 @@ if ($remove_underscore) {
 if ($use_escape) {
   [void]$ext_args.Add("--use_escape")
 }
+if ($tags_only) {
+  [void]$ext_args.Add("--tags_only")
+}
+if ($resize_max_side -gt 0) {
+  [void]$ext_args.Add("--resize_max_side=$resize_max_side")
+}
+if ($convert_format) {
+  [void]$ext_args.Add("--convert_format=$convert_format")
+}
+if ($keep_original) {
+  [void]$ext_args.Add("--keep_original")
+}
+if ($bucket_resolution -gt 0) {
+  [void]$ext_args.Add("--bucket_resolution=$bucket_resolution")
+}
+if ($near_duplicate_threshold -ge 0) {
+  [void]$ext_args.Add("--near_duplicate_threshold=$near_duplicate_threshold")
+}
+if ($resume) {
+  [void]$ext_args.Add("--resume")
+}
+if ($trace_file) {
+  [void]$ext_args.Add("--trace_file=$trace_file")
+}
+if ($metrics_port -gt 0) {
+  [void]$ext_args.Add("--metrics_port=$metrics_port")
+}
+if ($profile_mode) {
+  [void]$ext_args.Add("--profile=$profile_mode")
+}
+if ($tracemalloc_frames -gt 0) {
+  [void]$ext_args.Add("--tracemalloc_frames=$tracemalloc_frames")
+}
+if ($file_io_workers -gt 0) {
+  [void]$ext_args.Add("--file_io_workers=$file_io_workers")
+}
+if ($hash_workers -gt 0) {
+  [void]$ext_args.Add("--hash_workers=$hash_workers")
+}
+if ($image_mirrors.Count -gt 0) {
+  [void]$ext_args.Add("--image_mirrors")
+  [void]$ext_args.AddRange($image_mirrors)
+}
+if ($processes -gt 1) {
+  [void]$ext_args.Add("--processes=$processes")
+}
 if ($check_images_mode -ge 0) {
   [void]$ext_args.Add("--check_images_mode=$check_images_mode")
 }
 
-python download_images_coroutine.py `
+python gelbooru.py download `
   --tags=$tags `
   --max_images_number=$max_images_number `
   --download_dir=$download_dir `
   --max_workers=$max_workers `
   --unit=$unit `
   --timeout=$timeout `
+  --caption_format=$caption_format `
+  --convert_quality=$convert_quality `
   $ext_args
   
 pause
@@ -0,0 +1,47 @@
+"""批量追加写入JSONL文件的工具."""
+
+import asyncio
+import json
+from typing import Any, Dict, List
+
+import aiofiles
+
+__all__ = ("BatchedJsonlWriter",)
+
+
+class BatchedJsonlWriter:
+    """将记录缓存在内存中，每累计 `batch_size` 条才追加写入一次JSONL文件.
+
+    所有方法都应该在同一个事件循环中调用.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        """批量JSONL写入器
+
+        Args:
+            path: JSONL文件路径，不存在时会被创建，存在时追加写入.
+            batch_size: 缓存多少条记录后写入一次. Defaults to 1000.
+        """
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self._buffer: List[str] = []
+        self._lock = asyncio.Lock()
+
+    async def write(self, record: Dict[str, Any]) -> None:
+        """缓存一条记录，缓存满时写入文件"""
+        self._buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """将缓存中的全部记录写入文件"""
+        if not self._buffer:
+            return
+        # 先交换缓存，写入期间到来的新记录会进入新的缓存
+        lines, self._buffer = self._buffer, []
+        async with self._lock, aiofiles.open(self.path, "a", encoding="utf-8") as f:
+            await f.write("".join(lines))
+
+    async def close(self) -> None:
+        """写入剩余的记录"""
+        await self.flush()
@@ -3,9 +3,11 @@
 @author: WSH
 """
 
+import os
 from pathlib import Path
+from typing import Iterator, Union
 
-__all__ = ("IMAGE_EXTENSION", "search_img_files")
+__all__ = ("IMAGE_EXTENSION", "scan_img_files", "search_img_files")
 
 
 IMAGE_EXTENSION = {
@@ -87,3 +89,17 @@ def search_img_files(search_dir: Path) -> list[Path]:
         return file.suffix.lower() in IMAGE_EXTENSION and file.is_file()
 
     return list(filter(is_image_file, search_dir.iterdir()))
+
+
+def scan_img_files(search_dir: Union[str, Path]) -> Iterator["os.DirEntry[str]"]:
+    """用 `os.scandir` 惰性地遍历目录下已注册的扩展名的所有图片.
+
+    与 `search_img_files` 不同，这里不会为每个文件额外调用一次 `stat`，适合图片很多的目录.
+    """
+    with os.scandir(search_dir) as it:
+        for entry in it:
+            if (
+                os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSION
+                and entry.is_file()
+            ):
+                yield entry
@@ -0,0 +1,192 @@
+"""根据图片尺寸预先计算kohya风格的宽高比分桶(aspect ratio bucketing).
+
+Gelbooru API会返回每张图片的宽和高，所以不需要打开图片就可以完成分桶.
+桶的生成和分配规则与 [sd-scripts](https://github.com/kohya-ss/sd-scripts) 的
+`make_bucket_resolutions` 和 `BucketManager.select_bucket` 一致:
+按宽高比选择最接近的桶.
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+__all__ = (
+    "BUCKET_INDEX_FILE_NAME",
+    "BucketConfig",
+    "BucketIndex",
+    "make_bucket_resolutions",
+)
+
+
+BUCKET_INDEX_FILE_NAME = "buckets.json"
+
+
+class BucketConfig(NamedTuple):
+    """分桶参数，含义与sd-scripts的同名参数一致"""
+
+    resolution: Tuple[int, int] = (1024, 1024)
+    """训练分辨率(宽, 高)，桶的面积不超过 `宽*高`"""
+    min_size: int = 256
+    """桶的最小边长"""
+    max_size: int = 2048
+    """桶的最大边长"""
+    step: int = 64
+    """桶的边长必须是此值的倍数"""
+
+
+def make_bucket_resolutions(config: BucketConfig) -> List[Tuple[int, int]]:
+    """生成所有桶的分辨率，按(宽, 高)排序"""
+    max_width, max_height = config.resolution
+    max_area = max_width * max_height
+    step = config.step
+
+    resolutions = set()
+    width = int(math.sqrt(max_area) // step) * step
+    resolutions.add((width, width))
+
+    width = config.min_size
+    while width <= config.max_size:
+        height = min(config.max_size, int((max_area // width) // step) * step)
+        if height >= config.min_size:
+            resolutions.add((width, height))
+            resolutions.add((height, width))
+        width += step
+
+    return sorted(resolutions)
+
+
+class BucketIndex:
+    """宽高比分桶索引，写入下载目录下的 `buckets.json`
+
+    下载过程中只记录每张图片的尺寸，关闭时再一次性为所有图片分桶并写入文件.
+    文件中包括分桶参数、每个桶的图片数和图片列表，以及每张图片的尺寸和所属的桶.
+    打开时会读取已有文件中的图片尺寸，所以多次下载到同一目录时索引会覆盖全部图片.
+
+    用法:
+        ```python
+        async with BucketIndex("images/buckets.json") as index:
+            index.add("1.jpg", 832, 1216)
+        ```
+    """
+
+    def __init__(self, path: str, config: Optional[BucketConfig] = None):
+        """宽高比分桶索引
+
+        Args:
+            path: 索引文件路径
+            config: 分桶参数，`None` 则使用 `BucketConfig()` 的默认值. Defaults to None.
+        """
+        self.path = path
+        self.config = config if config is not None else BucketConfig()
+        self.resolutions = make_bucket_resolutions(self.config)
+
+        # 按宽高比排序，用二分查找选择最接近的桶
+        by_ratio = sorted(self.resolutions, key=lambda reso: reso[0] / reso[1])
+        self._ratios = [width / height for width, height in by_ratio]
+        self._sorted_resolutions = by_ratio
+
+        self._sizes: Dict[str, Tuple[int, int]] = {}
+        self._dirty = False
+
+    def assign(self, width: int, height: int) -> Tuple[int, int]:
+        """为尺寸为 `width*height` 的图片选择宽高比最接近的桶"""
+        ratio = width / height
+        ratios = self._ratios
+        i = bisect.bisect_left(ratios, ratio)
+        if i == len(ratios) or (i > 0 and ratio - ratios[i - 1] <= ratios[i] - ratio):
+            i -= 1
+        return self._sorted_resolutions[i]
+
+    def add(self, file_name: str, width: int, height: int) -> None:
+        """记录一张图片的尺寸，分桶在 `close` 时进行
+
+        Args:
+            file_name: 图片文件名(相对于下载目录)
+            width: 图片宽度
+            height: 图片高度
+        """
+        if width <= 0 or height <= 0:
+            return
+        if self._sizes.get(file_name) != (width, height):
+            self._sizes[file_name] = (width, height)
+            self._dirty = True
+
+    def _config_json(self) -> Dict[str, object]:
+        return {**self.config._asdict(), "resolution": list(self.config.resolution)}
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        self._sizes = {
+            name: (item["size"][0], item["size"][1])
+            for name, item in index.get("images", {}).items()
+        }
+        # 分桶参数改变时，即使没有新图片也需要重新分桶
+        self._dirty = index.get("config") != self._config_json()
+
+    def _build(self) -> Dict[str, object]:
+        images: Dict[str, Dict[str, List[int]]] = {}
+        buckets: Dict[Tuple[int, int], List[str]] = {
+            reso: [] for reso in self.resolutions
+        }
+        for name in sorted(self._sizes):
+            size = self._sizes[name]
+            bucket = self.assign(*size)
+            images[name] = {"size": list(size), "bucket": list(bucket)}
+            buckets[bucket].append(name)
+
+        return {
+            "config": self._config_json(),
+            "buckets": [
+                {
+                    "resolution": list(reso),
+                    "aspect_ratio": round(reso[0] / reso[1], 4),
+                    "count": len(files),
+                    "files": files,
+                }
+                for reso, files in buckets.items()
+                if files
+            ],
+            "images": images,
+        }
+
+    def _dump(self) -> None:
+        # 先写入临时文件再替换，避免中途退出时损坏已有的索引
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._build(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    async def open(self) -> None:
+        """读取已有索引中的图片尺寸"""
+        self._sizes = {}
+        self._dirty = False
+        await asyncio.to_thread(self._load)
+
+    async def close(self) -> None:
+        """为所有图片分桶并写入索引文件，没有新图片时跳过"""
+        await self.flush()
+
+    async def flush(self) -> None:
+        """与 `close` 相同，之后仍然可以继续添加图片"""
+        if not self._dirty:
+            return
+        try:
+            await asyncio.to_thread(self._dump)
+            self._dirty = False
+        except Exception as e:
+            logging.error(f"写入分桶索引 {self.path} 时发生错误, error: {e}")
+
+    async def __aenter__(self):  # noqa: D105
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:  # noqa: D105
+        await self.close()
@@ -0,0 +1,286 @@
+"""图片tags(caption)的写入器.
+
+- `TxtCaptionSink`: 每张图片一个同名 `.txt` 文件，内容未改变时不会重写
+- `JsonlCaptionSink`: 所有caption追加写入同一个JSONL文件
+- `KohyaJsonCaptionSink`: 所有caption写入同一个kohya风格的metadata json文件
+"""
+
+import asyncio
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, Literal, Optional
+
+import aiofiles
+import aiofiles.os
+
+from utils._jsonl import BatchedJsonlWriter
+
+__all__ = (
+    "CAPTION_FORMATS",
+    "CaptionSink",
+    "JsonlCaptionSink",
+    "KohyaJsonCaptionSink",
+    "TxtCaptionSink",
+    "make_caption_sink",
+    "write_caption_txt",
+)
+
+
+CAPTION_FORMATS = ("txt", "jsonl", "json")
+"""`make_caption_sink` 支持的caption格式"""
+
+JSONL_CAPTION_FILE_NAME = "captions.jsonl"
+KOHYA_JSON_CAPTION_FILE_NAME = "meta_cap.json"
+
+
+async def write_caption_txt(tags: str, txt_path: str) -> Literal[0, 1]:
+    """异步地将 `tags` 的内容以utf-8编码写入 `txt_path`，内容相同时跳过写入.
+
+    Args:
+        tags: 字符串内容
+        txt_path: 写入路径
+
+    Returns:
+        成功(包括内容未改变而跳过)返回1， 异常返回0
+    """
+    data = tags.encode("utf-8")
+    try:
+        try:
+            async with aiofiles.open(txt_path, "rb") as f:
+                if await f.read() == data:
+                    return 1
+        except FileNotFoundError:
+            pass
+
+        async with aiofiles.open(txt_path, "wb") as f:
+            await f.write(data)
+        return 1
+
+    except Exception as e:
+        logging.error(f"将tags写入 {txt_path} 时发生错误, error: {e}")
+        return 0
+
+
+class CaptionSink(ABC):
+    """caption写入器基类，子类必须实现 `write` 和 `remove`
+
+    用法:
+        ```python
+        async with TxtCaptionSink() as sink:
+            await sink.write("images/1.jpg", "1girl, solo")
+        ```
+    """
+
+    async def open(self) -> None:  # noqa: B027
+        """准备写入，例如读取已有的caption文件"""
+
+    @abstractmethod
+    async def write(self, image_path: str, tags: str) -> Literal[0, 1]:
+        """写入 `image_path` 对应图片的caption
+
+        Args:
+            image_path: 图片路径
+            tags: tags字符串
+
+        Returns:
+            成功返回1， 异常返回0
+        """
+
+    @abstractmethod
+    async def remove(self, image_path: str) -> None:
+        """移除 `image_path` 对应图片的caption，例如图片被判定为近似重复而删除时"""
+
+    async def flush(self) -> None:  # noqa: B027
+        """写入所有已缓存的caption，例如在任务日志把一页记为完成之前"""
+
+    async def close(self) -> None:  # noqa: B027
+        """写入所有尚未写入的caption"""
+
+    async def __aenter__(self):  # noqa: D105
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:  # noqa: D105
+        await self.close()
+
+
+class TxtCaptionSink(CaptionSink):
+    """每张图片写一个同名的 `.txt` 文件，内容未改变的文件会被跳过"""
+
+    @staticmethod
+    def txt_path(image_path: str) -> str:
+        """图片对应的caption文本路径"""
+        return os.path.splitext(image_path)[0] + ".txt"
+
+    async def write(self, image_path: str, tags: str) -> Literal[0, 1]:  # noqa: D102
+        return await write_caption_txt(tags, self.txt_path(image_path))
+
+    async def remove(self, image_path: str) -> None:  # noqa: D102
+        try:
+            await aiofiles.os.remove(self.txt_path(image_path))
+        except FileNotFoundError:
+            pass
+
+
+class JsonlCaptionSink(CaptionSink):
+    """将所有caption追加写入同一个JSONL文件
+
+    每行一个 `{"file": 图片文件名, "tags": tags字符串}` 记录，同一个文件名以最后一行为准，
+    `tags` 为 `null` 表示该图片的caption已被移除.
+    打开时会读取已有的记录，caption未改变的图片不会再被追加.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        """JSONL caption写入器
+
+        Args:
+            path: JSONL文件路径
+            batch_size: 缓存多少条记录后写入一次. Defaults to 1000.
+        """
+        self.path = path
+        self._writer = BatchedJsonlWriter(path, batch_size=batch_size)
+        self._captions: Dict[str, str] = {}
+
+    def _load(self) -> Dict[str, str]:
+        captions: Dict[str, str] = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 上次运行中断时可能残留不完整的最后一行
+                        continue
+                    if record["tags"] is None:
+                        captions.pop(record["file"], None)
+                    else:
+                        captions[record["file"]] = record["tags"]
+        except FileNotFoundError:
+            pass
+        return captions
+
+    async def open(self) -> None:  # noqa: D102
+        self._captions = await asyncio.to_thread(self._load)
+
+    async def write(self, image_path: str, tags: str) -> Literal[0, 1]:  # noqa: D102
+        file = os.path.basename(image_path)
+        if self._captions.get(file) == tags:
+            return 1
+        self._captions[file] = tags
+        try:
+            await self._writer.write({"file": file, "tags": tags})
+            return 1
+        except Exception as e:
+            logging.error(f"将tags写入 {self.path} 时发生错误, error: {e}")
+            return 0
+
+    async def remove(self, image_path: str) -> None:  # noqa: D102
+        file = os.path.basename(image_path)
+        self._captions.pop(file, None)
+        await self._writer.write({"file": file, "tags": None})
+
+    async def flush(self) -> None:  # noqa: D102
+        await self._writer.flush()
+
+    async def close(self) -> None:  # noqa: D102
+        await self._writer.close()
+
+
+class KohyaJsonCaptionSink(CaptionSink):
+    """将所有caption写入同一个kohya风格的metadata json文件
+
+    格式为 `{图片文件名去掉扩展名: {"tags": tags字符串}}`，
+    可以直接作为 [sd-scripts](https://github.com/kohya-ss/sd-scripts) 的 `in_json` 使用.
+    已有文件中的其他字段会被保留；只有内容改变时，才会在 `flush` 或关闭时整体重写一次文件.
+    """
+
+    def __init__(self, path: str):
+        """Kohya metadata json写入器
+
+        Args:
+            path: json文件路径
+        """
+        self.path = path
+        self._metadata: Dict[str, Dict[str, object]] = {}
+        self._dirty = False
+
+    def _load(self) -> Dict[str, Dict[str, object]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _dump(self) -> None:
+        # 先写入临时文件再替换，避免中途退出时损坏已有的metadata
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._metadata, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def image_key(image_path: str) -> str:
+        """图片在metadata中的键"""
+        return os.path.splitext(os.path.basename(image_path))[0]
+
+    async def open(self) -> None:  # noqa: D102
+        self._metadata = await asyncio.to_thread(self._load)
+
+    async def write(self, image_path: str, tags: str) -> Literal[0, 1]:  # noqa: D102
+        item = self._metadata.setdefault(self.image_key(image_path), {})
+        if item.get("tags") != tags:
+            item["tags"] = tags
+            self._dirty = True
+        return 1
+
+    async def remove(self, image_path: str) -> None:  # noqa: D102
+        if self._metadata.pop(self.image_key(image_path), None) is not None:
+            self._dirty = True
+
+    async def flush(self) -> None:  # noqa: D102
+        if not self._dirty:
+            return
+        try:
+            await asyncio.to_thread(self._dump)
+            self._dirty = False
+        except Exception as e:
+            logging.error(f"将tags写入 {self.path} 时发生错误, error: {e}")
+
+    async def close(self) -> None:  # noqa: D102
+        await self.flush()
+
+
+def make_caption_sink(
+    caption_format: str,
+    download_dir: str,
+    file_name: Optional[str] = None,
+) -> CaptionSink:
+    """根据 `caption_format` 创建caption写入器.
+
+    Args:
+        caption_format: `CAPTION_FORMATS` 中的一个.
+            - "txt": 每张图片一个同名 `.txt` 文件
+            - "jsonl": 所有caption追加写入 `download_dir` 下的 `captions.jsonl`
+            - "json": 所有caption写入 `download_dir` 下kohya风格的 `meta_cap.json`
+        download_dir: 下载目录.
+        file_name: "jsonl" 和 "json" 格式使用的文件名，`None` 则使用默认文件名. Defaults to None.
+
+    Raises:
+        ValueError: `caption_format` 不合法
+
+    Returns:
+        caption写入器，使用前需要 `await sink.open()` 或者 `async with sink`
+    """
+    if caption_format == "txt":
+        return TxtCaptionSink()
+    if caption_format == "jsonl":
+        return JsonlCaptionSink(
+            os.path.join(download_dir, file_name or JSONL_CAPTION_FILE_NAME)
+        )
+    if caption_format == "json":
+        return KohyaJsonCaptionSink(
+            os.path.join(download_dir, file_name or KOHYA_JSON_CAPTION_FILE_NAME)
+        )
+    raise ValueError(f"caption_format参数非法，只能为{CAPTION_FORMATS}中的一个")
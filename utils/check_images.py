@@ -2,16 +2,28 @@
 
 import argparse
 import concurrent.futures
+import functools
+import json
 import logging
 import os
+import shutil
+import tempfile
+import time
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Generator, List, Tuple, Union
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 from PIL import Image, ImageFile
 from tqdm import tqdm
 
-from utils._tools import search_img_files
+from utils._tools import scan_img_files
+from utils.image_structure import check_structure
+from utils.pipeline import imap_unordered_bounded
+
+VERIFIED_CACHE_FILE_NAME = ".check_images_cache.json"
+"""`check_images` 的检查缓存文件名"""
+
+_PROCESS_BATCH_SIZE = 32
 
 
 def delete_files(
@@ -37,18 +49,62 @@ def delete_files(
     return failed_delete_files_list, success_delete_files_list
 
 
+def _format_preserving_save_kwargs(image: Image.Image) -> Dict[str, Any]:
+    """尽量保持原有格式和编码参数的 `Image.save` 参数"""
+    kwargs: Dict[str, Any] = {
+        key: image.info[key]
+        for key in ("icc_profile", "exif", "dpi", "transparency", "duration", "loop")
+        if key in image.info
+    }
+    if image.format == "JPEG":
+        # 沿用原图的量化表和色度抽样，而不是用默认的质量75重新编码
+        kwargs.update(quality="keep", subsampling="keep")
+    elif image.format == "WEBP":
+        kwargs.update(quality=100, lossless=bool(image.info.get("lossless")))
+    if getattr(image, "is_animated", False):
+        kwargs["save_all"] = True
+    return kwargs
+
+
 def _try_fix(image_path: str) -> Union[None, Tuple[str, Exception]]:
-    """尝试修复图片，修复成功返回None，修复失败返回tuple(图片路径, 错误信息)"""
+    """尝试修复图片，修复成功返回None，修复失败返回tuple(图片路径, 错误信息)
+
+    修复后的图片先写入同一目录下的临时文件，再原子地替换原图，
+    所以中途崩溃不会破坏原图.
+    """
+    tmp_path = None
     try:
         with Image.open(image_path) as image:
-            image.save(image_path)
-            return None
+            image_format = image.format
+            save_kwargs = _format_preserving_save_kwargs(image)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=".fixing-",
+                suffix=os.path.splitext(image_path)[1],
+                dir=os.path.dirname(image_path) or None,
+            )
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format=image_format, **save_kwargs)
+        # mkstemp创建的文件权限为0600，替换前恢复原图的权限
+        shutil.copymode(image_path, tmp_path)
+        # 必须在原图关闭之后再替换，否则在Windows上会失败
+        os.replace(tmp_path, image_path)
+        return None
     except Exception as e:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
         return (image_path, e)
 
 
+def _allow_truncated_imgs() -> None:
+    """进程池的initializer，允许子进程读取截断的图片"""
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
 @contextmanager
-def _allow_truncated_imgs_temporarily(is_allowed: bool) -> Generator[None]:
+def _allow_truncated_imgs_temporarily(is_allowed: bool) -> Iterator[None]:
     """临时允许截断的图片"""
     ori_set = ImageFile.LOAD_TRUNCATED_IMAGES
     ImageFile.LOAD_TRUNCATED_IMAGES = is_allowed
@@ -60,97 +116,241 @@ def fix_images(
     images_list: List[str],
     max_workers: Union[int, None] = None,
 ) -> Tuple[List[Tuple[str, Exception]], List[str]]:
-    """修复图片列表中的所有图片.
+    """用进程池修复图片列表中的所有图片.
 
-    Note: 这个函数不是线程安全的，会修改 `PIL.ImageFile.LOAD_TRUNCATED_IMAGES` 的值.
+    每张图片会以原有格式和尽量相同的编码参数重新保存，
+    先写入临时文件再原子地替换原图.
 
     Args:
         images_list: 要修复的图片列表
-        max_workers: 用于修复的并发线程数
+        max_workers: 用于修复的并发进程数
 
     Returns:
-        返回tuple(修复失败的文件路径和错误元组列表, 删除成功的文件路径列表)
+        返回tuple(修复失败的文件路径和错误元组列表, 修复成功的文件路径列表)
     """
-    # 应当考虑复用主线程中创建的线程池，而不是在这个函数中新建一个进程池，
-    # 但是这样需要加更多逻辑，我有点懒得弄现在
-    with _allow_truncated_imgs_temporarily(True), concurrent.futures.ThreadPoolExecutor(
-        max_workers=max_workers
-    ) as executor:
-        futures_list = [
-            executor.submit(_try_fix, image_path) for image_path in images_list
-        ]
+    failed_fix_images_list = []
+    success_fix_images_list = []
+    if not images_list:
+        return failed_fix_images_list, success_fix_images_list
 
-        # 获取结果
-        failed_fix_images_list = []
-        success_fix_images_list = []
-        for future in concurrent.futures.as_completed(futures_list):
-            result = future.result()
+    start_time = time.perf_counter()
+    # 只在子进程中允许截断的图片，不会修改本进程的 `PIL.ImageFile.LOAD_TRUNCATED_IMAGES`
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_allow_truncated_imgs
+    ) as executor:
+        results = imap_unordered_bounded(
+            executor,
+            _try_fix,
+            images_list,
+            max_pending=4 * (max_workers or os.cpu_count() or 1),
+        )
+        for image_path, result in tqdm(
+            results, total=len(images_list), desc="修复图片中"
+        ):
             if result is None:
                 # 修复成功就记录该图片的路径
-                success_fix_images_list.append(images_list[futures_list.index(future)])
+                success_fix_images_list.append(image_path)
             else:
                 # 修复失败就记录tuple(图片绝对路径, 错误信息)
                 failed_fix_images_list.append(result)
+    elapsed = time.perf_counter() - start_time
+
+    print(
+        f"修复{len(images_list)}张图片用时{elapsed:.2f}秒，"
+        f"{len(images_list) / elapsed:.1f}张/秒"
+    )
 
     return failed_fix_images_list, success_fix_images_list
 
 
-def try_read(image_path: Path) -> Union[None, Tuple[str, Exception]]:
+def try_read(
+    image_path: Path, fast: bool = False
+) -> Union[None, Tuple[str, Exception]]:
     """尝试读取图片.
 
     Args:
         image_path: 图片路径
+        fast: 是否先只检查容器结构，结构可疑时才完整解码. Defaults to False.
 
     Returns:
         如果成功返回None，否则返回(图片名字, 错误信息).
         注意，返回的是不带路径的图片名字！
     """
-    with Image.open(image_path) as image:
-        try:
+    try:
+        # 图片可能在检查过程中被删除或无法读取，所以结构检查也要放在try中
+        if fast and check_structure(image_path) is None:
+            return None
+        # 截断严重的图片在打开时就会出错，所以open也要放在try中
+        with Image.open(image_path) as image:
             image.load()
             return None
-        except (OSError, SyntaxError) as e:
-            return (os.path.basename(image_path), e)
+    except (OSError, SyntaxError) as e:
+        return (os.path.basename(image_path), e)
+
+
+def _try_read_batch(
+    image_paths: List[str], fast: bool
+) -> List[Union[None, Tuple[str, Exception]]]:
+    """对一批图片调用 `try_read`，减少进程池的任务调度开销"""
+    return [try_read(Path(image_path), fast) for image_path in image_paths]
+
 
+def _disallow_truncated_imgs() -> None:
+    """进程池的initializer，保证子进程能检测到截断"""
+    ImageFile.LOAD_TRUNCATED_IMAGES = False
+
+
+class _VerifiedCache:
+    """已经通过检查的图片的持久化缓存.
+
+    以文件名为键，记录通过检查时的文件大小、修改时间，以及是否经过了完整解码.
+    大小或修改时间改变的文件会被重新检查，快速检查的结果不能代替完整解码.
+    """
+
+    def __init__(self, images_dir: str):
+        self.path = os.path.join(images_dir, VERIFIED_CACHE_FILE_NAME)
+        self._files: Dict[str, List[int]] = {}
+        self._seen: Set[str] = set()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._files = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"无法读取检查缓存 {self.path}，将重新检查所有图片, error: {e}")
+
+    def is_verified(self, name: str, stat: os.stat_result, fast: bool) -> bool:
+        """文件自上次通过检查以来是否没有改变"""
+        self._seen.add(name)
+        record = self._files.get(name)
+        return (
+            record is not None
+            and record[0] == stat.st_size
+            and record[1] == stat.st_mtime_ns
+            and (fast or bool(record[2]))
+        )
 
-def check_images(  # noqa: C901, PLR0912
+    def add(self, name: str, stat: os.stat_result, fast: bool) -> None:
+        """记录通过检查的文件"""
+        self._files[name] = [stat.st_size, stat.st_mtime_ns, int(not fast)]
+
+    def save(self) -> None:
+        """保存缓存，本次没有遍历到的文件(已被删除)会被移除"""
+        files = {name: v for name, v in self._files.items() if name in self._seen}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(files, f)
+        os.replace(tmp_path, self.path)
+
+
+def verify_image(image_path: str, fast: bool = False) -> Optional[str]:
+    """解码一张图片以检查其是否损坏，可以在进程池中运行.
+
+    Args:
+        image_path: 图片路径
+        fast: 是否先只检查容器结构，结构可疑时才完整解码. Defaults to False.
+
+    Returns:
+        成功返回None，否则返回错误信息字符串
+    """
+    try:
+        if fast and check_structure(image_path) is None:
+            return None
+        with Image.open(image_path) as image:
+            image.load()
+        return None
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def check_images(  # noqa: C901, PLR0912, PLR0915
     images_dir: str,
     mode: int = 0,
     debug: bool = False,
     max_workers: Union[int, None] = None,
+    fast: bool = False,
+    engine: str = "thread",
+    use_cache: bool = False,
 ) -> Tuple[List[Tuple[str, Exception]], List[str]]:
     """检查时候能正确读取images_dir目录下的图片
 
     iamges_dir: 要检查的目录
     mode: 0表示只检查，1表示检查并尝试修复，2表示检查并删除无法读取的图片
     debug: 是否打印详细信息
-    max_workers: 线程池最大线程数
+    max_workers: 线程池或进程池的最大并发数
+    fast: 是否只检查图片的容器结构(如JPEG的EOI、PNG的IEND和CRC、GIF的trailer)，
+        只有结构可疑或者不支持的格式才完整解码. 这会快得多，但无法发现像素数据本身的损坏
+    engine: "thread"表示用线程池检查；"process"表示用进程池检查，解码不再受GIL限制
+    use_cache: 是否使用images_dir下的检查缓存，跳过上次通过检查后大小和修改时间都没有改变的图片
 
     返回tuple(无法读取的图片路径和错误元组列表, 修复成功的图片路径列表)
     """
+    if engine == "process":
+        # 进程池不受GIL限制，将多张图片打包成一个任务以减少调度开销
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_disallow_truncated_imgs
+        )
+        batch_size = _PROCESS_BATCH_SIZE
+    elif engine == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        batch_size = 1
+    else:
+        raise ValueError("engine参数非法，只能为thread或process")
+
+    cache = _VerifiedCache(images_dir) if use_cache else None
+    stats: Dict[str, os.stat_result] = {}
+    cached_number = 0
+
+    def iter_batches() -> Iterator[List[str]]:
+        nonlocal cached_number
+        batch: List[str] = []
+        for entry in scan_img_files(images_dir):
+            if cache is not None:
+                stat = entry.stat()
+                if cache.is_verified(entry.name, stat, fast):
+                    cached_number += 1
+                    continue
+                stats[entry.name] = stat
+            batch.append(entry.path)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    checked_number = 0
+    error_image_files_list = []
     with _allow_truncated_imgs_temporarily(
         False
-    ), concurrent.futures.ThreadPoolExecutor(
-        max_workers=max_workers
-    ) as executor:  # 需要设置为False，否则无法检测到截断
-        futures_list = [
-            executor.submit(try_read, image_path)
-            for image_path in search_img_files(Path(images_dir))
-        ]
-
-        # 获取结果
-        error_image_files_list = []
-        for future in tqdm(
-            concurrent.futures.as_completed(futures_list),
-            total=len(futures_list),
-            desc="检查图片中",
-        ):
-            result = future.result()
-            if result is not None:
-                error_image_files_list.append(result)
+    ), executor:  # 需要设置为False，否则无法检测到截断
+        # 边遍历目录边检查，并按完成顺序处理结果，而不是先为所有图片创建future
+        pbar = tqdm(desc="检查图片中", unit="张")
+        results = imap_unordered_bounded(
+            executor,
+            functools.partial(_try_read_batch, fast=fast),
+            iter_batches(),
+            max_pending=4 * (max_workers or os.cpu_count() or 1),
+        )
+        for batch, batch_results in results:
+            for image_path, result in zip(batch, batch_results):
+                if result is not None:
+                    error_image_files_list.append(result)
+                elif cache is not None:
+                    name = os.path.basename(image_path)
+                    cache.add(name, stats.pop(name), fast)
+            checked_number += len(batch)
+            pbar.update(len(batch))
+        pbar.close()
+
+    if cache is not None:
+        try:
+            cache.save()
+        except Exception as e:
+            logging.warning(f"保存检查缓存 {cache.path} 时发生错误, error: {e}")
 
     print(
-        f"检查了{len(futures_list)}张图片，其中{len(error_image_files_list)}张无法读取"
+        f"检查了{checked_number}张图片，其中{len(error_image_files_list)}张无法读取"
+        + (f"，另有{cached_number}张未改变而跳过" if cache is not None else "")
     )
 
     abs_path_error_list = [
@@ -222,6 +422,23 @@ if __name__ == "__main__":
         help="是否打印详细信息，在控制台运行时且mode=0情况下建议开启",
     )
     parser.add_argument("--max_workers", type=int, default=None, help="处理线程数")
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="thread",
+        choices=("thread", "process"),
+        help="thread为线程池，process为进程池，图片很多时进程池更快",
+    )
+    parser.add_argument(
+        "--use_cache",
+        action="store_true",
+        help="跳过上次通过检查后没有改变的图片",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="只检查图片的容器结构而不解码像素，结构可疑时才完整解码",
+    )
 
     cmd_param, unknown = parser.parse_known_args()
     if unknown:
@@ -0,0 +1,123 @@
+"""事件循环的选择，以及文件I/O和md5计算使用的专用线程池.
+
+默认情况下，aiofiles、`asyncio.to_thread`、DNS解析和md5计算都在事件循环的同一个默认执行器中运行，
+大量的磁盘操作会在其中排队，使得本应很快的操作(例如写入tags)也要等待.
+这里把文件I/O和md5计算分到各自大小的线程池中；校验和转换使用的进程池见 `ExecutorStage`.
+"""
+
+import asyncio
+import concurrent.futures
+import importlib.util
+from typing import Any, Coroutine, Optional, TypeVar
+
+__all__ = (
+    "EVENT_LOOPS",
+    "current_event_loop",
+    "hash_executor",
+    "resolve_event_loop",
+    "run",
+    "use_file_io_executor",
+)
+
+
+_T = TypeVar("_T")
+
+EVENT_LOOPS = ("asyncio", "uvloop", "auto")
+"""可选的事件循环，`auto` 为安装了uvloop时使用uvloop，否则使用asyncio"""
+
+
+def resolve_event_loop(event_loop: str) -> str:
+    """把 `auto` 解析为实际使用的事件循环
+
+    Args:
+        event_loop: `EVENT_LOOPS` 之一
+
+    Raises:
+        ValueError: `event_loop` 不是 `EVENT_LOOPS` 之一
+        ImportError: 指定了uvloop但没有安装
+
+    Returns:
+        `asyncio` 或 `uvloop`
+    """
+    if event_loop not in EVENT_LOOPS:
+        raise ValueError(f"event_loop 必须是 {EVENT_LOOPS} 之一，而不是 {event_loop!r}")
+    uvloop_installed = importlib.util.find_spec("uvloop") is not None
+    if event_loop == "auto":
+        return "uvloop" if uvloop_installed else "asyncio"
+    if event_loop == "uvloop" and not uvloop_installed:
+        raise ImportError("使用uvloop需要先安装: pip install uvloop (不支持Windows)")
+    return event_loop
+
+
+def run(main: Coroutine[Any, Any, _T], event_loop: str = "asyncio") -> _T:
+    """在新的事件循环中运行 `main`，与 `asyncio.run` 相同
+
+    Args:
+        main: 要运行的协程
+        event_loop: `EVENT_LOOPS` 之一. Defaults to "asyncio".
+
+    Returns:
+        `main` 的返回值
+    """
+    try:
+        event_loop = resolve_event_loop(event_loop)
+    except Exception:
+        main.close()
+        raise
+    if event_loop == "uvloop":
+        import uvloop  # noqa: PLC0415
+
+        return uvloop.run(main)
+    return asyncio.run(main)
+
+
+def current_event_loop() -> str:
+    """正在运行的事件循环是 `asyncio` 还是 `uvloop`，用于让子进程使用相同的事件循环"""
+    loop_type = type(asyncio.get_running_loop())
+    return "uvloop" if loop_type.__module__.startswith("uvloop") else "asyncio"
+
+
+def use_file_io_executor(
+    max_workers: Optional[int],
+) -> Optional[concurrent.futures.ThreadPoolExecutor]:
+    """把正在运行的事件循环的默认执行器替换为有 `max_workers` 个线程的线程池
+
+    之后aiofiles和 `asyncio.to_thread` 都在这个线程池中运行，事件循环结束时
+    (`asyncio.run` 或 `run` 返回时)会将其关闭.
+
+    Note: 应在第一次使用默认执行器之前调用，
+        因为被替换的默认执行器不会被关闭，其空闲线程会保留到解释器退出.
+
+    Args:
+        max_workers: 线程数，`None` 则不替换，使用asyncio默认大小的执行器
+
+    Returns:
+        新的默认执行器，`max_workers` 为 `None` 时为 `None`
+    """
+    if max_workers is None:
+        return None
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="file_io"
+    )
+    asyncio.get_running_loop().set_default_executor(executor)
+    return executor
+
+
+def hash_executor(
+    max_workers: Optional[int],
+) -> Optional[concurrent.futures.ThreadPoolExecutor]:
+    """创建计算md5使用的线程池，由调用者负责关闭
+
+    `hashlib` 在计算较大的数据块时会释放GIL，所以多个线程可以同时计算.
+
+    Args:
+        max_workers: 线程数，`None` 则不创建，md5在默认执行器中计算
+
+    Returns:
+        线程池，`max_workers` 为 `None` 时为 `None`
+    """
+    if max_workers is None:
+        return None
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="hash"
+    )
@@ -0,0 +1,191 @@
+"""根据延迟和错误率在等价的图片服务器(镜像)之间选择，并在服务器故障时换用其他镜像.
+
+Gelbooru的图片由多个提供相同路径的服务器提供(例如 `img3.gelbooru.com` 和 `img4.gelbooru.com`)，
+`HostSelector` 为每个服务器记录首字节时间的EWMA和错误率，
+图片链接的服务器在镜像列表中时，按以下规则排列可以尝试的服务器:
+    - 连续失败或错误率过高的服务器在 `cooldown` 秒内被停用，只在其他服务器都不可用时才尝试
+    - 原服务器的延迟不超过最快服务器的 `slow_factor` 倍时优先使用原服务器
+    - 还没有测量过或超过 `cooldown` 秒没有使用的服务器视为延迟为0，以便重新测量
+不在镜像列表中的链接不会被改写，但仍然会被统计.
+"""
+
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+__all__ = (
+    "HostSelector",
+    "HostStats",
+)
+
+
+def _split_origin(url: str) -> Tuple[str, str]:
+    """把链接分为 `scheme://netloc` 和其余部分"""
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    return origin, url[len(origin) :]
+
+
+def _normalize_mirror(mirror: str) -> str:
+    """`img3.gelbooru.com` 或 `https://img3.gelbooru.com/` -> `https://img3.gelbooru.com`"""
+    if "://" not in mirror:
+        mirror = f"https://{mirror}"
+    return _split_origin(mirror)[0]
+
+
+class HostStats:
+    """一个服务器的统计"""
+
+    def __init__(self):  # noqa: D107
+        self.requests = 0
+        """请求数"""
+        self.errors = 0
+        """失败的请求数"""
+        self.latency: Optional[float] = None
+        """首字节时间的EWMA，单位为秒，`None` 表示还没有成功的请求"""
+        self.error_rate = 0.0
+        """错误率的EWMA"""
+        self.consecutive_errors = 0
+        """连续失败的请求数"""
+        self.down_until = 0.0
+        """停用到此时刻(`clock` 的时间)为止"""
+        self.down_count = 0
+        """被停用的次数"""
+        self.last_used = 0.0
+        """最后一次请求完成的时刻(`clock` 的时间)"""
+
+
+class HostSelector:
+    """延迟感知的图片服务器选择器，由 `Downloader` 在每次请求前后调用
+
+    Note: 只在一个事件循环中使用，不是线程安全的.
+    """
+
+    def __init__(
+        self,
+        mirrors: Sequence[str],
+        max_attempts: int = 2,
+        alpha: float = 0.2,
+        slow_factor: float = 3.0,
+        max_consecutive_errors: int = 3,
+        max_error_rate: float = 0.5,
+        cooldown: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """图片服务器选择器
+
+        Args:
+            mirrors: 提供相同图片路径的服务器，例如 `https://img3.gelbooru.com`，
+                没有写协议时为https.
+            max_attempts: 一张图片最多尝试的服务器数，失败时依次换用下一个. Defaults to 2.
+            alpha: 延迟和错误率EWMA的平滑系数，越大对变化越敏感. Defaults to 0.2.
+            slow_factor: 原服务器的延迟超过最快服务器的这个倍数时换用最快的服务器. Defaults to 3.0.
+            max_consecutive_errors: 连续失败这么多次时停用服务器. Defaults to 3.
+            max_error_rate: 错误率的EWMA达到这个值时停用服务器. Defaults to 0.5.
+            cooldown: 停用的时长，也是延迟测量结果的有效期，单位为秒. Defaults to 30.0.
+            clock: 返回当前时间(秒)的函数. Defaults to time.monotonic.
+        """
+        self.mirrors = tuple(dict.fromkeys(_normalize_mirror(m) for m in mirrors))
+        self.max_attempts = max(1, max_attempts)
+        self.alpha = alpha
+        self.slow_factor = slow_factor
+        self.max_consecutive_errors = max_consecutive_errors
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.clock = clock
+        self.stats: Dict[str, HostStats] = {}
+        """服务器(`scheme://netloc`) -> 统计"""
+
+    def is_down(self, host: str) -> bool:
+        """`host` 当前是否被停用"""
+        stats = self.stats.get(host)
+        return stats is not None and self.clock() < stats.down_until
+
+    def _expected_latency(self, host: str, now: float) -> float:
+        stats = self.stats.get(host)
+        if (
+            stats is None
+            or stats.latency is None
+            or now - stats.last_used > self.cooldown
+        ):
+            return 0.0
+        return stats.latency
+
+    def candidates(self, url: str) -> List[str]:
+        """按尝试顺序排列的等价链接，最多 `max_attempts` 个
+
+        Args:
+            url: 原始的图片链接
+
+        Returns:
+            服务器不在镜像列表中时只有 `url` 本身
+        """
+        origin, rest = _split_origin(url)
+        if origin not in self.mirrors:
+            return [url]
+        now = self.clock()
+
+        def key(host: str) -> Tuple[bool, float, bool]:
+            latency = self._expected_latency(host, now)
+            if host == origin:
+                latency /= self.slow_factor
+            # 延迟相同时(例如都还没有测量过)优先使用原服务器
+            return self.is_down(host), latency, host != origin
+
+        hosts = sorted(self.mirrors, key=key)
+        return [host + rest for host in hosts[: self.max_attempts]]
+
+    def record(self, url: str, ok: bool, latency: Optional[float] = None) -> None:
+        """记录一次请求的结果
+
+        Args:
+            url: 实际请求的链接
+            ok: 是否成功
+            latency: 成功时的首字节时间，单位为秒. Defaults to None.
+        """
+        host = _split_origin(url)[0]
+        stats = self.stats.setdefault(host, HostStats())
+        now = self.clock()
+        stats.requests += 1
+        stats.last_used = now
+        if ok:
+            stats.consecutive_errors = 0
+            stats.error_rate *= 1 - self.alpha
+            if latency is not None:
+                stats.latency = (
+                    latency
+                    if stats.latency is None
+                    else stats.latency + self.alpha * (latency - stats.latency)
+                )
+            return
+
+        stats.errors += 1
+        stats.consecutive_errors += 1
+        stats.error_rate += self.alpha * (1 - stats.error_rate)
+        if (
+            stats.consecutive_errors >= self.max_consecutive_errors
+            or stats.error_rate >= self.max_error_rate
+        ):
+            stats.down_until = now + self.cooldown
+            stats.down_count += 1
+            # 恢复后重新开始统计，不会因为一次失败就再次被停用
+            stats.consecutive_errors = 0
+            stats.error_rate = 0.0
+            if host in self.mirrors:
+                logging.warning(
+                    f"{host} 失败过多，{self.cooldown:g} 秒内将换用其他镜像"
+                )
+
+    def format(self) -> str:
+        """各服务器统计的表格"""
+        lines = [
+            f"{'服务器':<36}{'请求数':>8}{'失败数':>8}{'延迟(ms)':>10}{'停用次数':>10}  状态"
+        ]
+        for host, stats in sorted(self.stats.items()):
+            latency = "-" if stats.latency is None else f"{stats.latency * 1000:.1f}"
+            lines.append(
+                f"{host:<39}{stats.requests:>11}{stats.errors:>11}{latency:>12}"
+                f"{stats.down_count:>14}  {'停用' if self.is_down(host) else '正常'}"
+            )
+        return "\n".join(lines)
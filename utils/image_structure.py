@@ -0,0 +1,110 @@
+"""不解码像素，只检查图片容器结构是否完整的快速校验.
+
+- JPEG: SOI开头，EOI(`FF D9`)结尾
+- PNG: 文件签名，逐个校验chunk的CRC，以IEND结尾
+- GIF: `GIF87a`/`GIF89a` 开头，trailer(`3B`)结尾
+- WebP: RIFF头中记录的大小与文件大小一致
+
+这只能发现截断等结构问题，通过检查不代表像素数据一定能被正确解码.
+不认识的格式和可疑的文件应交给完整解码处理，见 `utils.check_images.try_read`.
+"""
+
+import os
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional, Union
+
+__all__ = ("check_structure",)
+
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_READ_BLOCK_SIZE = 1024 * 1024  # 1MB
+
+
+def _check_jpeg(f: BinaryIO, size: int) -> Optional[str]:
+    if size < 4:
+        return "文件过小"
+    f.seek(-2, os.SEEK_END)
+    if f.read(2) != b"\xff\xd9":
+        return "缺少JPEG结束标记EOI"
+    return None
+
+
+def _check_png(f: BinaryIO, size: int) -> Optional[str]:
+    f.seek(len(_PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return "PNG在IEND之前结束"
+        length = int.from_bytes(header[:4], "big")
+        chunk_type = header[4:]
+
+        crc = zlib.crc32(chunk_type)
+        remaining = length
+        while remaining > 0:
+            block = f.read(min(remaining, _READ_BLOCK_SIZE))
+            if not block:
+                return f"PNG的 {chunk_type!r} chunk被截断"
+            crc = zlib.crc32(block, crc)
+            remaining -= len(block)
+
+        expected_crc = f.read(4)
+        if len(expected_crc) < 4:
+            return f"PNG的 {chunk_type!r} chunk被截断"
+        if int.from_bytes(expected_crc, "big") != crc:
+            return f"PNG的 {chunk_type!r} chunk CRC校验失败"
+
+        if chunk_type == b"IEND":
+            if f.tell() != size:
+                return "PNG在IEND之后还有多余的数据"
+            return None
+
+
+def _check_gif(f: BinaryIO, size: int) -> Optional[str]:
+    if size < 14:
+        return "文件过小"
+    f.seek(-1, os.SEEK_END)
+    if f.read(1) != b"\x3b":
+        return "缺少GIF结束标记trailer"
+    return None
+
+
+def _check_webp(f: BinaryIO, size: int) -> Optional[str]:
+    f.seek(4)
+    riff_size = int.from_bytes(f.read(4), "little")
+    # RIFF大小不包括开头的8字节，奇数大小的chunk可能有1字节的填充
+    if riff_size + 8 > size:
+        return "WebP文件被截断"
+    if riff_size + 8 < size - 1:
+        return "WebP在RIFF之后还有多余的数据"
+    return None
+
+
+_CHECKERS: Dict[bytes, Callable[[BinaryIO, int], Optional[str]]] = {
+    b"\xff\xd8": _check_jpeg,
+    _PNG_SIGNATURE: _check_png,
+    b"GIF87a": _check_gif,
+    b"GIF89a": _check_gif,
+}
+
+
+def check_structure(image_path: Union[str, Path]) -> Optional[str]:
+    """不解码像素，只检查图片容器结构是否完整.
+
+    Args:
+        image_path: 图片路径
+
+    Returns:
+        结构完整返回None；否则返回可疑的原因，包括不支持快速检查的格式.
+        返回原因不代表图片一定损坏，应当再进行一次完整解码来确认.
+    """
+    with open(image_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(12)
+
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return _check_webp(f, size)
+        for magic, checker in _CHECKERS.items():
+            if head.startswith(magic):
+                return checker(f, size)
+    return "不支持快速检查的格式"
@@ -0,0 +1,356 @@
+"""多台机器共同下载同一个查询时使用的任务队列.
+
+队列是共享存储上的一个SQLite数据库，每个工作单元为API的一页(pid).
+工作进程租用(lease)一个单元后定期续租，完成后记录这一页的下载计数；
+进程崩溃或断开后租约会过期，这个单元将被重新分配给其他工作进程.
+
+Note:
+    SQLite依赖文件锁保证同一个单元不会被同时租给两个工作进程，
+    请确认共享存储(如NFS/SMB)的文件锁可用.
+    因为WAL模式不支持网络文件系统，这里使用SQLite默认的回滚日志模式.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from enum import IntEnum
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+__all__ = (
+    "JobInfo",
+    "UnitState",
+    "WorkQueue",
+    "default_worker_id",
+)
+
+_T = TypeVar("_T")
+
+
+class UnitState(IntEnum):
+    """工作单元状态枚举"""
+
+    PENDING = 0
+    """等待租用"""
+    LEASED = 1
+    """已被租用，租约过期后可以被重新租用"""
+    DONE = 2
+    """已完成"""
+    FAILED = 3
+    """失败次数达到上限，不再分配"""
+
+
+class JobInfo(NamedTuple):
+    """一次下载任务的查询参数，由协调进程写入队列，工作进程从队列读取"""
+
+    tags: str
+    """查询的tags"""
+    limit: int
+    """每页图片数"""
+    page_count: int
+    """需要下载的页数，页码为 `0 ~ page_count-1`"""
+    max_id: Optional[int] = None
+    """创建任务时最新的图片id，之后上传的图片不会进入本次任务，使每一页的内容在下载期间保持不变"""
+
+    def query_tags(self) -> str:
+        """实际用于查询API的tags"""
+        if self.max_id is None:
+            return self.tags
+        return f"{self.tags} id:<={self.max_id}"
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    tags TEXT NOT NULL,
+    page_limit INTEGER NOT NULL,
+    page_count INTEGER NOT NULL,
+    created REAL NOT NULL,
+    max_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS units (
+    page INTEGER PRIMARY KEY,
+    state INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    all_count INTEGER NOT NULL DEFAULT 0,
+    success_count INTEGER NOT NULL DEFAULT 0,
+    duplicate_count INTEGER NOT NULL DEFAULT 0,
+    error_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, page);
+"""
+
+
+def default_worker_id() -> str:
+    """由主机名和进程号组成的工作进程标识，同一台机器上的多个进程也不会重复"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue:
+    """基于SQLite的租约式工作队列
+
+    用法:
+        ```python
+        with WorkQueue("/shared/job.sqlite") as queue:
+            queue.create(JobInfo("1girl", 100, 50))
+            page = queue.lease("worker-1")
+            ...
+            queue.complete(page, "worker-1", (100, 98, 2, 0))
+        ```
+
+    所有方法都是同步的，可以用 `asyncio.to_thread` 在协程中调用；同一个实例可以被多个线程使用.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_seconds: float = 300.0,
+        max_attempts: int = 3,
+    ):
+        """租约式工作队列
+
+        Args:
+            path: SQLite数据库路径，应位于所有机器都能访问的共享存储上
+            lease_seconds: 租约时长，单位为秒，工作进程需要在此时间内续租. Defaults to 300.0.
+            max_attempts: 一个单元最多被租用的次数，超过后标记为失败. Defaults to 3.
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # 由自己管理事务，`BEGIN IMMEDIATE` 会在读取之前就取得写锁
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.executescript(_SCHEMA)
+        # 旧版本创建的队列没有 `max_id` 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(job)")}
+        if "max_id" not in columns:
+            self._conn.execute("ALTER TABLE job ADD COLUMN max_id INTEGER")
+
+    def _transaction(self, fn: Callable[[], _T]) -> _T:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def create(self, job: JobInfo, reset: bool = False) -> bool:
+        """创建任务和所有工作单元
+
+        Args:
+            job: 任务参数
+            reset: 队列中已有任务时，是否清空后重新创建. Defaults to False.
+
+        Returns:
+            是否创建了新任务，队列中已有相同的任务时为False，
+            这时继续使用已有任务的 `max_id`
+
+        Raises:
+            ValueError: 队列中已有不同的任务，并且 `reset` 为False
+        """
+
+        def create() -> bool:
+            existing = self._job()
+            if existing is not None and not reset:
+                if existing[:3] != job[:3]:
+                    raise ValueError(
+                        f"{self.path} 中已有不同的任务 {existing}，需要重置才能创建 {job}"
+                    )
+                return False
+            self._conn.execute("DELETE FROM job")
+            self._conn.execute("DELETE FROM units")
+            self._conn.execute(
+                "INSERT INTO job (tags, page_limit, page_count, created, max_id)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (job.tags, job.limit, job.page_count, time.time(), job.max_id),
+            )
+            self._conn.executemany(
+                "INSERT INTO units (page) VALUES (?)",
+                ((page,) for page in range(job.page_count)),
+            )
+            return True
+
+        return self._transaction(create)
+
+    def _job(self) -> Optional[JobInfo]:
+        row = self._conn.execute(
+            "SELECT tags, page_limit, page_count, max_id FROM job"
+        ).fetchone()
+        return JobInfo(*row) if row is not None else None
+
+    def job(self) -> Optional[JobInfo]:
+        """读取任务参数，队列中没有任务时返回None"""
+        with self._lock:
+            return self._job()
+
+    def _reclaim_expired(self, now: float) -> int:
+        # 租约过期且已经达到重试上限的单元不再分配
+        cursor = self._conn.execute(
+            "UPDATE units SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+            "error = ? WHERE state = ? AND lease_expires < ?",
+            (
+                self.max_attempts,
+                UnitState.FAILED,
+                UnitState.PENDING,
+                "租约过期",
+                UnitState.LEASED,
+                now,
+            ),
+        )
+        return cursor.rowcount
+
+    def reclaim_expired(self) -> int:
+        """把租约已过期的单元重新标记为等待租用，达到重试上限的标记为失败
+
+        `lease` 也会先进行同样的处理；没有工作进程再来租用时，
+        协调进程需要调用它，才能发现持有租约的工作进程已经崩溃.
+
+        Returns:
+            被处理的单元数
+        """
+        return self._transaction(lambda: self._reclaim_expired(time.time()))
+
+    def lease(self, worker_id: str) -> Optional[int]:
+        """租用一个等待中或租约已过期的单元
+
+        Args:
+            worker_id: 工作进程标识
+
+        Returns:
+            租用的页码，没有可以租用的单元时返回None
+        """
+
+        def lease() -> Optional[int]:
+            now = time.time()
+            self._reclaim_expired(now)
+            row = self._conn.execute(
+                "SELECT page FROM units WHERE state = ? ORDER BY page LIMIT 1",
+                (UnitState.PENDING,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE units SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE page = ?",
+                (UnitState.LEASED, worker_id, now + self.lease_seconds, row[0]),
+            )
+            return row[0]
+
+        return self._transaction(lease)
+
+    def renew(self, page: int, worker_id: str) -> bool:
+        """续租 `page`
+
+        Returns:
+            是否续租成功，租约已过期并被其他工作进程租用时为False
+        """
+
+        def renew() -> bool:
+            cursor = self._conn.execute(
+                "UPDATE units SET lease_expires = ? WHERE page = ? AND owner = ? AND state = ?",
+                (time.time() + self.lease_seconds, page, worker_id, UnitState.LEASED),
+            )
+            return cursor.rowcount > 0
+
+        return self._transaction(renew)
+
+    def complete(self, page: int, worker_id: str, counts: Sequence[int]) -> bool:
+        """将 `page` 标记为完成
+
+        Args:
+            page: 页码
+            worker_id: 工作进程标识
+            counts: 这一页的下载计数，按顺序为：总下载任务、成功下载数、存在的重复数、下载失败数
+
+        Returns:
+            是否标记成功，租约已被其他工作进程接手时为False(文件按md5去重，重复下载不会造成损坏)
+        """
+
+        def complete() -> bool:
+            cursor = self._conn.execute(
+                "UPDATE units SET state = ?, error = NULL, all_count = ?, success_count = ?, "
+                "duplicate_count = ?, error_count = ? WHERE page = ? AND owner = ? AND state = ?",
+                (UnitState.DONE, *counts, page, worker_id, UnitState.LEASED),
+            )
+            return cursor.rowcount > 0
+
+        return self._transaction(complete)
+
+    def release(self, page: int, worker_id: str, error: str) -> None:
+        """放弃 `page` 的租约，使其可以被立即重新租用；达到重试上限时标记为失败
+
+        Args:
+            page: 页码
+            worker_id: 工作进程标识
+            error: 失败原因
+        """
+
+        def release() -> None:
+            self._conn.execute(
+                "UPDATE units SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ? "
+                "WHERE page = ? AND owner = ? AND state = ?",
+                (
+                    self.max_attempts,
+                    UnitState.FAILED,
+                    UnitState.PENDING,
+                    error,
+                    page,
+                    worker_id,
+                    UnitState.LEASED,
+                ),
+            )
+
+        self._transaction(release)
+
+    def status(self) -> Dict[UnitState, int]:
+        """每种状态的单元数"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM units GROUP BY state"
+            ).fetchall()
+        counts = dict.fromkeys(UnitState, 0)
+        counts.update((UnitState(state), count) for state, count in rows)
+        return counts
+
+    def is_finished(self) -> bool:
+        """是否所有单元都已完成或失败"""
+        status = self.status()
+        return status[UnitState.PENDING] == status[UnitState.LEASED] == 0
+
+    def totals(self) -> Tuple[int, int, int, int]:
+        """所有已完成单元的下载计数之和，顺序与 `complete` 的 `counts` 相同"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT TOTAL(all_count), TOTAL(success_count), TOTAL(duplicate_count), "
+                "TOTAL(error_count) FROM units WHERE state = ?",
+                (UnitState.DONE,),
+            ).fetchone()
+        return tuple(int(x) for x in row)  # pyright: ignore[reportReturnType]
+
+    def failed_units(self) -> Dict[int, Optional[str]]:
+        """所有失败的单元及其最后一次的失败原因"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page, error FROM units WHERE state = ? ORDER BY page",
+                (UnitState.FAILED,),
+            ).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        self._conn.close()
+
+    def __enter__(self):  # noqa: D105
+        return self
+
+    def __exit__(self, *args: object) -> None:  # noqa: D105
+        self.close()
@@ -0,0 +1,169 @@
+"""`scrape_images` 的任务日志，用于在中断后继续下载.
+
+日志是下载目录下的一个JSONL文件，第一行记录任务(查询的tags、每页图片数和页数)，
+之后按顺序追加每张图片的最终状态和每一页的完成记录.
+每张图片的记录先缓存在内存中，在这一页完成时与页面记录一起写入，所以不会拖慢下载；
+中断时最多丢失当前页的图片记录，继续下载时这些图片会像普通下载一样通过md5判断是否重复.
+"""
+
+import json
+import logging
+import os
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence
+
+import aiofiles
+
+__all__ = (
+    "JOURNAL_FILE_NAME",
+    "DownloadJournal",
+    "JournalJob",
+)
+
+
+JOURNAL_FILE_NAME = ".scrape_journal.jsonl"
+
+
+class JournalJob(NamedTuple):
+    """日志记录的下载任务"""
+
+    tags: str
+    """用户输入的tags"""
+    limit: int
+    """每页图片数"""
+    page_count: int
+    """需要下载的页数"""
+    max_id: Optional[int] = None
+    """任务开始时最新的图片id，之后上传的图片不会进入本次任务，使页面内容在继续下载时保持不变"""
+
+    def query_tags(self) -> str:
+        """实际用于查询API的tags"""
+        if self.max_id is None:
+            return self.tags
+        return f"{self.tags} id:<={self.max_id}"
+
+
+class DownloadJournal:
+    """下载任务日志
+
+    用法:
+        ```python
+        journal = DownloadJournal("images")
+        if journal.load() is None:
+            await journal.start(JournalJob("1girl", 100, 10))
+        for page in journal.pending_pages():
+            ...
+            journal.record_post(page, md5, "SUCCESS")
+            await journal.complete_page(page, (100, 98, 2, 0))
+        await journal.close()
+        ```
+    """
+
+    def __init__(self, download_dir: str):
+        """下载任务日志
+
+        Args:
+            download_dir: 下载目录，日志写入其中的 `JOURNAL_FILE_NAME`
+        """
+        self.path = os.path.join(download_dir, JOURNAL_FILE_NAME)
+        self.job: Optional[JournalJob] = None
+        self.completed_pages: Dict[int, List[int]] = {}
+        """已完成的页面及其下载计数，有下载失败的页面在继续下载时仍会被重新下载"""
+        self._states: Dict[str, str] = {}
+        self._buffer: List[str] = []
+
+    def load(self) -> Optional[JournalJob]:
+        """读取日志中的任务、已完成的页面和每张图片的状态
+
+        Returns:
+            日志中的任务，没有日志时返回None
+        """
+        self.job = None
+        self.completed_pages = {}
+        self._states = {}
+        try:
+            f = open(self.path, encoding="utf-8")  # noqa: SIM115
+        except FileNotFoundError:
+            return None
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时可能留下不完整的最后一行
+                    continue
+                kind = record.get("type")
+                if kind == "job":
+                    self.job = JournalJob(**record["job"])
+                elif kind == "post":
+                    self._states[record["md5"]] = record["state"]
+                elif kind == "page":
+                    self.completed_pages[record["page"]] = record["counts"]
+        return self.job
+
+    async def start(self, job: JournalJob) -> None:
+        """清空日志，开始一个新任务"""
+        self.job = job
+        self.completed_pages = {}
+        self._states = {}
+        self._buffer = []
+        record = {"type": "job", "job": job._asdict()}
+        async with aiofiles.open(self.path, "w", encoding="utf-8") as f:
+            await f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def pending_pages(self) -> List[int]:
+        """尚未完成或有下载失败的图片的页码"""
+        assert self.job is not None
+        return [
+            page
+            for page in range(self.job.page_count)
+            # 下载计数的最后一项为下载失败数，这些图片需要重新下载
+            if page not in self.completed_pages or self.completed_pages[page][-1] > 0
+        ]
+
+    def is_finished(self, md5: str) -> bool:
+        """`md5` 对应的图片是否已经下载完成(成功或重复)"""
+        state = self._states.get(md5)
+        return state is not None and state != "ERROR"
+
+    def finished_posts(self) -> FrozenSet[str]:
+        """所有已经下载完成的图片的md5"""
+        return frozenset(md5 for md5 in self._states if self.is_finished(md5))
+
+    def record_post(self, page: int, md5: str, state: str) -> None:
+        """记录一张图片的最终状态，在这一页完成时才写入文件
+
+        Args:
+            page: 图片所在的页码
+            md5: 图片的md5
+            state: `DownloadResultState` 的名称，"ERROR" 的图片在继续下载时会被重新下载
+        """
+        self._states[md5] = state
+        record = {"type": "post", "page": page, "md5": md5, "state": state}
+        self._buffer.append(json.dumps(record) + "\n")
+
+    async def flush(self) -> None:
+        """写入所有缓存的记录"""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        async with aiofiles.open(self.path, "a", encoding="utf-8") as f:
+            await f.write("".join(lines))
+
+    async def complete_page(self, page: int, counts: Sequence[int]) -> None:
+        """记录一页已经完成，并与这一页的图片记录一起写入文件
+
+        Args:
+            page: 页码
+            counts: 这一页的下载计数，按顺序为：总下载任务、成功下载数、存在的重复数、下载失败数
+        """
+        self.completed_pages[page] = list(counts)
+        record = {"type": "page", "page": page, "counts": list(counts)}
+        self._buffer.append(json.dumps(record) + "\n")
+        await self.flush()
+
+    async def close(self) -> None:
+        """写入剩余的记录，例如被中断的页面中已经完成的图片"""
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"写入任务日志 {self.path} 时发生错误, error: {e}")
@@ -0,0 +1,198 @@
+"""在本地端口上以Prometheus文本格式提供下载指标，不需要额外依赖.
+
+提供的指标:
+    - `gelbooru_downloads_total{state}`: 按 `DownloadResultState` 统计的完成数
+    - `gelbooru_download_bytes_total`: 接收的字节数
+    - `gelbooru_downloads_in_flight`: 正在传输的下载数
+    - `gelbooru_semaphore_waiting`: 等待并发信号量的下载数
+    - `gelbooru_download_retries_total`: 校验失败后重新下载的次数
+    - `gelbooru_api_request_duration_seconds`: API请求耗时的直方图
+    - `gelbooru_api_errors_total`: 失败的API请求数
+    - `gelbooru_md5_check_duration_seconds`: 检查已有文件md5耗时的直方图
+
+所有更新都只是整数加减或一次二分查找，下载指标在每次被抓取时才生成.
+"""
+
+import asyncio
+import bisect
+import logging
+from typing import Dict, List, Optional, Sequence
+
+from utils.throughput import TransferStats
+
+__all__ = (
+    "METRICS_HOST",
+    "DownloadMetrics",
+    "Histogram",
+    "MetricsServer",
+)
+
+
+METRICS_HOST = "127.0.0.1"
+
+
+class Histogram:
+    """Prometheus风格的直方图"""
+
+    def __init__(self, buckets: Sequence[float]):
+        """Prometheus风格的直方图
+
+        Args:
+            buckets: 递增的桶上界，`+Inf` 会被自动添加
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """记录一个观测值"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str) -> List[str]:
+        """生成直方图的样本行，桶的计数是累积的"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class DownloadMetrics:
+    """下载过程中的指标，由 `Downloader` 和 `GetAPI` 更新"""
+
+    def __init__(self, transfer_stats: Optional[TransferStats] = None):
+        """下载指标
+
+        Args:
+            transfer_stats: 提供字节数和正在传输的下载数，应与 `launch_executor` 使用的是同一个.
+                Defaults to None.
+        """
+        self.transfer_stats = transfer_stats
+        self.completions: Dict[str, int] = {}
+        """`DownloadResultState` 的名称 -> 完成数"""
+        self.semaphore_waiting = 0
+        """等待并发信号量的下载数"""
+        self.retries = 0
+        """重新下载的次数"""
+        self.api_errors = 0
+        """失败的API请求数"""
+        self.api_latency = Histogram((0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+        self.md5_check = Histogram((0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+    def completed(self, state: str) -> None:
+        """记录一个完成的下载
+
+        Args:
+            state: `DownloadResultState` 的名称
+        """
+        self.completions[state] = self.completions.get(state, 0) + 1
+
+    def render(self) -> str:
+        """生成Prometheus文本格式的指标"""
+        stats = self.transfer_stats
+        lines = [
+            "# HELP gelbooru_downloads_total Completed downloads by result state.",
+            "# TYPE gelbooru_downloads_total counter",
+        ]
+        lines.extend(
+            f'gelbooru_downloads_total{{state="{state}"}} {count}'
+            for state, count in sorted(self.completions.items())
+        )
+        lines += [
+            "# HELP gelbooru_download_bytes_total Bytes received from image downloads.",
+            "# TYPE gelbooru_download_bytes_total counter",
+            f"gelbooru_download_bytes_total {stats.total_bytes if stats else 0}",
+            "# HELP gelbooru_downloads_in_flight Downloads currently transferring.",
+            "# TYPE gelbooru_downloads_in_flight gauge",
+            f"gelbooru_downloads_in_flight {stats.active_streams if stats else 0}",
+            "# HELP gelbooru_semaphore_waiting Downloads waiting for a concurrency slot.",
+            "# TYPE gelbooru_semaphore_waiting gauge",
+            f"gelbooru_semaphore_waiting {self.semaphore_waiting}",
+            "# HELP gelbooru_download_retries_total Re-downloads after failed verification.",
+            "# TYPE gelbooru_download_retries_total counter",
+            f"gelbooru_download_retries_total {self.retries}",
+            "# HELP gelbooru_api_errors_total Failed API requests.",
+            "# TYPE gelbooru_api_errors_total counter",
+            f"gelbooru_api_errors_total {self.api_errors}",
+            "# HELP gelbooru_api_request_duration_seconds API request latency.",
+            "# TYPE gelbooru_api_request_duration_seconds histogram",
+            *self.api_latency.render("gelbooru_api_request_duration_seconds"),
+            "# HELP gelbooru_md5_check_duration_seconds Time spent hashing existing files.",
+            "# TYPE gelbooru_md5_check_duration_seconds histogram",
+            *self.md5_check.render("gelbooru_md5_check_duration_seconds"),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """只响应 `GET /metrics` 的最小HTTP服务器
+
+    用法:
+        ```python
+        server = MetricsServer(metrics, 9100)
+        await server.start()
+        ...
+        await server.close()
+        ```
+    """
+
+    def __init__(self, metrics: DownloadMetrics, port: int, host: str = METRICS_HOST):
+        """指标服务器
+
+        Args:
+            metrics: 要提供的指标
+            port: 监听端口，0则由系统分配
+            host: 监听地址. Defaults to METRICS_HOST.
+        """
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        """开始监听，`port` 为0时会被更新为实际的端口"""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"下载指标: http://{self.host}:{self.port}/metrics")
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            # 忽略请求头
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status = "200 OK"
+                body = self.metrics.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logging.error(f"响应指标请求时发生错误, error: {e}")
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        """停止监听"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
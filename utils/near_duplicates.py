@@ -0,0 +1,506 @@
+"""基于感知哈希(dHash)的近似重复图片索引.
+
+md5只能发现完全相同的文件，重新编码、缩放过的同一张图片需要用感知哈希来发现.
+每张图片的64位dHash保存在一个 `numpy.uint64` 数组中，所有的汉明距离计算都是向量化的:
+
+- 查询单个哈希: 与所有哈希一次异或和popcount，一百万张图片也只需要几毫秒
+- 查找所有近似重复对: 使用multi-index hashing，把64位分成 `threshold + 1` 段，
+  距离不超过 `threshold` 的两个哈希至少有一段完全相同(鸽巢原理)，
+  所以只需要在每一段排序后比较相同段值的候选对，而不是比较所有 N^2 对.
+  候选对的数量约为 `段数 * N^2 / 2^(64/段数)`，`threshold` 越大越慢
+
+需要安装numpy.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from utils._tools import scan_img_files
+from utils.pipeline import ExecutorStage, imap_unordered_bounded
+
+__all__ = (
+    "PHASH_INDEX_FILE_NAME",
+    "NearDuplicateFilter",
+    "PerceptualHashIndex",
+    "dhash",
+    "find_near_duplicates",
+    "hamming_distance",
+)
+
+
+PHASH_INDEX_FILE_NAME = ".phash_index.npz"
+"""`PerceptualHashIndex` 在图片目录下的默认索引文件名"""
+
+_HASH_BATCH_SIZE = 64
+# 段值相同的图片超过这个数量时，直接在组内两两比较，而不是逐个偏移比较排序后的数组
+_LARGE_GROUP_SIZE = 256
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image_path: Union[str, os.PathLike]) -> int:
+    """计算图片的64位dHash(difference hash)
+
+    将图片缩小为9x8的灰度图，比较每行相邻像素的大小得到64位.
+    对JPEG使用 `draft` 以缩小的尺寸解码，不需要解码完整的像素.
+    """
+    with Image.open(image_path) as image:
+        image.draft("L", (64, 64))
+        small = image.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def _dhash_batch(image_paths: Sequence[str]) -> List[Optional[int]]:
+    """在子进程中批量计算dHash，无法读取的图片为None"""
+    hashes: List[Optional[int]] = []
+    for image_path in image_paths:
+        try:
+            hashes.append(dhash(image_path))
+        except Exception as e:
+            logging.warning(f"无法计算 {image_path} 的感知哈希, error: {e}")
+            hashes.append(None)
+    return hashes
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):  # numpy>=2.0
+        return np.bitwise_count(x)
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return (
+        _POPCOUNT_TABLE[x.view(np.uint8)].reshape(*x.shape, 8).sum(-1, dtype=np.uint8)
+    )
+
+
+def hamming_distance(hashes: np.ndarray, other: Union[int, np.ndarray]) -> np.ndarray:
+    """向量化地计算 `hashes` 与 `other` 之间的汉明距离，`other` 可以是单个哈希或形状可广播的数组"""
+    other = np.uint64(other) if isinstance(other, int) else other
+    return _popcount(np.bitwise_xor(hashes, other))
+
+
+def _pairs_in_group(
+    hashes: np.ndarray, threshold: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """分块地两两比较一组哈希，返回组内距离不超过 `threshold` 的 `(rows, cols)`，`rows < cols`"""
+    size = len(hashes)
+    chunk = max(1, (1 << 22) // size)
+    rows_list, cols_list = [], []
+    for start in range(0, size, chunk):
+        block = hamming_distance(hashes[start : start + chunk, None], hashes[None, :])
+        rows, cols = np.nonzero(block <= threshold)
+        rows += start
+        keep = rows < cols
+        rows_list.append(rows[keep])
+        cols_list.append(cols[keep])
+    return np.concatenate(rows_list), np.concatenate(cols_list)
+
+
+class PerceptualHashIndex:
+    """一个目录中所有图片的dHash索引.
+
+    哈希连同文件大小和修改时间保存在 `.phash_index.npz` 中，
+    `update` 只会重新计算新增或改变的图片.
+
+    用法:
+        ```python
+        index = PerceptualHashIndex.load("images")
+        index.update()
+        for group in index.duplicate_groups(threshold=4):
+            print(group)
+        index.save()
+        ```
+    """
+
+    def __init__(self, root: str):
+        """空的dHash索引
+
+        Args:
+            root: 图片目录，索引中的名字是相对于此目录的文件名
+        """
+        self.root = root
+        self.names: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        # 每行为(文件大小, 修改时间)，未知为-1
+        self._stats = np.full((1024, 2), -1, dtype=np.int64)
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.names)
+
+    @property
+    def hashes(self) -> np.ndarray:
+        """所有图片的哈希，与 `names` 一一对应"""
+        return self._hashes[: len(self.names)]
+
+    @property
+    def default_path(self) -> str:
+        """默认的索引文件路径"""
+        return os.path.join(self.root, PHASH_INDEX_FILE_NAME)
+
+    def add(
+        self, name: str, image_hash: int, stat: Optional[os.stat_result] = None
+    ) -> None:
+        """添加或更新一张图片的哈希
+
+        Args:
+            name: 图片文件名
+            image_hash: 图片的dHash
+            stat: 图片的 `os.stat` 结果，`None` 则在 `save` 时再获取. Defaults to None.
+        """
+        position = self._positions.get(name)
+        if position is None:
+            position = len(self.names)
+            if position == len(self._hashes):
+                # 容量翻倍，均摊的添加开销为O(1)
+                self._hashes = np.resize(self._hashes, 2 * position)
+                self._stats = np.resize(self._stats, (2 * position, 2))
+            self.names.append(name)
+            self._positions[name] = position
+        self._hashes[position] = image_hash
+        self._stats[position] = (
+            (stat.st_size, stat.st_mtime_ns) if stat is not None else (-1, -1)
+        )
+
+    def query(
+        self, image_hash: int, threshold: int, exclude: Optional[str] = None
+    ) -> List[Tuple[str, int]]:
+        """查找与 `image_hash` 的汉明距离不超过 `threshold` 的图片
+
+        Args:
+            image_hash: 要查询的dHash
+            threshold: 最大汉明距离
+            exclude: 不包括在结果中的图片文件名. Defaults to None.
+
+        Returns:
+            按距离从小到大排序的 `[(图片文件名, 距离), ...]`
+        """
+        distances = hamming_distance(self.hashes, image_hash)
+        (indices,) = np.nonzero(distances <= threshold)
+        indices = indices[np.argsort(distances[indices], kind="stable")]
+        return [
+            (self.names[i], int(distances[i]))
+            for i in indices
+            if self.names[i] != exclude
+        ]
+
+    def near_duplicate_pairs(self, threshold: int) -> np.ndarray:
+        """查找所有汉明距离不超过 `threshold` 的图片对
+
+        Args:
+            threshold: 最大汉明距离，0~63
+
+        Returns:
+            形状为 `(K, 3)` 的数组，每行为 `(索引i, 索引j, 距离)`，`i < j`，索引对应 `names`
+        """
+        hashes = self.hashes
+        count = len(hashes)
+        if count < 2:
+            return np.empty((0, 3), dtype=np.int64)
+
+        bands = min(threshold + 1, 64)
+        bounds = np.linspace(0, 64, bands + 1).astype(int)
+
+        rows_list = [np.empty(0, dtype=np.intp)]
+        cols_list = [np.empty(0, dtype=np.intp)]
+        for low, high in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            keys = (hashes >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            sorted_hashes = hashes[order]
+
+            # 段值相同的元素在排序后是连续的一组，过大的组(例如纯色图片)直接在组内两两比较
+            starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+            sizes = np.diff(np.r_[starts, count])
+            large = sizes > _LARGE_GROUP_SIZE
+            for start, size in zip(starts[large].tolist(), sizes[large].tolist()):
+                rows, cols = _pairs_in_group(
+                    sorted_hashes[start : start + size], threshold
+                )
+                rows_list.append(order[start + rows])
+                cols_list.append(order[start + cols])
+
+            # 其余的小组: 比较排序后相隔 `offset` 的元素，都是连续内存上的向量化运算
+            small = ~np.repeat(large, sizes)
+            order = order[small]
+            sorted_keys = sorted_keys[small]
+            sorted_hashes = sorted_hashes[small]
+            for offset in range(1, _LARGE_GROUP_SIZE):
+                same = sorted_keys[offset:] == sorted_keys[:-offset]
+                if not same.any():
+                    break
+                same &= (
+                    hamming_distance(sorted_hashes[offset:], sorted_hashes[:-offset])
+                    <= threshold
+                )
+                (indices,) = np.nonzero(same)
+                rows_list.append(order[indices])
+                cols_list.append(order[indices + offset])
+
+        # `argsort(kind="stable")` 使段值相同的一组内原索引保持升序，
+        # 而组内的每一对都是排序后靠前的在 `rows`，所以总有 `rows < cols`.
+        # 同一对可能在多个段中被找到
+        pair_keys = np.unique(
+            np.concatenate(rows_list).astype(np.int64) * count
+            + np.concatenate(cols_list)
+        )
+        rows, cols = pair_keys // count, pair_keys % count
+        distances = hamming_distance(hashes[rows], hashes[cols]).astype(np.int64)
+        return np.stack([rows, cols, distances], axis=1)
+
+    def duplicate_groups(self, threshold: int) -> List[List[str]]:
+        """将近似重复的图片合并为组(传递闭包)，只返回包含两张以上图片的组"""
+        parent = list(range(len(self.names)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, j, _ in self.near_duplicate_pairs(threshold).tolist():
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        groups: Dict[int, List[str]] = {}
+        for i in range(len(self.names)):
+            groups.setdefault(find(i), []).append(self.names[i])
+        return [group for group in groups.values() if len(group) > 1]
+
+    def file_size(self, name: str) -> int:
+        """图片在索引中记录的文件大小，未知为-1"""
+        return int(self._stats[self._positions[name], 0])
+
+    def update(self, max_workers: Optional[int] = None, debug: bool = True) -> int:
+        """扫描 `root`，用进程池计算新增或改变的图片的哈希，并移除已经不存在的图片
+
+        Args:
+            max_workers: 进程数，`None` 则为CPU核心数. Defaults to None.
+            debug: 是否显示进度条. Defaults to True.
+
+        Returns:
+            重新计算了哈希的图片数
+        """
+        old_positions, old_hashes, old_stats = (
+            self._positions,
+            self._hashes,
+            self._stats,
+        )
+        fresh = PerceptualHashIndex(self.root)
+
+        todo: Dict[str, os.stat_result] = {}
+        for entry in scan_img_files(self.root):
+            stat = entry.stat()
+            position = old_positions.get(entry.name)
+            if position is not None and tuple(old_stats[position]) == (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                fresh.add(entry.name, int(old_hashes[position]), stat)
+            else:
+                todo[entry.name] = stat
+
+        if todo:
+            names = list(todo)
+            batches = (
+                names[i : i + _HASH_BATCH_SIZE]
+                for i in range(0, len(names), _HASH_BATCH_SIZE)
+            )
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+            with executor, tqdm(total=len(names), disable=not debug) as pbar:
+                results = imap_unordered_bounded(
+                    executor,
+                    _dhash_batch,
+                    (
+                        tuple(os.path.join(self.root, name) for name in batch)
+                        for batch in batches
+                    ),
+                    max_pending=2 * (max_workers or os.cpu_count() or 1),
+                )
+                for batch, hashes in results:
+                    for image_path, image_hash in zip(batch, hashes):
+                        if image_hash is not None:
+                            name = os.path.basename(image_path)
+                            fresh.add(name, image_hash, todo[name])
+                    pbar.update(len(batch))
+
+        self.names, self._positions = fresh.names, fresh._positions
+        self._hashes, self._stats = fresh._hashes, fresh._stats
+        return len(todo)
+
+    def save(self, path: Optional[str] = None) -> None:
+        """保存索引，`path` 为 `None` 则保存到 `root` 下的 `.phash_index.npz`"""
+        path = path or self.default_path
+        stats = self._stats[: len(self.names)]
+        for i in np.flatnonzero(stats[:, 0] < 0):
+            try:
+                stat = os.stat(os.path.join(self.root, self.names[i]))
+                stats[i] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+
+        # 先写入临时文件再替换，避免中途退出时损坏已有的索引
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(self.names, dtype=str),
+                hashes=self.hashes,
+                stats=stats,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, root: str, path: Optional[str] = None) -> "PerceptualHashIndex":
+        """读取 `root` 的索引，索引文件不存在或无法读取时返回空索引"""
+        index = cls(root)
+        path = path or index.default_path
+        try:
+            with np.load(path) as data:
+                names, hashes, stats = data["names"], data["hashes"], data["stats"]
+        except FileNotFoundError:
+            return index
+        except Exception as e:
+            logging.warning(f"无法读取感知哈希索引 {path}，将重新计算, error: {e}")
+            return index
+
+        index.names = names.tolist()
+        index._positions = {name: i for i, name in enumerate(index.names)}
+        index._hashes = np.array(hashes, dtype=np.uint64)
+        index._stats = np.array(stats, dtype=np.int64).reshape(-1, 2)
+        if not len(index._hashes):
+            return cls(root)
+        return index
+
+
+class NearDuplicateFilter:
+    """在下载过程中过滤近似重复的图片
+
+    新图片的dHash在流水线阶段(通常是进程池)中计算，然后在索引中查询；
+    没有近似重复时会被加入索引，所以同一批下载中的近似重复图片也会被发现.
+    """
+
+    def __init__(
+        self, index: PerceptualHashIndex, stage: ExecutorStage, threshold: int = 4
+    ):
+        """近似重复过滤器
+
+        Args:
+            index: 已有图片的dHash索引
+            stage: 用于计算dHash的流水线阶段
+            threshold: 汉明距离不超过此值的图片被视为近似重复. Defaults to 4.
+        """
+        self.index = index
+        self.stage = stage
+        self.threshold = threshold
+
+    async def find(self, image_path: str, name: str) -> Optional[Tuple[str, int]]:
+        """查找与 `image_path` 近似重复的已有图片
+
+        Args:
+            image_path: 新图片的路径
+            name: 新图片在索引中的文件名
+
+        Returns:
+            找到时返回距离最近的 `(图片文件名, 距离)`，否则将新图片加入索引并返回None
+        """
+        (image_hash,) = await self.stage.run(_dhash_batch, (image_path,))
+        if image_hash is None:
+            return None
+        # 计算哈希之后没有再await，查询和加入索引之间不会有其他协程插入
+        matches = self.index.query(image_hash, self.threshold, exclude=name)
+        if matches:
+            return matches[0]
+        self.index.add(name, image_hash)
+        return None
+
+
+def find_near_duplicates(
+    images_dir: str,
+    threshold: int = 4,
+    mode: int = 0,
+    max_workers: Optional[int] = None,
+    debug: bool = True,
+) -> List[List[str]]:
+    """查找(并删除)目录中近似重复的图片，索引会被保存到目录下的 `.phash_index.npz`
+
+    Args:
+        images_dir: 图片目录
+        threshold: 汉明距离不超过此值的图片被视为近似重复. Defaults to 4.
+        mode: 0表示只输出信息，1表示每组只保留文件最大的一张，删除其余图片. Defaults to 0.
+        max_workers: 计算哈希的进程数，`None` 则为CPU核心数. Defaults to None.
+        debug: 是否输出详细信息. Defaults to True.
+
+    Returns:
+        近似重复的图片组
+    """
+    index = PerceptualHashIndex.load(images_dir)
+
+    start = time.perf_counter()
+    hashed = index.update(max_workers=max_workers, debug=debug)
+    print(f"计算了 {hashed} 张图片的感知哈希，耗时 {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    groups = index.duplicate_groups(threshold)
+    print(
+        f"在 {len(index)} 张图片中找到 {len(groups)} 组近似重复，"
+        f"耗时 {time.perf_counter() - start:.2f}s"
+    )
+
+    removed = []
+    for group in groups:
+        if debug:
+            print(group)
+        if mode == 1:
+            # 每组保留文件最大的一张
+            _, *duplicates = sorted(group, key=index.file_size, reverse=True)
+            for name in duplicates:
+                try:
+                    os.remove(os.path.join(images_dir, name))
+                    removed.append(name)
+                except Exception as e:
+                    logging.error(f"删除 {name} 时发生错误, error: {e}")
+    if removed:
+        print(f"删除了 {len(removed)} 张图片")
+        index.update(max_workers=max_workers, debug=False)
+
+    index.save()
+    return groups
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("images_dir", type=str, help="要检查的目录")
+    parser.add_argument(
+        "--threshold",
+        type=int,
+        default=4,
+        help="dHash汉明距离不超过此值的图片被视为近似重复，0~63",
+    )
+    parser.add_argument(
+        "--mode",
+        type=int,
+        default=0,
+        help="0表示只输出信息，1表示每组只保留文件最大的一张，删除其余图片",
+    )
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="计算哈希的进程数"
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="是否打印每一组近似重复的图片"
+    )
+
+    cmd_param, unknown = parser.parse_known_args()
+    if unknown:
+        logging.warning(f"以下输入参数非法，将被忽略：\n{unknown}")
+
+    find_near_duplicates(**vars(cmd_param))
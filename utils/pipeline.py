@@ -0,0 +1,87 @@
+"""在执行器中运行同步任务的异步流水线阶段."""
+
+import asyncio
+import concurrent.futures
+from typing import Any, Callable, Dict, Iterable, Iterator, Set, Tuple, TypeVar
+
+__all__ = ("ExecutorStage", "imap_unordered_bounded")
+
+
+_T = TypeVar("_T")
+_ItemT = TypeVar("_ItemT")
+
+
+def imap_unordered_bounded(
+    executor: concurrent.futures.Executor,
+    func: Callable[[_ItemT], _T],
+    items: Iterable[_ItemT],
+    max_pending: int,
+) -> Iterator[Tuple[_ItemT, _T]]:
+    """在执行器中对 `items` 逐个运行 `func`，按完成顺序产出 `(item, func(item))`.
+
+    与先为所有item创建future再用 `as_completed` 等待不同，这里惰性地读取 `items`，
+    同时最多只有 `max_pending` 个任务在执行器中，所以内存占用与 `items` 的数量无关，
+    并且第一个结果完成后就能立即被处理.
+
+    Args:
+        executor: 运行任务的执行器.
+        func: 要运行的函数，使用进程池时必须可以被pickle.
+        items: 任意可迭代对象，可以是生成器.
+        max_pending: 同时提交到执行器中的最大任务数.
+
+    Raises:
+        Exception: `func` 引发的异常会在产出对应结果时重新引发.
+    """
+    max_pending = max(1, max_pending)
+    future_to_item: Dict[concurrent.futures.Future[_T], _ItemT] = {}
+    items_iter = iter(items)
+
+    def fill() -> None:
+        for item in items_iter:
+            future_to_item[executor.submit(func, item)] = item
+            if len(future_to_item) >= max_pending:
+                break
+
+    fill()
+    while future_to_item:
+        done: Set[concurrent.futures.Future[_T]]
+        done, _ = concurrent.futures.wait(
+            future_to_item, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            yield future_to_item.pop(future), future.result()
+        fill()
+
+
+class ExecutorStage:
+    """把同步函数提交到执行器(通常是进程池)中运行的流水线阶段.
+
+    同时最多只有 `max_pending` 个任务在执行器中排队或运行，
+    超出时 `run` 会等待，从而让上游(例如下载协程)慢下来，而不是无限制地堆积任务.
+
+    Note: 必须在事件循环中实例化.
+    """
+
+    def __init__(self, executor: concurrent.futures.Executor, max_pending: int):
+        """流水线阶段
+
+        Args:
+            executor: 运行任务的执行器，由调用者负责关闭.
+            max_pending: 同时提交到执行器中的最大任务数.
+        """
+        self.executor = executor
+        self.max_pending = max(1, max_pending)
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+        self.pending = 0
+        """当前提交到执行器中的任务数"""
+
+    async def run(self, func: Callable[..., _T], *args: Any) -> _T:
+        """在执行器中运行 `func(*args)` 并等待结果，`func` 和参数必须可以被pickle"""
+        async with self._semaphore:
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, func, *args
+                )
+            finally:
+                self.pending -= 1
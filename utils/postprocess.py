@@ -0,0 +1,250 @@
+"""下载后的图片缩放和格式转换."""
+
+import asyncio
+import json
+import math
+import os
+import shutil
+import tempfile
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
+
+import aiofiles.os
+
+from utils._jsonl import BatchedJsonlWriter
+
+if TYPE_CHECKING:
+    # Pillow只在进程池中转换图片时才需要，避免在导入时拖慢启动
+    from PIL import Image
+
+__all__ = (
+    "CONVERTED_INDEX_FILE_NAME",
+    "CONVERT_FORMATS",
+    "ConvertOptions",
+    "ConvertedIndex",
+    "convert_image",
+)
+
+
+CONVERT_FORMATS = ("webp", "jpeg")
+"""`ConvertOptions.format` 支持的格式"""
+
+_FORMAT_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+
+
+class ConvertOptions(NamedTuple):
+    """图片缩放和格式转换的参数，可以被pickle传递给进程池"""
+
+    max_side: Optional[int] = None
+    """缩放后最长边的最大像素数，`None` 则不限制"""
+    max_pixels: Optional[int] = None
+    """缩放后的最大总像素数(宽*高)，`None` 则不限制"""
+    format: Optional[str] = "webp"
+    """转换的目标格式，`CONVERT_FORMATS` 中的一个，`None` 则保持原有格式只缩放"""
+    quality: int = 90
+    """有损编码的质量，1~100"""
+    keep_original: bool = False
+    """转换为其他格式后是否保留原图"""
+
+    def target_size(self, width: int, height: int) -> Tuple[int, int]:
+        """计算缩放后的尺寸，保持宽高比，只缩小不放大"""
+        scale = 1.0
+        if self.max_side is not None:
+            scale = min(scale, self.max_side / max(width, height))
+        if self.max_pixels is not None:
+            scale = min(scale, math.sqrt(self.max_pixels / (width * height)))
+        if scale >= 1:
+            return width, height
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def output_path(self, image_path: str) -> str:
+        """转换后的图片路径"""
+        if self.format is None:
+            return image_path
+        return os.path.splitext(image_path)[0] + _FORMAT_EXTENSIONS[self.format]
+
+
+def _resize_frames(
+    image: "Image.Image", size: Tuple[int, int], target_format: str, all_frames: bool
+) -> List["Image.Image"]:
+    """缩放图片的帧，`all_frames` 为False时只处理第一帧"""
+    from PIL import Image  # noqa: PLC0415
+
+    if all_frames:
+        frames = []
+        for frame_index in range(image.n_frames):  # pyright: ignore[reportAttributeAccessIssue]
+            image.seek(frame_index)
+            frames.append(image.convert("RGBA").resize(size, Image.Resampling.LANCZOS))
+        return frames
+
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+    converted = image.convert("RGBA" if has_alpha else "RGB")
+    if converted.size != size:
+        converted = converted.resize(size, Image.Resampling.LANCZOS)
+    if target_format == "JPEG" and converted.mode == "RGBA":
+        # jpeg不支持透明通道，铺在白色背景上
+        background = Image.new("RGB", converted.size, (255, 255, 255))
+        background.paste(converted, mask=converted.getchannel("A"))
+        converted = background
+    return [converted]
+
+
+def convert_image(
+    image_path: str, options: ConvertOptions
+) -> Tuple[str, Optional[str]]:
+    """按 `options` 缩放并转换一张图片，可以在进程池中运行.
+
+    转换结果先写入同一目录下的临时文件，再原子地替换到 `options.output_path(image_path)`.
+    动图转换为webp时保留所有帧，转换为jpeg时只保留第一帧.
+
+    Args:
+        image_path: 图片路径
+        options: 转换参数
+
+    Returns:
+        tuple(转换后的图片路径, 错误信息)，成功时错误信息为None；失败时图片路径为 `image_path`
+    """
+    from PIL import Image  # noqa: PLC0415
+
+    output_path = options.output_path(image_path)
+    tmp_path = None
+    try:
+        with Image.open(image_path) as image:
+            size = options.target_size(*image.size)
+            target_format = (options.format or image.format or "").upper()
+            if size == image.size and output_path == image_path:
+                # 既不需要缩放也不需要转换
+                return image_path, None
+
+            save_all = target_format != "JPEG" and getattr(image, "is_animated", False)
+            frames = _resize_frames(image, size, target_format, save_all)
+
+            save_kwargs = {
+                key: image.info[key]
+                for key in ("icc_profile", "duration", "loop")
+                if key in image.info
+            }
+            if target_format in ("JPEG", "WEBP"):
+                save_kwargs["quality"] = options.quality
+
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=".converting-",
+                suffix=os.path.splitext(output_path)[1],
+                dir=os.path.dirname(output_path) or None,
+            )
+            with os.fdopen(fd, "wb") as f:
+                frames[0].save(
+                    f,
+                    format=target_format,
+                    save_all=save_all,
+                    append_images=frames[1:],
+                    **save_kwargs,
+                )
+
+        # mkstemp创建的文件权限为0600，替换前恢复原图的权限
+        shutil.copymode(image_path, tmp_path)
+        os.replace(tmp_path, output_path)
+        tmp_path = None
+        if output_path != image_path and not options.keep_original:
+            os.remove(image_path)
+        return output_path, None
+
+    except Exception as e:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return image_path, f"{type(e).__name__}: {e}"
+
+
+CONVERTED_INDEX_FILE_NAME = ".converted_index.jsonl"
+"""`ConvertedIndex` 的记录文件名"""
+
+
+class ConvertedIndex:
+    """下载目录中已经转换的图片的记录
+
+    只缩放而不改变格式时，转换结果会替换原图，文件名不变但md5已经改变，无法再通过md5判断图片是否已经下载.
+    每次转换成功后追加一条 `{"md5": 原图md5, "file": 转换结果文件名, "size": 文件大小, "mtime_ns": 修改时间}`，
+    同一个md5以最后一条为准；转换结果的大小和修改时间与记录一致时，就视为这张图片已经下载并转换完成.
+
+    多个进程同时下载到同一目录时可以共用这个文件，无法解析的行会被忽略，最多只会让一些图片被重新下载.
+
+    用法:
+        ```python
+        async with ConvertedIndex("images") as index:
+            if not await index.is_converted(md5, "images/1.jpg"):
+                ...
+                await index.add(md5, "images/1.jpg")
+        ```
+    """
+
+    def __init__(self, download_dir: str, batch_size: int = 100):
+        """转换记录
+
+        Args:
+            download_dir: 下载目录，记录写入其中的 `CONVERTED_INDEX_FILE_NAME`
+            batch_size: 缓存多少条记录后写入一次. Defaults to 100.
+        """
+        self.path = os.path.join(download_dir, CONVERTED_INDEX_FILE_NAME)
+        self._writer = BatchedJsonlWriter(self.path, batch_size=batch_size)
+        self._records: Dict[str, Tuple[str, int, int]] = {}
+
+    def _load(self) -> Dict[str, Tuple[str, int, int]]:
+        records: Dict[str, Tuple[str, int, int]] = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        records[record["md5"]] = (
+                            record["file"],
+                            record["size"],
+                            record["mtime_ns"],
+                        )
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # 中断或多个进程同时写入时可能留下不完整的行
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    async def open(self) -> None:
+        """读取已有的记录"""
+        self._records = await asyncio.to_thread(self._load)
+
+    async def is_converted(self, md5: str, path: str) -> bool:
+        """`path` 是否是md5为 `md5` 的图片的转换结果，并且在转换之后没有被改变"""
+        record = self._records.get(md5)
+        if record is None or record[0] != os.path.basename(path):
+            return False
+        try:
+            stat = await aiofiles.os.stat(path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == record[1:]
+
+    async def add(self, md5: str, path: str) -> None:
+        """记录 `path` 是md5为 `md5` 的图片的转换结果"""
+        stat = await aiofiles.os.stat(path)
+        file = os.path.basename(path)
+        self._records[md5] = (file, stat.st_size, stat.st_mtime_ns)
+        await self._writer.write(
+            {
+                "md5": md5,
+                "file": file,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+        )
+
+    async def close(self) -> None:
+        """写入剩余的记录"""
+        await self._writer.close()
+
+    async def __aenter__(self):  # noqa: D105
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:  # noqa: D105
+        await self.close()
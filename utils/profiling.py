@@ -0,0 +1,384 @@
+"""下载过程的性能分析：cProfile或采样分析、事件循环延迟、分阶段CPU时间和tracemalloc快照.
+
+`Profiler` 是一个异步上下文管理器，只在进入时才安装各种钩子，退出时移除并输出报告，
+所以不启用时对下载过程没有任何影响.
+
+分阶段CPU时间有两个来源:
+    - `stages` 中列出的同步函数(如API解析、tag处理、进度条渲染)，在进入时被替换为计时的包装函数.
+    - 线程池中运行的任务(aiofiles的读写、md5计算、`asyncio.to_thread` 等)，
+      包括 `utils.executors` 创建的文件I/O和md5线程池，
+      按任务函数的名称归类，例如 `_file_md5` 归为 `hashing`，`write` 归为 `writing`.
+每个阶段记录的是运行它的线程的CPU时间(`time.thread_time`)和墙钟时间.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence, Tuple
+
+__all__ = (
+    "PROFILE_MODES",
+    "LoopLagMonitor",
+    "Profiler",
+    "StackSampler",
+    "StageStats",
+)
+
+
+PROFILE_MODES = ("cprofile", "sample")
+
+THREAD_STAGES = {
+    "_file_md5": "hashing",
+    "update": "hashing",
+    "write": "writing",
+    "writelines": "writing",
+    "flush": "writing",
+    "read": "reading",
+}
+"""线程池中的任务函数名 -> 阶段名，其余任务归为 `thread:<函数名>`"""
+
+
+class StageStats:
+    """各阶段的调用次数、CPU时间和墙钟时间，可以被多个线程同时更新"""
+
+    def __init__(self):  # noqa: D107
+        self._lock = threading.Lock()
+        self.stats: Dict[str, List[float]] = {}
+        """阶段名 -> [调用次数, CPU秒数, 墙钟秒数]"""
+
+    def add(self, stage: str, cpu: float, wall: float) -> None:
+        """记录一次调用"""
+        with self._lock:
+            entry = self.stats.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += cpu
+            entry[2] += wall
+
+    def timed(self, stage: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """返回记录 `func` 每次调用耗时的包装函数"""
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            cpu_start = time.thread_time()
+            wall_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(
+                    stage,
+                    time.thread_time() - cpu_start,
+                    time.perf_counter() - wall_start,
+                )
+
+        return wrapper
+
+    def format(self) -> str:
+        """按CPU时间从高到低排列的表格"""
+        lines = [f"{'阶段':<20}{'调用次数':>10}{'CPU(s)':>12}{'墙钟(s)':>12}"]
+        for stage, (calls, cpu, wall) in sorted(
+            self.stats.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            lines.append(f"{stage:<20}{int(calls):>12}{cpu:>12.3f}{wall:>12.3f}")
+        return "\n".join(lines)
+
+
+def _thread_stage(fn: Callable[..., Any]) -> str:
+    """根据线程池中的任务函数判断阶段"""
+    # `asyncio.to_thread` 提交的是 `partial(contextvars.Context.run, func, ...)`
+    while isinstance(fn, functools.partial):
+        if isinstance(getattr(fn.func, "__self__", None), contextvars.Context):
+            fn = fn.args[0]
+        else:
+            fn = fn.func
+    name = getattr(fn, "__name__", type(fn).__name__)
+    return THREAD_STAGES.get(name, f"thread:{name}")
+
+
+def _timed_submit(
+    stage_stats: StageStats, submit: Callable[..., Any]
+) -> Callable[..., Any]:
+    """返回按阶段统计任务耗时的 `ThreadPoolExecutor.submit`
+
+    替换的是类的方法，所以无论线程池在分析开始之前还是之后创建、是否被设置为默认线程池，都会被统计.
+    """
+
+    @functools.wraps(submit)
+    def wrapper(
+        self: concurrent.futures.ThreadPoolExecutor,
+        fn: Callable[..., Any],
+        /,
+        *args: Any,
+        **kwargs: Any,
+    ) -> "concurrent.futures.Future[Any]":
+        return submit(self, stage_stats.timed(_thread_stage(fn), fn), *args, **kwargs)
+
+    return wrapper
+
+
+class LoopLagMonitor:
+    """定期调度一个协程，用实际唤醒时间与预期的差值衡量事件循环的延迟"""
+
+    def __init__(self, interval: float = 0.05):
+        """事件循环延迟监视器
+
+        Args:
+            interval: 采样间隔，单位为秒. Defaults to 0.05.
+        """
+        self.interval = interval
+        self.samples: List[float] = []
+        """每次采样的延迟，单位为秒"""
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self) -> None:
+        """开始采样，必须在事件循环中调用"""
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        """停止采样"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def format(self) -> str:
+        """延迟的分位数"""
+        if not self.samples:
+            return "事件循环延迟: 没有采样"
+        samples = sorted(self.samples)
+
+        def quantile(q: float) -> float:
+            return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+        return (
+            f"事件循环延迟: 采样 {len(samples)} 次，p50: {quantile(0.5):.1f}ms，"
+            f"p99: {quantile(0.99):.1f}ms，最大: {samples[-1] * 1000:.1f}ms"
+        )
+
+
+class StackSampler:
+    """在后台线程中定期采样一个线程的调用栈，结果为flamegraph使用的折叠栈格式"""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        """调用栈采样器
+
+        Args:
+            thread_id: 被采样的线程，通常为事件循环所在的线程
+            interval: 采样间隔，单位为秒. Defaults to 0.005.
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        """折叠栈 -> 采样次数"""
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self) -> None:
+        """开始采样"""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """停止采样"""
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, path: str) -> None:
+        """保存折叠栈，可以用flamegraph.pl或speedscope查看"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def format(self, limit: int = 15) -> str:
+        """采样次数最多的栈顶函数"""
+        total = sum(self.stacks.values())
+        leaves: Counter[str] = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"采样 {total} 次，栈顶函数:"]
+        for name, count in leaves.most_common(limit):
+            lines.append(f"{count / max(total, 1):>7.1%}  {name}")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """下载过程的性能分析器
+
+    用法:
+        ```python
+        async with Profiler(
+            "sample", "profile_out", stages=[(module, "func", "stage")]
+        ):
+            await scrape_images(...)
+        ```
+
+    退出时打印报告，并在 `output_dir` 中保存:
+        - `profile.pstats`(cprofile模式)或 `profile.folded`(sample模式)
+        - `tracemalloc_<序号>.snapshot`(启用tracemalloc时)，可以用 `tracemalloc.Snapshot.load` 读取
+    """
+
+    def __init__(
+        self,
+        mode: Literal["cprofile", "sample"],
+        output_dir: str,
+        stages: Sequence[Tuple[Any, str, str]] = (),
+        lag_interval: float = 0.05,
+        tracemalloc_frames: int = 0,
+        tracemalloc_interval: Optional[float] = None,
+    ):
+        """下载过程的性能分析器
+
+        Args:
+            mode: "cprofile" 为确定性分析事件循环线程，"sample" 为定期采样事件循环线程的调用栈，开销更低.
+            output_dir: 保存结果的目录
+            stages: 需要统计CPU时间的同步函数，每项为 `(所属对象, 属性名, 阶段名)`. Defaults to ().
+            lag_interval: 事件循环延迟的采样间隔，单位为秒. Defaults to 0.05.
+            tracemalloc_frames: tracemalloc记录的栈帧数，0则不启用. Defaults to 0.
+            tracemalloc_interval: 每隔多少秒保存一次tracemalloc快照，`None` 则只在结束时保存.
+                Defaults to None.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"mode 必须是 {PROFILE_MODES} 之一，而不是 {mode}")
+        self.mode = mode
+        self.output_dir = output_dir
+        self.stages = stages
+        self.tracemalloc_frames = tracemalloc_frames
+        self.tracemalloc_interval = tracemalloc_interval
+        self.stage_stats = StageStats()
+        self.lag_monitor = LoopLagMonitor(lag_interval)
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[StackSampler] = None
+        self._patched: List[Tuple[Any, str, Any]] = []
+        self._snapshot_task: Optional[asyncio.Task[None]] = None
+        self._snapshot_count = 0
+        self._cpu_start = 0.0
+        self._wall_start = 0.0
+
+    async def __aenter__(self) -> "Profiler":  # noqa: D105
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        for owner, attr, stage in self.stages:
+            original = (
+                owner.__dict__[attr]
+                if isinstance(owner, type)
+                else getattr(owner, attr)
+            )
+            self._patched.append((owner, attr, original))
+            setattr(owner, attr, self.stage_stats.timed(stage, original))
+        executor_type = concurrent.futures.ThreadPoolExecutor
+        self._patched.append((executor_type, "submit", executor_type.submit))
+        executor_type.submit = _timed_submit(self.stage_stats, executor_type.submit)
+
+        if self.tracemalloc_frames > 0:
+            tracemalloc.start(self.tracemalloc_frames)
+            if self.tracemalloc_interval is not None:
+                self._snapshot_task = asyncio.create_task(self._snapshot_periodically())
+
+        self.lag_monitor.start()
+        self._cpu_start = time.thread_time()
+        self._wall_start = time.perf_counter()
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = StackSampler(threading.get_ident())
+            self._sampler.start()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:  # noqa: D105
+        if self._profile is not None:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        loop_cpu = time.thread_time() - self._cpu_start
+        wall = time.perf_counter() - self._wall_start
+        self.lag_monitor.stop()
+
+        for owner, attr, original in reversed(self._patched):
+            setattr(owner, attr, original)
+        self._patched.clear()
+
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+        if tracemalloc.is_tracing():
+            snapshot = self._dump_snapshot()
+            tracemalloc.stop()
+        else:
+            snapshot = None
+
+        self._report(loop_cpu, wall, snapshot)
+
+    async def _snapshot_periodically(self) -> None:
+        assert self.tracemalloc_interval is not None
+        while True:
+            await asyncio.sleep(self.tracemalloc_interval)
+            await asyncio.to_thread(self._dump_snapshot)
+
+    def _dump_snapshot(self) -> tracemalloc.Snapshot:
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(
+            os.path.join(
+                self.output_dir, f"tracemalloc_{self._snapshot_count}.snapshot"
+            )
+        )
+        self._snapshot_count += 1
+        return snapshot
+
+    def _report(
+        self, loop_cpu: float, wall: float, snapshot: Optional[tracemalloc.Snapshot]
+    ) -> None:
+        print("*#" * 20)
+        print("性能分析")
+        print(
+            f"墙钟时间: {wall:.2f}s，事件循环线程CPU: {loop_cpu:.2f}s ({loop_cpu / max(wall, 1e-9):.0%})"
+        )
+        print(self.lag_monitor.format())
+        print(self.stage_stats.format())
+
+        if self._profile is not None:
+            path = os.path.join(self.output_dir, "profile.pstats")
+            self._profile.dump_stats(path)
+            stream = io.StringIO()
+            pstats.Stats(self._profile, stream=stream).sort_stats(
+                "tottime"
+            ).print_stats(15)
+            print(stream.getvalue())
+            print(f"cProfile结果已保存到: {path}")
+        if self._sampler is not None:
+            path = os.path.join(self.output_dir, "profile.folded")
+            self._sampler.save(path)
+            print(self._sampler.format())
+            print(f"折叠栈已保存到: {path}")
+
+        if snapshot is not None:
+            print("内存分配最多的位置:")
+            for stat in snapshot.statistics("lineno")[:10]:
+                print(stat)
+            print(f"tracemalloc快照已保存到: {self.output_dir}")
@@ -1,6 +1,9 @@
 $images_dir = "images"    # 要检查的目录 | the folder path to check images
 $debug = 1    # 是否打印处理信息，$mode等于0时将强制开启 | whether to print debug info, will be forced to open when $mode is 0
 $max_workers = 10    # 处理线程数 | number of threads to process
+$engine = "thread"    # thread为线程池，process为进程池，图片很多时进程池更快 | thread pool or process pool, process is faster for many images
+$use_cache = 0    # 是否跳过上次通过检查后没有改变的图片 | whether to skip images unchanged since they last passed
+$fast = 0    # 是否只检查图片结构而不解码像素，结构可疑时才完整解码 | whether to only check image structure, full decoding only for suspicious images
 
 # 处理模式，0只展示错误信息，1会修复图片保留未阶段部分，2会删除错误图片 |
 # mode for processing, 0 for only showing error messages, 1 for trying to fix images, 2 for deleting error images
@@ -15,11 +18,18 @@ $ext_args = [System.Collections.ArrayList]::new()
 if ($debug -or $mode -eq 0) {
   [void]$ext_args.Add("--debug")
 }
+if ($use_cache) {
+  [void]$ext_args.Add("--use_cache")
+}
+if ($fast) {
+  [void]$ext_args.Add("--fast")
+}
 
 python check_images.py `
   $images_dir `
   --mode=$mode `
   --max_workers=$max_workers `
+  --engine=$engine `
   $ext_args
   
 pause
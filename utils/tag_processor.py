@@ -0,0 +1,184 @@
+"""带缓存的tags处理器，用于将gelbooru的tags字符串转换为训练用的caption."""
+
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+__all__ = (
+    "TagProcessor",
+    "load_tag_aliases",
+    "load_tag_list",
+)
+
+
+def _normalize_tag(tag: str) -> str:
+    """将用户输入的tag统一为gelbooru的原始形式，即用下划线代替空格"""
+    return tag.strip().replace(" ", "_")
+
+
+def load_tag_list(path: str) -> List[str]:
+    """从文本文件中读取tags，每行一个，忽略空行和以 `#` 开头的行"""
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def load_tag_aliases(path: str) -> Dict[str, str]:
+    """从文本文件中读取tag别名，每行为 `原tag 新tag`，忽略空行和以 `#` 开头的行"""
+    aliases: Dict[str, str] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            try:
+                old, new = line.split()
+            except ValueError as e:
+                raise ValueError(
+                    f"无法解析别名 {line!r}，格式应为 `原tag 新tag`"
+                ) from e
+            aliases[old] = new
+    return aliases
+
+
+class _TagCache(Dict[str, Optional[str]]):
+    """有界的tag转换缓存.
+
+    命中时就是一次普通的字典查询；未命中时由 `__missing__` 计算并缓存.
+    缓存满时整体清空，而不是在每次命中时维护LRU顺序，
+    因为对于这种廉价的转换，维护LRU顺序的开销比转换本身还大.
+    """
+
+    def __init__(
+        self,
+        transform: Callable[[str], Optional[str]],
+        maxsize: Optional[int],
+    ):
+        super().__init__()
+        self.transform = transform
+        self.maxsize = maxsize
+        self.misses = 0
+
+    def __missing__(self, tag: str) -> Optional[str]:
+        self.misses += 1
+        if self.maxsize is not None and len(self) >= self.maxsize:
+            self.clear()
+        result = self[tag] = self.transform(tag)
+        return result
+
+
+class TagProcessor:
+    r"""带缓存的tags处理器.
+
+    同样的几千个tag会在上百万个post中反复出现，所以每个tag的转换结果都会被缓存在一个有界的缓存中，
+    处理一个post只需要一次 `split` 和若干次字典查询.
+
+    处理顺序为: 别名 -> 黑白名单过滤 -> 下划线替换和转义 -> 排序 -> 去重.
+    其中别名、黑白名单和优先tag都使用gelbooru的原始tag形式匹配(空格会被视为下划线).
+
+    用法:
+        ```python
+        processor = TagProcessor(
+            blacklist=["watermark"], priority_tags=["hifumi_(blue_archive)"]
+        )
+        processor("1girl hifumi_(blue_archive) watermark")
+        # 'hifumi \\(blue archive\\), 1girl'
+        ```
+    """
+
+    def __init__(
+        self,
+        add_comma: bool = True,
+        remove_underscore: bool = True,
+        use_escape: bool = True,
+        blacklist: Optional[Iterable[str]] = None,
+        whitelist: Optional[Iterable[str]] = None,
+        aliases: Optional[Mapping[str, str]] = None,
+        priority_tags: Optional[Sequence[str]] = None,
+        deduplicate: bool = True,
+        cache_size: Optional[int] = 65536,
+    ):
+        r"""带缓存的tags处理器
+
+        Args:
+            add_comma: 是否用 `, ` 分割tags，否则用空格分割. Defaults to True.
+            remove_underscore: 是否将tag中的下划线换成空格，长度不大于3的tag(如 `>_<`)除外. Defaults to True.
+            use_escape: 是否将tag中的 `(` 和 `)` 转义为 `\(` 和 `\)`，长度不大于3的tag除外. Defaults to True.
+            blacklist: 需要移除的tags. Defaults to None.
+            whitelist: 只保留这些tags，`None` 则不限制. Defaults to None.
+            aliases: tag别名，`{原tag: 新tag}`，新tag不会再次查找别名. Defaults to None.
+            priority_tags: 需要排在最前面的tags(例如角色和画师)，按此顺序排列，
+                其余tags保持原有顺序. Defaults to None.
+            deduplicate: 是否移除重复的tags(例如别名产生的重复). Defaults to True.
+            cache_size: tag转换结果的缓存大小，`None` 则不限制. Defaults to 65536.
+        """
+        self.add_comma = add_comma
+        self.remove_underscore = remove_underscore
+        self.use_escape = use_escape
+        self.blacklist: FrozenSet[str] = frozenset(map(_normalize_tag, blacklist or ()))
+        self.whitelist: Optional[FrozenSet[str]] = (
+            None if whitelist is None else frozenset(map(_normalize_tag, whitelist))
+        )
+        self.aliases: Dict[str, str] = {
+            _normalize_tag(k): _normalize_tag(v) for k, v in (aliases or {}).items()
+        }
+        self.priority: Dict[str, int] = {
+            _normalize_tag(tag): rank for rank, tag in enumerate(priority_tags or ())
+        }
+        self.deduplicate = deduplicate
+        self.separator = ", " if add_comma else " "
+
+        # 每个实例有自己的缓存，配置不同的处理器之间不会互相污染
+        self._cache = _TagCache(self._transform_tag, cache_size)
+        # 优先tag转换后的排序优先级，大小不超过 `priority_tags`
+        self._ranks: Dict[str, int] = {}
+        self._has_filter = bool(self.blacklist) or self.whitelist is not None
+
+    def _transform_tag(self, tag: str) -> Optional[str]:
+        """转换单个tag，被过滤时返回None"""
+        tag = self.aliases.get(tag, tag)
+        if tag in self.blacklist:
+            return None
+        if self.whitelist is not None and tag not in self.whitelist:
+            return None
+
+        rank = self.priority.get(tag)
+        if len(tag) > 3:  # ignore emoji tags like >_< and ^_^
+            if self.remove_underscore:
+                tag = tag.replace("_", " ")
+            if self.use_escape:
+                tag = tag.replace("(", "\\(").replace(")", "\\)")
+        if rank is not None:
+            self._ranks[tag] = rank
+        return tag
+
+    def process(self, tags: str) -> str:
+        """处理gelbooru以空格分割的tags字符串，返回处理后的字符串"""
+        # 命中缓存时整个转换都在C层面完成
+        tag_list: List[Optional[str]] = list(
+            map(self._cache.__getitem__, tags.split(" "))
+        )
+        if self._has_filter:
+            tag_list = [tag for tag in tag_list if tag is not None]
+        ranks = self._ranks
+        if ranks and not ranks.keys().isdisjoint(tag_list):
+            # 优先tag按优先级排在前面，其余tag保持原有顺序
+            first = sorted(
+                (tag for tag in tag_list if tag in ranks), key=ranks.__getitem__
+            )
+            tag_list = first + [tag for tag in tag_list if tag not in ranks]
+        if self.deduplicate:
+            tag_list = list(dict.fromkeys(tag_list))
+        return self.separator.join(tag_list)  # pyright: ignore[reportArgumentType]
+
+    __call__ = process
+
+    def cache_info(self) -> Tuple[int, int]:
+        """返回tag转换缓存的(未命中次数, 当前大小)"""
+        return self._cache.misses, len(self._cache)
@@ -0,0 +1,554 @@
+"""数据集的tag频率和共现统计.
+
+所有caption被转换为一个稀疏的 文档-tag 矩阵(CSR格式: `indptr` 和 `indices` 两个numpy数组)，
+统计都是在这个矩阵上的向量化运算:
+
+- tag频率: `np.bincount(indices)`
+- 与某个tag共现的tags: 找出包含该tag的文档，再对这些文档的 `indices` 做一次 `bincount`
+- 高频tags之间的共现矩阵: 按文档分块构造稠密的0/1矩阵 `X`，累加 `X.T @ X`
+
+矩阵会被缓存到数据集目录下的 `.tag_stats.npz`，caption没有改变时直接读取缓存.
+
+需要安装numpy.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.captions import (
+    CAPTION_FORMATS,
+    JSONL_CAPTION_FILE_NAME,
+    KOHYA_JSON_CAPTION_FILE_NAME,
+)
+
+__all__ = (
+    "TAG_STATS_CACHE_FILE_NAME",
+    "TagMatrix",
+    "TagMatrixBuilder",
+    "iter_captions",
+    "load_tag_matrix",
+    "print_tag_stats",
+)
+
+
+TAG_STATS_CACHE_FILE_NAME = ".tag_stats.npz"
+"""`load_tag_matrix` 在数据集目录下的缓存文件名"""
+
+# 计算共现矩阵时每块的文档数，限制稠密中间矩阵的内存占用
+_COOCCURRENCE_CHUNK_SIZE = 16384
+# 在进程池中解析caption时，每个任务的JSONL字节数和txt文件数
+_PARSE_JSONL_CHUNK_SIZE = 32 * 1024 * 1024
+_PARSE_TXT_CHUNK_SIZE = 20000
+
+
+class _Vocabulary(Dict[str, int]):
+    """未知的tag在第一次查询时被分配下一个id"""
+
+    def __missing__(self, tag: str) -> int:
+        tag_id = self[tag] = len(self)
+        return tag_id
+
+
+class TagMatrix:
+    """稀疏的 文档-tag 矩阵，每个文档(图片)一行，每个tag一列，同一文档中重复的tag只计一次"""
+
+    def __init__(
+        self,
+        vocab: Sequence[str],
+        names: Sequence[str],
+        indptr: np.ndarray,
+        indices: np.ndarray,
+    ):
+        """稀疏的 文档-tag 矩阵
+
+        Args:
+            vocab: tag列表，下标为tag的id
+            names: 文档(图片)名列表，下标为行号
+            indptr: CSR格式的行指针，第 `i` 行的tag id为 `indices[indptr[i]:indptr[i+1]]`
+            indices: CSR格式的列下标，即tag id
+        """
+        self.vocab = list(vocab)
+        self.names = list(names)
+        self.indptr = indptr
+        self.indices = indices
+        self._tag_ids = {tag: i for i, tag in enumerate(self.vocab)}
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        """(文档数, tag数)"""
+        return len(self.names), len(self.vocab)
+
+    def tag_id(self, tag: str) -> int:
+        """tag的id，不存在时引发 `KeyError`"""
+        return self._tag_ids[tag]
+
+    def frequencies(self) -> np.ndarray:
+        """每个tag出现的文档数，下标为tag id"""
+        return np.bincount(self.indices, minlength=len(self.vocab))
+
+    def top_k(self, k: int) -> List[Tuple[str, int]]:
+        """出现次数最多的 `k` 个tags，`[(tag, 文档数), ...]`"""
+        frequencies = self.frequencies()
+        k = min(k, len(frequencies))
+        top = np.argpartition(-frequencies, k - 1)[:k] if k else np.empty(0, int)
+        top = top[np.argsort(-frequencies[top], kind="stable")]
+        return [(self.vocab[i], int(frequencies[i])) for i in top]
+
+    def _rows_of_indices(self) -> np.ndarray:
+        """`indices` 中每个元素所在的行号"""
+        return np.repeat(np.arange(len(self.names)), np.diff(self.indptr))
+
+    def cooccurring(self, tag: str, k: int) -> List[Tuple[str, int, float]]:
+        """与 `tag` 共同出现最多的 `k` 个tags
+
+        Returns:
+            `[(tag, 共现文档数, 共现文档数 / tag的文档数), ...]`
+        """
+        tag_id = self.tag_id(tag)
+        has_tag = np.zeros(len(self.names), dtype=bool)
+        has_tag[self._rows_of_indices()[self.indices == tag_id]] = True
+        # 包含tag的文档中所有tag的出现次数
+        mask = np.repeat(has_tag, np.diff(self.indptr))
+        counts = np.bincount(self.indices[mask], minlength=len(self.vocab))
+        total = counts[tag_id]
+        counts[tag_id] = 0
+        k = min(k, int(np.count_nonzero(counts)))
+        top = np.argpartition(-counts, k - 1)[:k] if k else np.empty(0, int)
+        top = top[np.argsort(-counts[top], kind="stable")]
+        return [(self.vocab[i], int(counts[i]), float(counts[i] / total)) for i in top]
+
+    def cooccurrence(self, tags: Sequence[str]) -> np.ndarray:
+        """`tags` 两两之间的共现文档数矩阵，对角线为每个tag的文档数"""
+        tag_ids = np.array([self.tag_id(tag) for tag in tags], dtype=np.int64)
+        # 把tag id映射为 `tags` 中的列号，不在 `tags` 中的为-1
+        columns = np.full(len(self.vocab), -1, dtype=np.int64)
+        columns[tag_ids] = np.arange(len(tag_ids))
+
+        result = np.zeros((len(tag_ids), len(tag_ids)), dtype=np.float64)
+        for start in range(0, len(self.names), _COOCCURRENCE_CHUNK_SIZE):
+            stop = min(start + _COOCCURRENCE_CHUNK_SIZE, len(self.names))
+            low, high = self.indptr[start], self.indptr[stop]
+            chunk_columns = columns[self.indices[low:high]]
+            chunk_rows = np.repeat(
+                np.arange(stop - start), np.diff(self.indptr[start : stop + 1])
+            )
+            keep = chunk_columns >= 0
+            dense = np.zeros((stop - start, len(tag_ids)), dtype=np.float32)
+            dense[chunk_rows[keep], chunk_columns[keep]] = 1
+            result += dense.T @ dense
+        return result.astype(np.int64)
+
+    def save(self, path: str, signature: Sequence[object] = ()) -> None:
+        """保存矩阵，`signature` 为可以json序列化的值，用于判断缓存是否过期"""
+        # 先写入临时文件再替换，避免中途退出时损坏已有的缓存
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vocab=np.array(self.vocab, dtype=str),
+                names=np.array(self.names, dtype=str),
+                indptr=self.indptr,
+                indices=self.indices,
+                signature=np.array(json.dumps(list(signature))),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Tuple["TagMatrix", List[object]]:
+        """读取矩阵，返回tuple(矩阵, 保存时的signature)"""
+        with np.load(path) as data:
+            matrix = cls(
+                data["vocab"].tolist(),
+                data["names"].tolist(),
+                data["indptr"],
+                data["indices"],
+            )
+            return matrix, json.loads(str(data["signature"]))
+
+
+class TagMatrixBuilder:
+    """逐个添加caption，构造 `TagMatrix`
+
+    用法:
+        ```python
+        builder = TagMatrixBuilder(separator=",")
+        builder.add("1.jpg", "1girl, solo")
+        matrix = builder.build()
+        ```
+    """
+
+    def __init__(self, separator: str = ","):
+        """`TagMatrix` 构造器
+
+        Args:
+            separator: caption中tags的分隔符，分割后会去掉两端的空白. Defaults to ",".
+        """
+        self.separator = separator
+        self._vocab = _Vocabulary()
+        self._names: List[str] = []
+        self._indices: List[int] = []
+        self._indptr: List[int] = [0]
+
+    def add(self, name: str, caption: str) -> None:
+        """添加一个文档(图片)的caption"""
+        tags = set(map(str.strip, caption.split(self.separator)))
+        tags.discard("")
+        self._indices.extend(map(self._vocab.__getitem__, tags))
+        self._indptr.append(len(self._indices))
+        self._names.append(name)
+
+    def build(self) -> TagMatrix:
+        """构造 `TagMatrix`"""
+        return TagMatrix(
+            list(self._vocab),
+            self._names,
+            np.array(self._indptr, dtype=np.int64),
+            np.array(self._indices, dtype=np.int32),
+        )
+
+
+def _merge_matrices(chunks: Iterable[Tuple[TagMatrix, Sequence[str]]]) -> TagMatrix:
+    """按顺序合并多个 `(矩阵, 被移除的文档名)`，同名的文档以最后一次出现为准
+
+    每个矩阵的tag id通过一次数组索引映射为合并后的id.
+    """
+    vocab = _Vocabulary()
+    names: List[str] = []
+    last_rows: Dict[str, int] = {}
+    indptr_list = [np.zeros(1, dtype=np.int64)]
+    indices_list = [np.empty(0, dtype=np.int32)]
+    offset = 0
+    for matrix, removed in chunks:
+        remap = np.fromiter(
+            map(vocab.__getitem__, matrix.vocab),
+            dtype=np.int32,
+            count=len(matrix.vocab),
+        )
+        indices_list.append(remap[matrix.indices])
+        indptr_list.append(matrix.indptr[1:] + offset)
+        offset += len(matrix.indices)
+
+        last_rows.update(
+            zip(matrix.names, range(len(names), len(names) + len(matrix.names)))
+        )
+        names.extend(matrix.names)
+        for name in removed:
+            last_rows.pop(name, None)
+
+    indptr = np.concatenate(indptr_list)
+    indices = np.concatenate(indices_list)
+    if len(last_rows) < len(names):
+        keep = np.zeros(len(names), dtype=bool)
+        keep[np.fromiter(last_rows.values(), dtype=np.int64, count=len(last_rows))] = (
+            True
+        )
+        lengths = np.diff(indptr)
+        indices = indices[np.repeat(keep, lengths)]
+        indptr = np.concatenate([[0], np.cumsum(lengths[keep])])
+        names = [name for name, kept in zip(names, keep.tolist()) if kept]
+
+    return TagMatrix(list(vocab), names, indptr, indices)
+
+
+def _parse_jsonl_range(
+    path: str, start: int, end: int, separator: str
+) -> Tuple[TagMatrix, List[str]]:
+    """解析JSONL文件中从 `[start, end)` 开始的行，可以在进程池中运行
+
+    Returns:
+        tuple(矩阵, 被移除的文件名)，被移除的文件名只包括在本范围内最后一次出现时被移除的，
+        其中也可能包括在本范围内先被添加后被移除的
+    """
+    builder = TagMatrixBuilder(separator=separator)
+    removed: Dict[str, None] = {}
+    with open(path, "rb") as f:
+        if start:
+            # 从 `start` 之后的第一个完整的行开始
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次运行中断时可能残留不完整的最后一行
+                continue
+            if record["tags"] is None:
+                removed[record["file"]] = None
+            else:
+                removed.pop(record["file"], None)
+                builder.add(record["file"], record["tags"])
+    return builder.build(), list(removed)
+
+
+def _parse_txt_files(
+    dataset_dir: str, names: Sequence[str], separator: str
+) -> Tuple[TagMatrix, List[str]]:
+    """读取一批 `.txt` caption文件，可以在进程池中运行"""
+    builder = TagMatrixBuilder(separator=separator)
+    for name in names:
+        with open(os.path.join(dataset_dir, name + ".txt"), encoding="utf-8") as f:
+            builder.add(name, f.read())
+    return builder.build(), []
+
+
+def _caption_source(dataset_dir: str, caption_format: str) -> str:
+    if caption_format == "jsonl":
+        return os.path.join(dataset_dir, JSONL_CAPTION_FILE_NAME)
+    if caption_format == "json":
+        return os.path.join(dataset_dir, KOHYA_JSON_CAPTION_FILE_NAME)
+    return dataset_dir
+
+
+def _iter_txt_entries(dataset_dir: str) -> Iterator[os.DirEntry]:
+    with os.scandir(dataset_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".txt") and entry.is_file():
+                yield entry
+
+
+def _signature(dataset_dir: str, caption_format: str) -> List[int]:
+    """caption来源的指纹，caption改变时指纹也会改变"""
+    if caption_format == "txt":
+        count, total_size, max_mtime = 0, 0, 0
+        for entry in _iter_txt_entries(dataset_dir):
+            stat = entry.stat()
+            count += 1
+            total_size += stat.st_size
+            max_mtime = max(max_mtime, stat.st_mtime_ns)
+        return [count, total_size, max_mtime]
+    stat = os.stat(_caption_source(dataset_dir, caption_format))
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def iter_captions(dataset_dir: str, caption_format: str) -> Iterable[Tuple[str, str]]:
+    """读取数据集中的所有caption，产出 `(文档名, caption)`
+
+    Args:
+        dataset_dir: 数据集目录
+        caption_format: `CAPTION_FORMATS` 中的一个，含义与 `make_caption_sink` 相同
+
+    Raises:
+        ValueError: `caption_format` 不合法
+    """
+    if caption_format == "txt":
+        for entry in _iter_txt_entries(dataset_dir):
+            with open(entry.path, encoding="utf-8") as f:
+                yield entry.name[: -len(".txt")], f.read()
+    elif caption_format == "jsonl":
+        captions: Dict[str, str] = {}
+        with open(_caption_source(dataset_dir, caption_format), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record["tags"] is None:
+                    captions.pop(record["file"], None)
+                else:
+                    captions[record["file"]] = record["tags"]
+        yield from captions.items()
+    elif caption_format == "json":
+        with open(_caption_source(dataset_dir, caption_format), encoding="utf-8") as f:
+            metadata = json.load(f)
+        for key, item in metadata.items():
+            if "tags" in item:
+                yield key, item["tags"]
+    else:
+        raise ValueError(f"caption_format参数非法，只能为{CAPTION_FORMATS}中的一个")
+
+
+def _build_tag_matrix(
+    dataset_dir: str, caption_format: str, separator: str, max_workers: Optional[int]
+) -> TagMatrix:
+    if caption_format == "txt":
+        names = [entry.name[: -len(".txt")] for entry in _iter_txt_entries(dataset_dir)]
+        tasks = [
+            (_parse_txt_files, dataset_dir, names[i : i + _PARSE_TXT_CHUNK_SIZE])
+            for i in range(0, len(names), _PARSE_TXT_CHUNK_SIZE)
+        ]
+    elif caption_format == "jsonl":
+        path = _caption_source(dataset_dir, caption_format)
+        size = os.path.getsize(path)
+        tasks = [
+            (
+                _parse_jsonl_range,
+                path,
+                start,
+                min(start + _PARSE_JSONL_CHUNK_SIZE, size),
+            )
+            for start in range(0, size, _PARSE_JSONL_CHUNK_SIZE)
+        ]
+    else:
+        builder = TagMatrixBuilder(separator=separator)
+        for name, caption in iter_captions(dataset_dir, caption_format):
+            builder.add(name, caption)
+        return builder.build()
+
+    if len(tasks) <= 1:
+        results = [func(*args, separator) for func, *args in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers
+        ) as executor:
+            futures = [executor.submit(func, *args, separator) for func, *args in tasks]
+            # 必须按顺序合并，JSONL中同一个文件名以最后一行为准
+            results = [future.result() for future in futures]
+
+    return _merge_matrices(results)
+
+
+def load_tag_matrix(
+    dataset_dir: str,
+    caption_format: str = "txt",
+    separator: str = ",",
+    use_cache: bool = True,
+    max_workers: Optional[int] = None,
+) -> TagMatrix:
+    """读取数据集的 文档-tag 矩阵，caption没有改变时使用缓存
+
+    `txt` 和 `jsonl` 格式的caption会被分块，在进程池中并行解析后再合并.
+
+    Args:
+        dataset_dir: 数据集目录
+        caption_format: `CAPTION_FORMATS` 中的一个. Defaults to "txt".
+        separator: caption中tags的分隔符. Defaults to ",".
+        use_cache: 是否读取和写入 `.tag_stats.npz` 缓存. Defaults to True.
+        max_workers: 解析caption的进程数，`None` 则为CPU核心数. Defaults to None.
+    """
+    cache_path = os.path.join(dataset_dir, TAG_STATS_CACHE_FILE_NAME)
+    signature = [caption_format, separator, *_signature(dataset_dir, caption_format)]
+
+    if use_cache:
+        try:
+            matrix, cached_signature = TagMatrix.load(cache_path)
+            if cached_signature == signature:
+                return matrix
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"无法读取tag统计缓存 {cache_path}，将重新统计, error: {e}")
+
+    matrix = _build_tag_matrix(dataset_dir, caption_format, separator, max_workers)
+
+    if use_cache:
+        try:
+            matrix.save(cache_path, signature)
+        except Exception as e:
+            logging.warning(f"无法写入tag统计缓存 {cache_path}, error: {e}")
+    return matrix
+
+
+def print_tag_stats(
+    matrix: TagMatrix,
+    top_k: int = 50,
+    tags: Optional[Sequence[str]] = None,
+    cooccurrence_k: int = 20,
+) -> None:
+    """打印tag频率和共现统计
+
+    Args:
+        matrix: 文档-tag 矩阵
+        top_k: 打印出现次数最多的多少个tags. Defaults to 50.
+        tags: 需要打印共现统计的tags，`None` 则打印前 `cooccurrence_k` 个高频tags之间的共现矩阵.
+            Defaults to None.
+        cooccurrence_k: 共现统计的数量. Defaults to 20.
+    """
+    documents, vocab_size = matrix.shape
+    print(f"文档数: {documents}，tag数: {vocab_size}，tag总数: {len(matrix.indices)}")
+
+    print(f"\n出现次数最多的 {top_k} 个tags:")
+    for tag, count in matrix.top_k(top_k):
+        print(f"{count:>10} {count / max(documents, 1):>8.2%}  {tag}")
+
+    if tags:
+        for tag in tags:
+            try:
+                cooccurring = matrix.cooccurring(tag, cooccurrence_k)
+            except KeyError:
+                print(f"\n数据集中没有 {tag}")
+                continue
+            print(f"\n与 {tag} 共同出现最多的 {cooccurrence_k} 个tags:")
+            for other, count, ratio in cooccurring:
+                print(f"{count:>10} {ratio:>8.2%}  {other}")
+        return
+
+    top_tags = [tag for tag, _ in matrix.top_k(cooccurrence_k)]
+    counts = matrix.cooccurrence(top_tags)
+    print(f"\n前 {len(top_tags)} 个高频tags之间的共现(行tag出现时列tag也出现的比例):")
+    ratios = counts / np.maximum(np.diag(counts), 1)[:, None]
+    for tag, row in zip(top_tags, ratios):
+        print(f"{tag[:24]:<24} " + " ".join(f"{ratio:>4.0%}" for ratio in row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("dataset_dir", type=str, help="数据集目录")
+    parser.add_argument(
+        "--matrix",
+        type=str,
+        default=None,
+        help="直接读取保存的矩阵文件(例如下载时保存的.tag_stats_scrape.npz)，而不是读取caption",
+    )
+    parser.add_argument(
+        "--caption_format",
+        type=str,
+        default="txt",
+        choices=CAPTION_FORMATS,
+        help="caption的保存格式，与下载时的caption_format相同",
+    )
+    parser.add_argument(
+        "--separator", type=str, default=",", help="caption中tags的分隔符"
+    )
+    parser.add_argument(
+        "--top_k", type=int, default=50, help="打印出现次数最多的多少个tags"
+    )
+    parser.add_argument(
+        "--tags",
+        type=str,
+        nargs="*",
+        default=None,
+        help="需要打印共现统计的tags，默认打印高频tags之间的共现矩阵",
+    )
+    parser.add_argument("--cooccurrence_k", type=int, default=20, help="共现统计的数量")
+    parser.add_argument(
+        "--no_cache", action="store_true", help="不读取也不写入.tag_stats.npz缓存"
+    )
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="解析caption的进程数"
+    )
+
+    cmd_param, unknown = parser.parse_known_args()
+    if unknown:
+        logging.warning(f"以下输入参数非法，将被忽略：\n{unknown}")
+
+    start = time.perf_counter()
+    if cmd_param.matrix is not None:
+        tag_matrix, _ = TagMatrix.load(cmd_param.matrix)
+    else:
+        tag_matrix = load_tag_matrix(
+            cmd_param.dataset_dir,
+            caption_format=cmd_param.caption_format,
+            separator=cmd_param.separator,
+            use_cache=not cmd_param.no_cache,
+            max_workers=cmd_param.max_workers,
+        )
+    print(f"读取耗时 {time.perf_counter() - start:.2f}s")
+    print_tag_stats(
+        tag_matrix,
+        top_k=cmd_param.top_k,
+        tags=cmd_param.tags,
+        cooccurrence_k=cmd_param.cooccurrence_k,
+    )
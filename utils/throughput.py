@@ -0,0 +1,111 @@
+"""下载速度和传输状态的统计，每次更新都是O(1)的."""
+
+import math
+import time
+from typing import Callable, Optional
+
+__all__ = (
+    "ThroughputMeter",
+    "TransferStats",
+)
+
+
+class ThroughputMeter:
+    """用指数加权移动平均(EWMA)估计速度
+
+    `add` 只累加计数，速度在调用 `rate` 时才按距上次调用的时间间隔衰减并更新，
+    所以更新的频率再高也不会增加开销；`rate` 的调用间隔不影响估计结果的时间尺度.
+    """
+
+    def __init__(
+        self,
+        half_life: float = 2.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """EWMA速度估计器
+
+        Args:
+            half_life: 半衰期，单位为秒，越小对速度变化越敏感. Defaults to 2.0.
+            clock: 返回当前时间(秒)的函数. Defaults to time.monotonic.
+        """
+        self._tau = half_life / math.log(2)
+        self._clock = clock
+        self.start_time = clock()
+        self.total = 0
+        """累计的总量"""
+        self._pending = 0
+        self._last_time = self.start_time
+        self._rate = 0.0
+
+    def add(self, amount: int) -> None:
+        """累加 `amount`"""
+        self.total += amount
+        self._pending += amount
+
+    def rate(self, now: Optional[float] = None) -> float:
+        """当前的估计速度，单位为每秒的 `add` 单位"""
+        if now is None:
+            now = self._clock()
+        dt = now - self._last_time
+        if dt <= 0:
+            return self._rate
+        alpha = 1 - math.exp(-dt / self._tau)
+        self._rate += alpha * (self._pending / dt - self._rate)
+        self._pending = 0
+        self._last_time = now
+        return self._rate
+
+    def average(self, now: Optional[float] = None) -> float:
+        """从开始到现在的平均速度"""
+        if now is None:
+            now = self._clock()
+        elapsed = now - self.start_time
+        return self.total / elapsed if elapsed > 0 else 0.0
+
+
+class TransferStats:
+    """流式下载的传输状态：速度、总量、传输中的字节数和活动的连接数
+
+    `Downloader` 在接收每个数据块时调用 `received`，所以大文件的速度也是平滑准确的.
+    """
+
+    def __init__(self, half_life: float = 2.0):
+        """流式下载的传输状态
+
+        Args:
+            half_life: 速度估计的半衰期，单位为秒. Defaults to 2.0.
+        """
+        self.meter = ThroughputMeter(half_life)
+        self.active_streams = 0
+        """正在传输的连接数"""
+        self.bytes_in_flight = 0
+        """正在传输的文件已经接收的字节数"""
+
+    @property
+    def total_bytes(self) -> int:
+        """累计接收的字节数"""
+        return self.meter.total
+
+    def stream_started(self) -> None:
+        """一个连接开始传输"""
+        self.active_streams += 1
+
+    def received(self, nbytes: int) -> None:
+        """接收到 `nbytes` 字节"""
+        self.meter.add(nbytes)
+        self.bytes_in_flight += nbytes
+
+    def stream_finished(self, stream_bytes: int) -> None:
+        """一个连接结束传输(包括失败)，`stream_bytes` 为它接收的字节数"""
+        self.active_streams -= 1
+        self.bytes_in_flight -= stream_bytes
+
+    def describe(self) -> str:
+        """用于进度条的描述"""
+        mb = 1048576  # 1024 * 1024
+        return (
+            f"当前: {self.meter.rate() / mb:.2f}MB/s，"
+            f"平均: {self.meter.average() / mb:.2f}MB/s，"
+            f"总量: {self.total_bytes / mb:.2f}MB，"
+            f"传输中: {self.active_streams}个/{self.bytes_in_flight / mb:.2f}MB"
+        )
@@ -0,0 +1,183 @@
+"""每张图片下载过程的结构化追踪记录，用于分析下载慢在哪个阶段.
+
+每张图片输出一条JSONL记录，例如:
+    ```json
+    {"md5": "...", "url": "...", "state": "SUCCESS", "status": 200, "bytes": 123456,
+     "retries": 0, "failovers": 0, "start": 1700000000.0, "duration": 1.2,
+     "phases": {"md5_check": [0.0, 0.01], "semaphore_wait": [0.01, 0.5],
+                "ttfb": [0.5, 0.7], "transfer": [0.7, 1.1], "verify": [1.1, 1.2]},
+     "disk_write": 0.05, "error": null}
+    ```
+
+`phases` 中每个阶段为相对于 `start` 的 `[开始, 结束]` 秒数；
+`disk_write` 是 `transfer` 期间写入图片文件的累计耗时，它与网络传输交替进行，所以单独统计.
+校验失败重新下载时，`ttfb` 和 `transfer` 为最后一次下载的耗时，`bytes` 为所有下载的总和.
+`failovers` 是服务器失败后换用其他镜像的次数，最终成功时 `error` 为null.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from typing import Any, ContextManager, Dict, List, Optional
+
+__all__ = (
+    "DownloadTrace",
+    "TraceSink",
+    "trace_phase",
+)
+
+
+class DownloadTrace:
+    """一张图片的追踪记录，由 `Downloader` 在下载过程中填写"""
+
+    def __init__(self, file_url: str, md5: Optional[str] = None):
+        """一张图片的追踪记录
+
+        Args:
+            file_url: 图片链接
+            md5: 图片的md5. Defaults to None.
+        """
+        self.file_url = file_url
+        self.md5 = md5
+        self.start_time = time.time()
+        self._origin = time.perf_counter()
+        self.phases: Dict[str, List[float]] = {}
+        """各阶段相对于开始时间的 `[开始, 结束]` 秒数"""
+        self.status: Optional[int] = None
+        """最后一次下载的HTTP状态码"""
+        self.bytes = 0
+        """接收的字节数"""
+        self.retries = 0
+        """重新下载的次数"""
+        self.failovers = 0
+        """服务器失败后换用其他镜像的次数"""
+        self.disk_write = 0.0
+        """写入图片文件的累计耗时，单位为秒"""
+        self.error: Optional[str] = None
+        """最后一次下载的错误"""
+
+    def now(self) -> float:
+        """相对于开始时间的秒数"""
+        return time.perf_counter() - self._origin
+
+    def begin(self, phase: str) -> None:
+        """记录 `phase` 开始，同名阶段会被覆盖"""
+        now = self.now()
+        self.phases[phase] = [now, now]
+
+    def end(self, phase: str) -> None:
+        """记录 `phase` 结束"""
+        self.phases[phase][1] = self.now()
+
+    def record(self, state: str) -> Dict[str, Any]:
+        """生成JSONL记录
+
+        Args:
+            state: `DownloadResultState` 的名称
+        """
+        return {
+            "md5": self.md5,
+            "url": self.file_url,
+            "state": state,
+            "status": self.status,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "failovers": self.failovers,
+            "start": self.start_time,
+            "duration": round(self.now(), 6),
+            "phases": {
+                phase: [round(start, 6), round(end, 6)]
+                for phase, (start, end) in self.phases.items()
+            },
+            "disk_write": round(self.disk_write, 6),
+            "error": self.error,
+        }
+
+
+@contextlib.contextmanager
+def _phase(trace: DownloadTrace, phase: str):
+    trace.begin(phase)
+    try:
+        yield
+    finally:
+        trace.end(phase)
+
+
+def trace_phase(trace: Optional[DownloadTrace], phase: str) -> ContextManager[None]:
+    """记录 `with` 块作为 `phase` 的耗时，`trace` 为 `None` 时什么也不做"""
+    if trace is None:
+        return contextlib.nullcontext()
+    return _phase(trace, phase)
+
+
+class TraceSink:
+    """将追踪记录批量写入JSONL文件
+
+    `emit` 只把记录放入内存中的列表，序列化和写入由后台任务定期在线程中完成，
+    所以不会拖慢下载协程.
+
+    用法:
+        ```python
+        sink = TraceSink("trace.jsonl")
+        sink.start()
+        sink.emit(trace.record("SUCCESS"))
+        await sink.close()
+        ```
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        """追踪记录写入器
+
+        Args:
+            path: JSONL文件路径，不存在时会被创建，存在时追加写入.
+            flush_interval: 后台写入的间隔，单位为秒. Defaults to 1.0.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task[None]] = None
+        self._lock = asyncio.Lock()
+        self._closing = asyncio.Event()
+
+    def start(self) -> None:
+        """启动后台写入任务，必须在事件循环中调用"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._closing.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._closing.wait(), self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"写入追踪记录 {self.path} 时发生错误, error: {e}")
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        """缓存一条记录"""
+        self._buffer.append(record)
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def flush(self) -> None:
+        """在线程中写入所有缓存的记录"""
+        if not self._buffer:
+            return
+        # 先交换缓存，写入期间到来的新记录会进入新的缓存
+        records, self._buffer = self._buffer, []
+        async with self._lock:
+            await asyncio.to_thread(self._write, records)
+
+    async def close(self) -> None:
+        """停止后台任务并写入剩余的记录"""
+        # 不取消后台任务，否则正在排队等待线程的写入会连同其中的记录一起被取消
+        self._closing.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()